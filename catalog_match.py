@@ -0,0 +1,262 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Matching files against a local catalog of releases to fill in missing
+# tags (FILL_FRAMES).
+#
+# A catalog is a CSV file or an SQLite table with one row per track and
+# columns named by frame key (TIT2, TPE1, TALB, TRCK, TDRC, ...). Other
+# columns are ignored. The catalog is indexed once by the trigrams of each
+# track's title. A file is matched by its title (from its TIT2 tag or else
+# its file name) and scored by title, artist, album and track similarity.
+#
+
+import csv
+import os
+import re
+import sqlite3
+import unicodedata
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import id3frames
+import library_scan
+import tag_formats
+
+# The frames a match fills in when a file does not have them
+FILL_FRAMES = ("TALB", "TPE1", "TRCK", "TDRC")
+
+DEFAULT_MIN_CONFIDENCE = 0.8
+
+# A best proposal must beat a different second best by this much to be
+# applied without asking
+AMBIGUITY_MARGIN = 0.05
+
+# Weights of the parts of a match score
+_TITLE_WEIGHT = 0.6
+_ARTIST_WEIGHT = 0.25
+_ALBUM_WEIGHT = 0.15
+_TRACK_WEIGHT = 0.1
+
+# Number of index candidates scored per file
+_CANDIDATES = 50
+
+# Leading track number of a file name, e.g. "01 - ", "3. "
+_TRACK_PREFIX = re.compile(r"^\d+\s*[-._)]*\s*")
+
+
+def normalize(text):
+    """
+    Lower case, without accents or punctuation, single spaced
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", text.lower()).split())
+
+
+def trigrams(text):
+    """
+    :param text: Any text, it is normalized first
+    :return: The set of 3 character substrings, with word boundaries padded
+    """
+    text = " " + normalize(text) + " "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(a, b):
+    """
+    Dice coefficient of the trigrams of two texts, 0 to 1
+    """
+    ga = a if isinstance(a, (set, frozenset)) else trigrams(a)
+    gb = b if isinstance(b, (set, frozenset)) else trigrams(b)
+    if not ga or not gb:
+        return 0.0
+    return 2.0 * len(ga & gb) / (len(ga) + len(gb))
+
+
+def load_catalog(path, table="catalog"):
+    """
+    Read a catalog
+    :param path: CSV file or SQLite database
+    :param table: Table name in an SQLite database
+    :return: A list of dicts of frame key to value
+    """
+    keys = set(id3frames.frame_keys())
+    with open(path, "rb") as f:
+        is_sqlite = f.read(16) == b"SQLite format 3\x00"
+
+    if is_sqlite:
+        if not re.match(r"^\w+$", table):
+            raise ValueError("Invalid table name {0}".format(table))
+        db = sqlite3.connect(path)
+        try:
+            cursor = db.execute("SELECT * FROM {0}".format(table))
+            columns = [d[0].upper() for d in cursor.description]
+            rows = (dict(zip(columns, row)) for row in cursor)
+            return [_catalog_entry(row, keys) for row in rows]
+        finally:
+            db.close()
+
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        return [_catalog_entry({k.upper(): v for k, v in row.items() if k}, keys) for row in reader]
+
+
+def _catalog_entry(row, keys):
+    return {k: str(v) for k, v in row.items() if k in keys and v not in (None, "")}
+
+
+class Proposal():
+    """
+    A catalog entry proposed for a file
+    """
+    def __init__(self, confidence, entry, values):
+        """
+        :param confidence: Match score, 0 to 1
+        :param entry: The catalog entry
+        :param values: Dict of the frames the entry would fill in
+        """
+        self.confidence = confidence
+        self.entry = entry
+        self.values = values
+
+    def __repr__(self):
+        return "Proposal({0:.2f}, {1})".format(self.confidence, self.values)
+
+
+class CatalogIndex():
+    """
+    Trigram index over the titles of a catalog
+    """
+    def __init__(self, entries):
+        """
+        :param entries: Catalog entries (see load_catalog)
+        """
+        self.entries = entries
+        self._titles = []
+        # trigram -> list of entry numbers
+        self._postings = defaultdict(list)
+        for i, entry in enumerate(entries):
+            grams = frozenset(trigrams(entry.get("TIT2", "")))
+            self._titles.append(grams)
+            for g in grams:
+                self._postings[g].append(i)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def propose(self, record, filename=None, limit=3):
+        """
+        Rank catalog entries for a file
+        :param record: The file's tag record
+        :param filename: The file's path, used when it has no title
+        :param limit: Maximum number of proposals
+        :return: A list of Proposal, best first. Only entries that would
+        fill in at least one missing frame are proposed.
+        """
+        from_filename = "TIT2" not in record
+        if from_filename:
+            if not filename:
+                return []
+            title = _TRACK_PREFIX.sub("", os.path.splitext(os.path.basename(filename))[0])
+        else:
+            title = record["TIT2"]
+        title_grams = trigrams(title)
+
+        # Trigrams in a large part of the catalog (e.g. "the") say little and
+        # cost a lot to count, they are skipped unless there is nothing else
+        grams = sorted((g for g in title_grams if g in self._postings), key=lambda g: len(self._postings[g]))
+        common = max(1000, len(self.entries) // 20)
+        grams = [g for g in grams if len(self._postings[g]) <= common] or grams[:3]
+        counts = Counter()
+        for g in grams:
+            counts.update(self._postings[g])
+
+        proposals = []
+        for i, _ in counts.most_common(_CANDIDATES):
+            entry = self.entries[i]
+            values = {k: entry[k] for k in FILL_FRAMES if k in entry and k not in record}
+            if not values:
+                continue
+            confidence = self._score(record, title_grams, from_filename, i)
+            proposals.append(Proposal(confidence, entry, values))
+        proposals.sort(key=lambda p: p.confidence, reverse=True)
+        return proposals[:limit]
+
+    def _score(self, record, title_grams, from_filename, i):
+        entry = self.entries[i]
+        title_score = similarity(title_grams, self._titles[i])
+        if from_filename and "TPE1" in entry:
+            # File names are often "Artist - Title"
+            title_score = max(title_score, similarity(title_grams, entry["TPE1"] + " " + entry.get("TIT2", "")))
+        parts = [(_TITLE_WEIGHT, title_score)]
+        if "TPE1" in record and "TPE1" in entry:
+            parts.append((_ARTIST_WEIGHT, similarity(record["TPE1"], entry["TPE1"])))
+        if "TALB" in record and "TALB" in entry:
+            parts.append((_ALBUM_WEIGHT, similarity(record["TALB"], entry["TALB"])))
+        if "TRCK" in record and "TRCK" in entry:
+            parts.append((_TRACK_WEIGHT, 1.0 if _track_number(record["TRCK"]) == _track_number(entry["TRCK"]) else 0.0))
+        return sum(w * s for w, s in parts) / sum(w for w, s in parts)
+
+
+def _track_number(value):
+    m = re.match(r"\s*(\d+)", value)
+    return int(m.group(1)) if m else None
+
+
+def accepted(proposals, min_confidence=DEFAULT_MIN_CONFIDENCE):
+    """
+    The proposal that can be applied without asking, if any: confident
+    enough and clearly better than any different runner up
+    :param proposals: Ranked proposals (see CatalogIndex.propose)
+    :return: A Proposal or None
+    """
+    if not proposals or proposals[0].confidence < min_confidence:
+        return None
+    best = proposals[0]
+    for other in proposals[1:]:
+        if other.values != best.values and other.confidence > best.confidence - AMBIGUITY_MARGIN:
+            return None
+    return best
+
+
+# The index in a worker process, see match_files
+_worker_index = None
+
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def _propose_file(fn):
+    return _worker_index.propose(tag_formats.read_record(fn), fn)
+
+
+def match_files(index, files, workers=None):
+    """
+    Propose catalog entries for many files. Matching is CPU bound, so it
+    runs on a pool of processes, each with its own copy of the index.
+    :param index: A CatalogIndex
+    :param files: Iterable of file paths
+    :param workers: Number of processes, default the number of CPUs
+    :return: A generator of (path, proposals, error) 3-tuples, in completion order
+    """
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index,))
+    try:
+        yield from library_scan.parallel_map(_propose_file, files, workers=workers, executor=executor)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
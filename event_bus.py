@@ -0,0 +1,93 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Events between the widgets and the app. Events are not delivered when
+# they are published but together once Tk is idle, so the events of one
+# action (e.g. loading a file) cost subscribers one call. An event
+# replaces an earlier undelivered event of the same kind and key. Tk is
+# idle between two keys, typing is held back by the widget until it
+# pauses (see ID3TagsWidget).
+#
+# Events must be published on the Tk thread.
+#
+
+from collections import OrderedDict, defaultdict
+
+# A tag value was edited. Key and payload: the tag name.
+TAG_CHANGED = "tag-changed"
+# A tag was added to or deleted from the open file. Key and payload: the tag name.
+TAG_ADDED = "tag-added"
+TAG_DELETED = "tag-deleted"
+# The open file has unsaved changes. Key and payload: the file path.
+FILE_DIRTY = "file-dirty"
+# A file's tags were saved. Key and payload: the file path.
+FILE_SAVED = "file-saved"
+# The unsaved changes of a file were discarded. Key and payload: the file path.
+FILE_REVERTED = "file-reverted"
+
+
+class EventBus():
+    """
+    Publish/subscribe with delivery batched per Tk idle cycle
+    """
+    def __init__(self, widget):
+        """
+        :param widget: Any Tk widget, used to schedule delivery
+        """
+        self._widget = widget
+        # kind -> list of callbacks
+        self._subscribers = defaultdict(list)
+        # (kind, key) -> payload, in publish order
+        self._pending = OrderedDict()
+        self._scheduled = False
+
+    def subscribe(self, kinds, callback):
+        """
+        :param kinds: Event kinds to receive
+        :param callback: Called once per delivery with a list of (kind,
+        payload) 2-tuples in the order they were published
+        :return: None
+        """
+        for kind in kinds:
+            if callback not in self._subscribers[kind]:
+                self._subscribers[kind].append(callback)
+
+    def publish(self, kind, key, payload=None):
+        """
+        Queue an event for delivery when Tk is idle
+        :param kind: Event kind
+        :param key: Undelivered events of the same kind and key are replaced
+        :param payload: Delivered to subscribers, default the key
+        :return: None
+        """
+        # Moved to the end, the latest event of a key is delivered in its place
+        self._pending.pop((kind, key), None)
+        self._pending[(kind, key)] = key if payload is None else payload
+        if not self._scheduled:
+            self._scheduled = True
+            self._widget.after_idle(self._deliver)
+
+    def _deliver(self):
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._scheduled = False
+        # callback -> its events, callbacks in the order of their first event
+        batches = OrderedDict()
+        for (kind, key), payload in pending.items():
+            for callback in self._subscribers.get(kind, []):
+                batches.setdefault(callback, []).append((kind, payload))
+        for callback, events in batches.items():
+            callback(events)
@@ -18,6 +18,8 @@
 import os
 from tkinter import Button, Frame, LabelFrame, Listbox, filedialog, Scrollbar
 import tkinter
+import session_state
+import tag_formats
 from status_bar import StatusBar
 
 
@@ -49,8 +51,9 @@ class FileList(Frame):
         self._open_directory_callback = open_directory
 
         self._file_type = None
-        # TODO It would be nice to persist the last used path
-        self._mp3_dir = "./"
+        self._mp3_dir = session_state.load().get("mp3_dir", "./")
+        if not os.path.isdir(self._mp3_dir):
+            self._mp3_dir = "./"
 
         self.background_color = "#ffffff"
         self.highlight_color = "#e0e0e0"
@@ -115,10 +118,11 @@ class FileList(Frame):
             if not directory.endswith("/"):
                 directory += "/"
             self._mp3_dir = directory
+            session_state.update({"mp3_dir": directory})
             # Load listbox with files from directory
             self._filelist.delete(0, last=self._filelist.size() - 1)
             for file in os.listdir(directory):
-                if file.endswith(".mp3"):
+                if file.endswith(tag_formats.extensions()):
                     self._filelist.insert(tkinter.END, file)
             self._status_bar.set(directory)
             self._open_button.config(state=tkinter.DISABLED)
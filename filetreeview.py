@@ -17,9 +17,112 @@
 
 import os
 import re
+import bisect
 import datetime
+import queue
+import threading
 import tkinter as tk
 import tkinter.ttk as ttk
+import event_bus
+import io_scheduler
+import tag_formats
+import ui_watchdog
+
+# Total number of directory entries kept by session_state
+MAX_SESSION_ENTRIES = 100000
+
+# Sortable columns: column id -> heading text
+SORT_COLUMNS = {"#0": "Name", "Size": "Size", "Date Modified": "Date Modified"}
+
+# A reorder that takes more moves than this replaces the whole child list instead
+_MAX_MOVES = 200
+
+_DIGITS = re.compile(r"(\d+)")
+
+
+def list_directory(abspath, filter_regex):
+    """
+    List what the tree shows of a directory
+    :param abspath: Directory
+    :param filter_regex: Compiled filter for file names
+    :return: A 2-tuple (directory modification time in ns, list of
+    [name, is_dir, size, mtime] entries sorted by name)
+    """
+    # Taken first, so a change while listing is seen the next time
+    mtime_ns = os.stat(abspath).st_mtime_ns
+    entries = []
+    for name in os.listdir(abspath):
+        fullpath = os.path.join(abspath, name)
+        if os.path.isdir(fullpath):
+            entries.append([name, True, 0, 0])
+        elif filter_regex.match(name):
+            sr = os.lstat(fullpath)
+            entries.append([name, False, sr.st_size, sr.st_mtime])
+    entries.sort(key=lambda e: e[0].lower())
+    return mtime_ns, entries
+
+
+def _file_values(size, mtime):
+    return "{0:,}".format(size), datetime.datetime.fromtimestamp(mtime)
+
+
+def natural_key(text):
+    """
+    Sort key for names that orders the numbers in them by value, e.g.
+    "2 Intro" before "10 Outro". Case is ignored.
+    """
+    parts = _DIGITS.split(text.lower())
+    # Odd parts are the numbers
+    parts[1::2] = [int(p) for p in parts[1::2]]
+    return parts
+
+
+def sort_order(keyed, column, descending=False):
+    """
+    Sort nodes by a column
+    :param keyed: List of (node, key) 2-tuples, key is a (natural_key of the
+    name, is_dir, size, mtime) 4-tuple
+    :param column: A SORT_COLUMNS column id
+    :param descending: Largest first
+    :return: List of the nodes in order. When sorted by size or date
+    directories come first, by name.
+    """
+    if column == "#0":
+        return [node for node, key in sorted(keyed, key=lambda nk: nk[1][0], reverse=descending)]
+    part = 2 if column == "Size" else 3
+    ordered = sorted(keyed, key=lambda nk: (nk[1][part], nk[1][0]), reverse=descending)
+    return [node for node, key in ordered if key[1]] + [node for node, key in ordered if not key[1]]
+
+
+def nodes_to_move(current, desired):
+    """
+    The fewest nodes to move to turn one order into another: all but a
+    longest run of nodes that are already in the right relative order
+    :param current: List of nodes in their current order
+    :param desired: The same nodes in the new order
+    :return: A set of nodes
+    """
+    position = {node: i for i, node in enumerate(desired)}
+    # Longest increasing subsequence of desired positions, O(n log n)
+    tails = []
+    tail_nodes = []
+    previous = {}
+    for node in current:
+        p = position[node]
+        i = bisect.bisect_left(tails, p)
+        previous[node] = tail_nodes[i - 1] if i else None
+        if i == len(tails):
+            tails.append(p)
+            tail_nodes.append(node)
+        else:
+            tails[i] = p
+            tail_nodes[i] = node
+    keep = set()
+    node = tail_nodes[-1] if tail_nodes else None
+    while node is not None:
+        keep.add(node)
+        node = previous[node]
+    return set(current) - keep
 
 
 class FileTreeView(tk.Frame):
@@ -31,8 +134,9 @@ class FileTreeView(tk.Frame):
                  width=100, height=100,
                  background=None,
                  select=None, action=None,
-                 filter_regex=".+\.mp3$",
-                 title="File TreeView"):
+                 filter_regex=None,
+                 title="File TreeView",
+                 bus=None):
         """
         Create an instance of the widget
         :param parent: parent of this widget
@@ -42,12 +146,38 @@ class FileTreeView(tk.Frame):
         :param background: Background color as a Tkinter color (e.g. "#e8e8e8") or None
         :param select: callback for item selection
         :param action: callback for double-click action
-        :param filter_regex: filter regex for files (does not apply to directories)
+        :param filter_regex: filter regex for files (does not apply to directories), default
+        the files of every supported format (see tag_formats)
         :param title: text for the title at the top of the widget
+        :param bus: Optional EventBus, files with unsaved or saved changes are marked (see event_bus)
         """
         super(FileTreeView, self).__init__(parent)
 
+        # Directory nodes that have not been opened yet -> their path
         self._nodes = dict()
+        # Path -> node of the directories that have been opened
+        self._dir_nodes = dict()
+        # Path -> (modification time in ns, entries) of directory listings (see list_directory)
+        self._listings = dict()
+        # Listings checked against the disk in the background (see restore_session)
+        self._revalidated = queue.Queue()
+        # Changed whenever the tree is rebuilt, so late background results are dropped
+        self._generation = 0
+        # Parent node of the query results list, see show_results
+        self._results_node = None
+        # The directory tree's session_state while results are shown
+        self._tree_state = None
+        # Node -> sort key (see sort_order), computed when the node is inserted
+        self._sort_keys = dict()
+        self._sort_column = "#0"
+        self._sort_descending = False
+        # Orders computed in the background by sort_by
+        self._sorted = queue.Queue()
+        self._sort_generation = 0
+        # File path -> "dirty" or "saved", shown with the Treeview tag of the same name
+        self._file_states = dict()
+        # Files saved in this session
+        self._saved_files = set()
         self._title = title
         self._select_callback = select
         self._action_callback = action
@@ -73,52 +203,251 @@ class FileTreeView(tk.Frame):
         self._dir_tree.column("Size", width=100, minwidth=100, stretch=False)
         self._dir_tree.column("Date Modified", width=0, minwidth=150)
         # Note that the file/dir name goes in the icon column
-        self._dir_tree.heading('#0', text='Name', anchor='w')
-        self._dir_tree.heading('Size', text='Size', anchor='w')
-        self._dir_tree.heading('Date Modified', text='Date Modified', anchor='w')
+        for column, text in SORT_COLUMNS.items():
+            self._dir_tree.heading(column, text=text, anchor='w',
+                                   command=lambda column=column: self.sort_by(column))
+        self._show_sort_heading()
+
+        self._dir_tree.tag_configure("dirty", foreground="#c00000")
+        self._dir_tree.tag_configure("saved", foreground="#008000")
 
         ysb.grid(row=0, column=1, sticky=tk.NS)
         xsb.grid(row=1, column=0, sticky=tk.EW)
 
         self._path = path
-        # The filter is a regex expression that defaults to all mp3 files
-        self.set_filter(filter_regex)
+        # The filter is a regex expression that defaults to all supported files
+        self.set_filter(filter_regex or tag_formats.file_filter())
 
         # Event capture
         self._dir_tree.bind('<<TreeviewOpen>>', self._open_node)
         self._dir_tree.bind("<<TreeviewSelect>>", self._on_select)
         self._dir_tree.bind("<Double-1>", self._on_double_click)
+        if bus:
+            bus.subscribe((event_bus.FILE_DIRTY, event_bus.FILE_SAVED, event_bus.FILE_REVERTED),
+                          self._on_file_events)
 
     def _insert_node(self, parent, text, abspath):
-        # Note that the tags value is used to hold the full filepath
         if os.path.isdir(abspath):
-            values = ("",)
+            self._insert_entry(parent, 'end', text, abspath, True, 0, 0)
         else:
             # For a file, supply size and last modified time
             sr = os.lstat(abspath)
-            sz = "{0:,}".format(sr.st_size)
-            dt = datetime.datetime.fromtimestamp(sr.st_mtime)
-            values = (sz, dt)
+            self._insert_entry(parent, 'end', text, abspath, False, sr.st_size, sr.st_mtime)
+
+    def _insert_entry(self, parent, index, text, abspath, is_dir, size, mtime):
+        # Note that the tags value is used to hold the full filepath
+        values = ("",) if is_dir else _file_values(size, mtime)
         # Here text is the icon column and values are the size and date columns
-        node = self._dir_tree.insert(parent, 'end', open=False, tags=(abspath,),
+        node = self._dir_tree.insert(parent, index, open=False, tags=self._node_tags(abspath),
                                      text=text, values=values)
+        self._sort_keys[node] = (natural_key(text), is_dir, size, mtime)
 
-        if os.path.isdir(abspath):
+        if is_dir:
             self._nodes[node] = abspath
             self._dir_tree.insert(node, 'end')
+        return node
 
+    def _node_tags(self, abspath):
+        state = self._file_states.get(abspath)
+        return (abspath, state) if state else (abspath,)
+
+    def _file_nodes(self, abspath):
+        """
+        :return: The nodes of a file, in its directory and in the results list
+        """
+        nodes = []
+        for parent in (self._dir_nodes.get(os.path.dirname(abspath)), self._results_node):
+            if parent is not None and self._dir_tree.exists(parent):
+                nodes.extend(c for c in self._dir_tree.get_children(parent)
+                             if self._dir_tree.item(c, "tags")[:1] == (abspath,))
+        return nodes
+
+    def _on_file_events(self, events):
+        """
+        Mark files with unsaved changes and files that were saved
+        :param events: List of (kind, file path) from the event bus
+        """
+        for kind, abspath in events:
+            if kind == event_bus.FILE_SAVED:
+                self._saved_files.add(abspath)
+                self._file_states[abspath] = "saved"
+            elif kind == event_bus.FILE_DIRTY:
+                self._file_states[abspath] = "dirty"
+            elif abspath in self._saved_files:
+                self._file_states[abspath] = "saved"
+            else:
+                self._file_states.pop(abspath, None)
+            for node in self._file_nodes(abspath):
+                self._dir_tree.item(node, tags=self._node_tags(abspath))
+                if kind == event_bus.FILE_SAVED:
+                    # Saving changes the size and modification time
+                    try:
+                        sr = os.lstat(abspath)
+                    except OSError:
+                        continue
+                    self._dir_tree.item(node, values=_file_values(sr.st_size, sr.st_mtime))
+                    key = self._sort_keys.get(node)
+                    if key:
+                        self._sort_keys[node] = (key[0], False, sr.st_size, sr.st_mtime)
+
+    @ui_watchdog.instrumented
     def _open_node(self, event):
-        node = self._dir_tree.focus()
+        self._populate(self._dir_tree.focus())
+
+    def _populate(self, node):
+        """
+        Fill in a directory node the first time it is opened, from its
+        cached listing if there is one
+        """
         abspath = self._nodes.pop(node, None)
         if abspath:
-            self._dir_tree.delete(self._dir_tree.get_children(node))
-            sorted_list = sorted(os.listdir(abspath), key=str.lower)
-            for p in sorted_list:
-                fullpath = os.path.join(abspath, p)
-                # Filter contents (e.g. *.mp3 files)
-                if (not os.path.isdir(fullpath)) and (not self._filter_regex.match(p)):
+            listing = self._listings.get(abspath)
+            if listing is None:
+                # Counts against the I/O budgets like opening a file does
+                with io_scheduler.default().operation(0, io_scheduler.INTERACTIVE):
+                    listing = list_directory(abspath, self._filter_regex)
+                self._listings[abspath] = listing
+            self._dir_nodes[abspath] = node
+            self._apply_listing(node, abspath, listing[1])
+
+    def _apply_listing(self, node, abspath, entries):
+        """
+        Make a directory node's children match a listing. Children that are
+        still in the listing are kept, with their own children and open state.
+        """
+        existing = {}
+        for child in self._dir_tree.get_children(node):
+            tags = self._dir_tree.item(child, "tags")
+            if tags:
+                existing[tags[0]] = child
+            else:
+                # Placeholder that makes an unopened directory openable
+                self._dir_tree.delete(child)
+
+        children = []
+        for name, is_dir, size, mtime in entries:
+            fullpath = os.path.join(abspath, name)
+            child = existing.pop(fullpath, None)
+            if child is None:
+                child = self._insert_entry(node, 'end', name, fullpath, is_dir, size, mtime)
+            elif not is_dir:
+                self._dir_tree.item(child, values=_file_values(size, mtime))
+                self._sort_keys[child] = (natural_key(name), False, size, mtime)
+            children.append(child)
+        for fullpath, child in existing.items():
+            self._forget(fullpath, child)
+        desired = sort_order([(c, self._sort_keys[c]) for c in children],
+                             self._sort_column, self._sort_descending)
+        self._reorder(node, list(self._dir_tree.get_children(node)), desired)
+
+    def _forget(self, abspath, node):
+        """
+        Remove a node that is no longer on disk, and everything known about it
+        """
+        for child in self._descendants(node):
+            self._sort_keys.pop(child, None)
+        self._dir_tree.delete(node)
+        under = lambda p: p == abspath or p.startswith(abspath + os.sep)
+        self._nodes = {n: p for n, p in self._nodes.items() if not under(p)}
+        self._dir_nodes = {p: n for p, n in self._dir_nodes.items() if not under(p)}
+        self._listings = {p: listing for p, listing in self._listings.items() if not under(p)}
+
+    def _descendants(self, node):
+        nodes = [node]
+        for child in self._dir_tree.get_children(node):
+            nodes.extend(self._descendants(child))
+        return nodes
+
+    def _reorder(self, parent, current, desired):
+        """
+        Put the children of a node in a new order with as few changes to
+        the Treeview as possible
+        :param parent: The node
+        :param current: Its children as they are now
+        :param desired: The same children in the new order
+        """
+        if current == desired:
+            return
+        moves = nodes_to_move(current, desired)
+        if len(moves) > _MAX_MOVES:
+            self._dir_tree.set_children(parent, *desired)
+            return
+        # The nodes left are in the right order, each moved node then goes
+        # straight to its place
+        self._dir_tree.detach(*moves)
+        for i, node in enumerate(desired):
+            if node in moves:
+                self._dir_tree.move(node, parent, i)
+
+    def sort_by(self, column):
+        """
+        Sort every listed directory (or the results list) by a column.
+        Clicking the column the tree is sorted by reverses the order. The
+        orders are worked out on a worker thread and applied when ready.
+        :param column: A SORT_COLUMNS column id
+        :return: None
+        """
+        if column == self._sort_column:
+            self._sort_descending = not self._sort_descending
+        else:
+            self._sort_column = column
+            self._sort_descending = False
+        self._show_sort_heading()
+        self._sort_generation += 1
+
+        parents = [node for node in self._dir_nodes.values() if self._dir_tree.exists(node)]
+        if self._results_node is not None:
+            parents.append(self._results_node)
+        work = []
+        for parent in parents:
+            children = self._dir_tree.get_children(parent)
+            keyed = [(c, self._sort_keys.get(c)) for c in children]
+            if len(keyed) > 1 and all(key is not None for c, key in keyed):
+                work.append((parent, keyed))
+        threading.Thread(target=self._sort_worker,
+                         args=(self._sort_generation, column, self._sort_descending, work),
+                         daemon=True).start()
+        self.after(20, self._poll_sorted, self._sort_generation)
+
+    def _show_sort_heading(self):
+        for column, text in SORT_COLUMNS.items():
+            if column == self._sort_column:
+                text += " \u25bc" if self._sort_descending else " \u25b2"
+            self._dir_tree.heading(column, text=text)
+
+    def _sort_worker(self, generation, column, descending, work):
+        """
+        Runs on a worker thread
+        """
+        for parent, keyed in work:
+            current = [c for c, key in keyed]
+            self._sorted.put((generation, parent, current, sort_order(keyed, column, descending)))
+        self._sorted.put((generation, None, None, None))
+
+    def _poll_sorted(self, generation):
+        if generation != self._sort_generation:
+            # Sorted again since
+            return
+        while True:
+            try:
+                result_generation, parent, current, desired = self._sorted.get_nowait()
+            except queue.Empty:
+                self.after(20, self._poll_sorted, generation)
+                return
+            if result_generation != generation:
+                continue
+            if parent is None:
+                return
+            if not self._dir_tree.exists(parent):
+                continue
+            children = list(self._dir_tree.get_children(parent))
+            if children != current:
+                # Changed while sorting, sort what is there now
+                keyed = [(c, self._sort_keys.get(c)) for c in children]
+                if any(key is None for c, key in keyed):
                     continue
-                self._insert_node(node, p, fullpath)
+                desired = sort_order(keyed, self._sort_column, self._sort_descending)
+            self._reorder(parent, children, desired)
 
     def _on_select(self, event):
         if self._select_callback:
@@ -143,10 +472,155 @@ class FileTreeView(tk.Frame):
         :return:
         """
         self._dir_tree.delete(*self._dir_tree.get_children())
+        self._nodes = dict()
+        self._dir_nodes = dict()
+        self._listings = dict()
+        self._sort_keys = dict()
+        self._generation += 1
+        self._results_node = None
+        self._tree_state = None
         abspath = os.path.abspath(path)
         self._insert_node('', abspath, abspath)
         self._path = path
 
+    @property
+    def path(self):
+        """
+        The absolute path of the tree's origin
+        """
+        return os.path.abspath(self._path)
+
+    def show_results(self, title):
+        """
+        Replace the directory tree with an (initially empty) list of
+        files, e.g. the files found by a query. Use add_result to add
+        files to the list and set_path to go back to the directory tree.
+        :param title: Text for the node that holds the results
+        :return: None
+        """
+        if self._results_node is None:
+            self._tree_state = self.session_state()
+        self._dir_tree.delete(*self._dir_tree.get_children())
+        self._nodes = dict()
+        self._dir_nodes = dict()
+        self._sort_keys = dict()
+        self._generation += 1
+        self._results_node = self._dir_tree.insert('', 'end', open=True, tags=(self.path,),
+                                                   text=title, values=("",))
+
+    def add_result(self, filepath):
+        """
+        Add a file to the results list
+        :param filepath: Full path of the file
+        :return: None
+        """
+        self._insert_node(self._results_node, os.path.relpath(filepath, self.path), filepath)
+
+    def add_problems(self, filepath, messages):
+        """
+        Add a file and its problems to the results list (see show_results).
+        The problems are listed under the file and selecting one selects the file.
+        :param filepath: Full path of the file
+        :param messages: List of problem descriptions
+        :return: None
+        """
+        text = os.path.relpath(filepath, self.path)
+        node = self._dir_tree.insert(self._results_node, 'end', open=True, tags=(filepath,),
+                                     text=text, values=("",))
+        self._sort_keys[node] = (natural_key(text), False, 0, 0)
+        for message in messages:
+            self._dir_tree.insert(node, 'end', tags=(filepath,), text=message, values=("",))
+
+    def session_state(self):
+        """
+        What to save to show the same tree in the next session (see
+        restore_session): the origin path, the expanded directories and
+        their listings
+        :return: A dict of JSON serializable values
+        """
+        if self._results_node is not None:
+            return self._tree_state
+        expanded = [p for p, node in self._dir_nodes.items()
+                    if self._dir_tree.exists(node) and self._dir_tree.item(node, "open")]
+        listings = dict()
+        total = 0
+        for p in expanded:
+            listing = self._listings.get(p)
+            if listing and total + len(listing[1]) <= MAX_SESSION_ENTRIES:
+                listings[p] = listing
+                total += len(listing[1])
+        return {"path": self.path, "filter": self._filter_regex.pattern,
+                "expanded": expanded, "listings": listings}
+
+    def restore_session(self, state):
+        """
+        Show the tree saved by session_state. The saved directories are
+        expanded at once from their saved listings, which are then checked
+        against the disk in the background and updated where they changed.
+        :param state: A dict from session_state
+        :return: None
+        """
+        self.set_path(state["path"])
+        if state.get("filter") == self._filter_regex.pattern:
+            self._listings = {p: tuple(listing) for p, listing in state.get("listings", {}).items()}
+        # Parents before their children
+        for p in sorted(state.get("expanded", []), key=len):
+            node = next((n for n, path in self._nodes.items() if path == p), None)
+            if node is None:
+                continue
+            try:
+                self._populate(node)
+            except OSError:
+                # Gone since the last session
+                continue
+            self._dir_tree.item(node, open=True)
+
+        cached = list(self._listings.items())
+        threading.Thread(target=self._revalidate, args=(self._generation, cached), daemon=True).start()
+        self.after(100, self._poll_revalidated, self._generation)
+
+    def _revalidate(self, generation, cached):
+        """
+        Runs on a worker thread. Lists the cached directories that changed.
+        """
+        scheduler = io_scheduler.default()
+        for abspath, (mtime_ns, entries) in cached:
+            try:
+                with scheduler.operation(0, io_scheduler.BACKGROUND):
+                    if os.stat(abspath).st_mtime_ns == mtime_ns:
+                        continue
+                    listing = list_directory(abspath, self._filter_regex)
+            except OSError:
+                listing = None
+            self._revalidated.put((generation, abspath, listing))
+        self._revalidated.put((generation, None, None))
+
+    def _poll_revalidated(self, generation):
+        if generation != self._generation:
+            # The tree was rebuilt since
+            return
+        while True:
+            try:
+                result_generation, abspath, listing = self._revalidated.get_nowait()
+            except queue.Empty:
+                self.after(100, self._poll_revalidated, generation)
+                return
+            if result_generation != generation:
+                # Left over from an earlier tree
+                continue
+            if abspath is None:
+                return
+            node = self._dir_nodes.get(abspath)
+            if listing is None:
+                if node is not None and self._dir_tree.parent(node):
+                    self._forget(abspath, node)
+                else:
+                    self._listings.pop(abspath, None)
+                continue
+            self._listings[abspath] = listing
+            if node is not None and self._dir_tree.exists(node):
+                self._apply_listing(node, abspath, listing[1])
+
     def set_filter(self, filter_regex):
         self._filter_regex = re.compile(filter_regex)
         self.set_path(self._path)
@@ -0,0 +1,204 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# A look inside the frames the editor does not support (PRIV, GEOB,
+# MCDI and the like). A frame's contents are wrapped in a memoryview and
+# shown a page at a time, as text where they decode and as a hex dump
+# otherwise, so a multi-MB blob is never copied as a whole. Contents are
+# only looked at when a frame is inspected, the sizes shown for a file's
+# frames and the library statistics come from the frame headers (see
+# tag_regions.frame_headers), without reading or parsing frame contents.
+#
+
+import id3frames
+import io_scheduler
+import library_scan
+import tag_regions
+
+# Bytes shown per page
+PAGE_SIZE = 4096
+# Bytes per hex dump line
+_HEX_WIDTH = 16
+# UTF-16 byte order marks
+_BOMS = (b"\xff\xfe", b"\xfe\xff")
+
+
+def is_supported(key):
+    """
+    :param key: Frame key or ID, e.g. "TALB" or "PRIV:owner:..."
+    :return: True if the editor edits the frame
+    """
+    return key[:4] in id3frames.frame_keys()
+
+
+def frame_contents(frame):
+    """
+    The contents of a frame, without copying them when the frame keeps
+    them as bytes (PRIV, GEOB, MCDI, APIC...)
+    :param frame: mutagen ID3 frame
+    :return: A memoryview of the contents
+    """
+    data = getattr(frame, "data", None)
+    if not isinstance(data, bytes):
+        # The frame as mutagen prints it, e.g. "TXXX=description=text"
+        data = frame.pprint().encode("utf-8")
+    return memoryview(data)
+
+
+def frame_summary(frame, size=None):
+    """
+    :param frame: mutagen ID3 frame
+    :param size: The frame's size in bytes as stored (see stored_sizes), None if not known
+    :return: A one line description, e.g. "PRIV 1.2 MB, owner=www.example.com"
+    """
+    details = []
+    for attr in ("owner", "mime", "filename", "desc"):
+        value = getattr(frame, attr, None)
+        if value:
+            details.append("{0}={1}".format(attr, value))
+    if size is None:
+        return ", ".join([frame.FrameID] + details)
+    return ", ".join(["{0} {1}".format(frame.FrameID, format_size(size))] + details)
+
+
+def format_size(size):
+    """
+    :param size: Size in bytes
+    :return: The size for people, e.g. "512 bytes", "1.2 MB"
+    """
+    if size < 1024:
+        return "{0} bytes".format(size)
+    if size < 1024 * 1024:
+        return "{0:.1f} KB".format(size / 1024)
+    return "{0:.1f} MB".format(size / (1024 * 1024))
+
+
+def page_count(contents, page_size=PAGE_SIZE):
+    return max(1, -(-len(contents) // page_size))
+
+
+def hex_page(contents, page, page_size=PAGE_SIZE):
+    """
+    A page of a hex dump, 16 bytes per line with offsets and printable characters
+    :param contents: memoryview of the contents
+    :param page: Page number from 0
+    :param page_size: Bytes per page
+    :return: Text of the page
+    """
+    start = page * page_size
+    # Only this page is copied out of the view
+    data = contents[start:start + page_size].tobytes()
+    lines = []
+    for i in range(0, len(data), _HEX_WIDTH):
+        chunk = data[i:i + _HEX_WIDTH]
+        printable = "".join(chr(b) if 32 <= b < 127 else "." for b in chunk)
+        lines.append("{0:08x}  {1:<{2}}  {3}".format(start + i, chunk.hex(" "), _HEX_WIDTH * 3 - 1, printable))
+    return "\n".join(lines)
+
+
+def text_page(contents, page, page_size=PAGE_SIZE):
+    """
+    A page of the contents decoded as text
+    :param contents: memoryview of the contents
+    :param page: Page number from 0
+    :param page_size: Bytes per page
+    :return: Text of the page, None if it is not text
+    """
+    start = page * page_size
+    data = contents[start:start + page_size].tobytes()
+    encodings = ["utf-8"]
+    # Text frames start with an encoding byte, then maybe a byte order mark
+    if data[:2] in _BOMS or data[1:3] in _BOMS:
+        # Only with a byte order mark, most binary data decodes as UTF-16
+        encodings.append("utf-16")
+    for encoding in encodings:
+        skip = 1 if encoding == "utf-16" and data[:2] not in _BOMS else 0
+        try:
+            text = data[skip:].decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        # A nul right after a printable character ends a string, as in most
+        # frames. Other nuls (e.g. zero filled data) are not text.
+        unprintable = sum(1 for c, prev in zip(text, "\x00" + text)
+                          if not (c.isprintable() or c in "\n\r\t" or (c == "\x00" and prev.isprintable())))
+        if unprintable < len(text) and unprintable <= max(1, len(text) // 32):
+            text = text.replace("\x00", "\n")
+            return "".join(c if c.isprintable() or c in "\n\r\t" else "." for c in text)
+    return None
+
+
+def file_frame_sizes(fn):
+    """
+    :param fn: mp3 file
+    :return: A dict of unsupported frame ID -> list of content sizes in bytes
+    """
+    sizes = {}
+    with open(fn, "rb") as f:
+        for frame_id, offset, size in tag_regions.frame_headers(f):
+            if not is_supported(frame_id):
+                sizes.setdefault(frame_id, []).append(size)
+    return sizes
+
+
+def stored_sizes(id3):
+    """
+    The sizes of the unsupported frames of loaded tags as stored in their
+    file, from the frame headers
+    :param id3: mutagen ID3 tags read from a file
+    :return: A dict of frame key -> size in bytes. Frames whose size is not
+    known are left out.
+    """
+    fn = getattr(id3, "filename", None)
+    if not fn:
+        return {}
+    try:
+        with io_scheduler.default().operation(0, io_scheduler.INTERACTIVE):
+            sizes = file_frame_sizes(fn)
+    except OSError:
+        return {}
+    keys = {}
+    for frame_id, frame_sizes in sizes.items():
+        # Both in file order. Frames merged, converted or deleted since the
+        # tags were read do not match up, their sizes are not known.
+        frames = id3.getall(frame_id)
+        if len(frames) == len(frame_sizes):
+            keys.update(zip((f.HashKey for f in frames), frame_sizes))
+    return keys
+
+
+def library_stats(root, workers=library_scan.DEFAULT_WORKERS):
+    """
+    Which unsupported frames take up the most space in a library
+    :param root: Directory to scan
+    :param workers: Number of worker threads
+    :return: A 2-tuple (stats, errors). stats is a list of dicts with the
+    frame id, files, frames, bytes and largest (bytes), most bytes first.
+    errors is a list of (path, error) 2-tuples.
+    """
+    totals = {}
+    errors = []
+    work = io_scheduler.default().throttled(file_frame_sizes)
+    for fn, sizes, error in library_scan.parallel_map(work, library_scan.scan_files(root), workers=workers):
+        if error:
+            errors.append((fn, error))
+            continue
+        for frame_id, frame_sizes in sizes.items():
+            total = totals.setdefault(frame_id, {"id": frame_id, "files": 0, "frames": 0, "bytes": 0, "largest": 0})
+            total["files"] += 1
+            total["frames"] += len(frame_sizes)
+            total["bytes"] += sum(frame_sizes)
+            total["largest"] = max(total["largest"], max(frame_sizes))
+    return sorted(totals.values(), key=lambda t: (-t["bytes"], t["id"])), errors
@@ -0,0 +1,128 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Window showing the contents of an unsupported frame one page at a time
+# (see frame_inspector). Only the page on screen is ever in the text widget.
+#
+
+import tkinter
+from tkinter import Text, Scrollbar, Button, Checkbutton, Frame, Label, BooleanVar
+from tkinter import font as tkfont
+import frame_inspector
+
+
+class FrameInspectorWindow(tkinter.Toplevel):
+    """
+    Independent top level window for looking inside a frame
+    """
+    def __init__(self, parent, x=0, y=0, close=None):
+        """
+        Create top level window for inspecting frames
+        :param parent: Parent widget
+        :param x: Where to position window
+        :param y: Where to position window
+        :param close: callback for window close event
+        """
+        super(FrameInspectorWindow, self).__init__(parent)
+        self.on_close = close
+        self.title("Frame Inspector")
+        f = tkfont.Font(self, font="TkFixedFont")
+        # Wide enough for a line of the hex dump
+        self.geometry(newGeometry="{0}x{1}+{2}+{3}".format(f.measure("0" * 80), 30 * f.metrics("linespace"), x, y))
+        self.resizable(width=True, height=True)
+        # Need to handle window close event to reset
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+
+        self._contents = None
+        self._page = 0
+
+        # widgets
+
+        self._summary = Label(self, anchor=tkinter.W, justify=tkinter.LEFT, wraplength=f.measure("0" * 78))
+        self._summary.grid(row=0, column=0, columnspan=2, sticky=tkinter.EW, padx=5, pady=5)
+
+        self._text_widget = Text(self, bd=0, font=f, wrap=tkinter.NONE)
+        self._text_widget.grid(row=1, column=0, sticky=tkinter.NSEW)
+        self._scrollbar = Scrollbar(self, command=self._text_widget.yview)
+        self._scrollbar.grid(row=1, column=1, sticky=tkinter.NSEW)
+        self._text_widget['yscrollcommand'] = self._scrollbar.set
+
+        buttons = Frame(self)
+        buttons.grid(row=2, column=0, columnspan=2, sticky=tkinter.EW, pady=5)
+        self._prev_button = Button(buttons, text="< Prev", width=6, command=lambda: self._turn(-1))
+        self._prev_button.grid(row=0, column=0, padx=5)
+        self._page_label = Label(buttons)
+        self._page_label.grid(row=0, column=1, padx=5)
+        self._next_button = Button(buttons, text="Next >", width=6, command=lambda: self._turn(1))
+        self._next_button.grid(row=0, column=2, padx=5)
+        self._hex = BooleanVar(value=False)
+        Checkbutton(buttons, text="Hex", variable=self._hex, command=self._render).grid(row=0, column=3, padx=5)
+
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(1, weight=1)
+
+    def show_frame(self, key, frame, size=None):
+        """
+        Show a frame's first page
+        :param key: The frame's key in the tags
+        :param frame: mutagen ID3 frame
+        :param size: The frame's size in bytes as stored, None if not known
+        :return: None
+        """
+        self._contents = frame_inspector.frame_contents(frame)
+        self._page = 0
+        # Keys of some frames hold their data, show only the start
+        if len(key) > 60:
+            key = key[:60] + "..."
+        self._summary.configure(text="{0}\n{1}".format(key, frame_inspector.frame_summary(frame, size)))
+        self._render()
+        self.show()
+
+    def _turn(self, pages):
+        self._page = min(max(0, self._page + pages), frame_inspector.page_count(self._contents) - 1)
+        self._render()
+
+    def _render(self):
+        if self._contents is None:
+            return
+        text = None
+        if not self._hex.get():
+            text = frame_inspector.text_page(self._contents, self._page)
+        if text is None:
+            text = frame_inspector.hex_page(self._contents, self._page)
+        self._text_widget.config(state=tkinter.NORMAL)
+        self._text_widget.delete("1.0", tkinter.END)
+        self._text_widget.insert(tkinter.END, text)
+        self._text_widget.config(state=tkinter.DISABLED)
+
+        pages = frame_inspector.page_count(self._contents)
+        self._page_label.configure(text="Page {0} of {1}".format(self._page + 1, pages))
+        self._prev_button.configure(state=tkinter.NORMAL if self._page > 0 else tkinter.DISABLED)
+        self._next_button.configure(state=tkinter.NORMAL if self._page < pages - 1 else tkinter.DISABLED)
+
+    def _on_close(self):
+        if self.on_close:
+            self.on_close()
+        self._contents = None
+        self.destroy()
+        return True
+
+    def show(self):
+        # Bring the window to the top and activate it, see TagHelpWindow
+        self.lift()
+        self.grab_set()
+        self.focus()
+        self.grab_release()
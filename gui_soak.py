@@ -0,0 +1,304 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Soak test of the editor's widgets. Drives the real ID3TagsWidget and
+# FileTreeView over a generated library of mp3 files for a number of
+# rounds. Each round loads the tags of every file (hovering over a tag
+# name so its tool tip opens), then rebuilds the file tree, opens every
+# directory and sorts it by each column.
+#
+# The first round warms up caches. After it, the Python heap, the number
+# of Python objects, Tk widgets, Tcl commands, Tcl variables and pending
+# after callbacks must not grow by more than a few per round, and each
+# kind of operation must stay under a latency bound. The exit status is 0
+# if every bound held, 1 if one did not and 2 if the test could not run.
+#
+# Without a display (DISPLAY not set) a virtual X server is started with
+# Xvfb, which must be installed.
+#
+#     python3 gui_soak.py --files 2000 --rounds 5
+#
+
+import argparse
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import mutagen.id3
+
+# A silent MPEG-1 layer III frame header, repeated as the "audio"
+_AUDIO = b"\xff\xfb\x90\x00" * 1000
+# Frames the tags widget does not edit, shown as unsupported
+_UNSUPPORTED = [
+    lambda i: mutagen.id3.PRIV(owner="soak", data=b"soak" * (i % 16)),
+    lambda i: mutagen.id3.TXXX(encoding=3, desc="soak{0}".format(i % 3), text="x"),
+]
+
+
+def make_library(root, files, wide):
+    """
+    Write a library of tagged mp3 files
+    :param root: Directory to create the library in
+    :param files: Number of files spread over Artist/Album directories
+    :param wide: Number of files in one extra directory, a large directory
+    :return: List of the file paths
+    """
+    paths = []
+    for i in range(files + wide):
+        if i < files:
+            d = os.path.join(root, "Artist {0}".format(i % 40), "Album {0}".format(i % 7))
+        else:
+            d = os.path.join(root, "Wide")
+        os.makedirs(d, exist_ok=True)
+        fn = os.path.join(d, "{0} track.mp3".format(i))
+        with open(fn, "wb") as f:
+            f.write(_AUDIO)
+        tags = mutagen.id3.ID3()
+        tags.add(mutagen.id3.TIT2(encoding=3, text="Song {0}".format(i)))
+        tags.add(mutagen.id3.TPE1(encoding=3, text="Artist {0}".format(i % 40)))
+        tags.add(mutagen.id3.TALB(encoding=3, text="Album {0}".format(i % 7)))
+        tags.add(mutagen.id3.TRCK(encoding=3, text=str(i % 20 + 1)))
+        tags.add(mutagen.id3.COMM(encoding=3, lang="eng", desc="", text="x" * (i % 200)))
+        # A varying number of rows, so the widget grows and shrinks
+        for make in _UNSUPPORTED[:i % (len(_UNSUPPORTED) + 1)]:
+            tags.add(make(i))
+        tags.save(fn)
+        paths.append(fn)
+    return paths
+
+
+def start_xvfb():
+    """
+    Start a virtual X server and point DISPLAY at it
+    :return: The server's Popen, None if it could not be started
+    """
+    if not shutil.which("Xvfb"):
+        return None
+    for number in range(99, 120):
+        if os.path.exists("/tmp/.X{0}-lock".format(number)):
+            continue
+        display = ":{0}".format(number)
+        server = subprocess.Popen(["Xvfb", display, "-screen", "0", "1600x1200x24", "-nolisten", "tcp"],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # The server is ready when its socket appears
+        for _ in range(50):
+            if os.path.exists("/tmp/.X11-unix/X{0}".format(number)):
+                os.environ["DISPLAY"] = display
+                return server
+            if server.poll() is not None:
+                break
+            time.sleep(0.1)
+        server.kill()
+        server.wait()
+    return None
+
+
+def widget_count(widget):
+    return 1 + sum(widget_count(child) for child in widget.winfo_children())
+
+
+def tcl_count(root, *command):
+    return len(root.tk.splitlist(root.tk.call(*command)))
+
+
+def measure(root):
+    """
+    :return: A dict of resource name -> amount in use, after a full collection
+    """
+    gc.collect()
+    return {
+        "python heap KiB": tracemalloc.get_traced_memory()[0] // 1024,
+        "python objects": len(gc.get_objects()),
+        "tk widgets": widget_count(root),
+        "tcl commands": tcl_count(root, "info", "commands"),
+        "tcl variables": tcl_count(root, "info", "globals"),
+        "after callbacks": tcl_count(root, "after", "info"),
+    }
+
+
+class Soak():
+    """
+    The widgets under test and the timings of the operations on them
+    """
+    def __init__(self, root, library):
+        import event_bus
+        from filetreeview import FileTreeView
+        from id3tags_widget import ID3TagsWidget
+
+        self._root = root
+        self._library = library
+        bus = event_bus.EventBus(root)
+        self.tree = FileTreeView(root, library, bus=bus)
+        self.tree.grid(row=0, column=0, sticky="nsew")
+        self.tags = ID3TagsWidget(root, text="Tags", width=600, bus=bus)
+        self.tags.grid(row=0, column=1, sticky="nsew")
+        # Operation -> list of durations in seconds
+        self.timings = {}
+
+    def _timed(self, name, func, *args):
+        start = time.perf_counter()
+        func(*args)
+        # Include the redraw the operation caused
+        self._root.update()
+        self.timings.setdefault(name, []).append(time.perf_counter() - start)
+
+    def load_files(self, paths):
+        import tag_records
+        for fn in paths:
+            self._timed("load_tags", self.tags.load_tags, tag_records.load_id3(fn))
+            # Open the tool tip of the first tag name
+            label = self.tags._tag_widgets[0][0] if self.tags._tag_widgets else None
+            if label is not None and label.winfo_ismapped():
+                label.event_generate("<Enter>")
+                label.event_generate("<Leave>")
+
+    def open_tree(self):
+        tree = self.tree
+        self._timed("set_path", tree.set_path, self._library)
+        # Open directories until there are none left to open
+        while tree._nodes:
+            for node in list(tree._nodes):
+                self._timed("open directory", tree._populate, node)
+
+    def sort_tree(self, column):
+        pending = tcl_count(self._root, "after", "info")
+        start = time.perf_counter()
+        self.tree.sort_by(column)
+        # Sorting is done when the polling for sorted orders stops
+        while tcl_count(self._root, "after", "info") > pending:
+            if time.perf_counter() - start > 60:
+                raise RuntimeError("Sorting by {0} did not finish".format(column))
+            self._root.update()
+            time.sleep(0.005)
+        self.timings.setdefault("sort", []).append(time.perf_counter() - start)
+
+    def round(self, paths):
+        from filetreeview import SORT_COLUMNS
+        self.load_files(paths)
+        self.open_tree()
+        for column in SORT_COLUMNS:
+            self.sort_tree(column)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(args):
+    """
+    :return: Exit status
+    """
+    import tkinter
+
+    work_dir = tempfile.mkdtemp(prefix="pyid3tag-soak-")
+    try:
+        library = os.path.join(work_dir, "library")
+        print("Writing {0} files...".format(args.files + args.wide))
+        paths = make_library(library, args.files, args.wide)
+
+        root = tkinter.Tk()
+        root.geometry("1400x900")
+        root.columnconfigure(0, weight=1)
+        root.rowconfigure(0, weight=1)
+        soak = Soak(root, library)
+        root.update()
+
+        tracemalloc.start()
+        failures = []
+        baseline = None
+        for n in range(args.rounds):
+            start = time.perf_counter()
+            soak.round(paths)
+            usage = measure(root)
+            print("Round {0} {1:.1f}s: {2}".format(n + 1, time.perf_counter() - start,
+                                                   ", ".join("{0} {1}".format(k, v) for k, v in usage.items())))
+            if baseline is None:
+                # The first round warms up
+                baseline = usage
+                soak.timings = {}
+
+        rounds = args.rounds - 1
+        if rounds:
+            limits = {
+                "python heap KiB": args.max_heap_growth,
+                "python objects": args.max_object_growth,
+                "tk widgets": 0,
+                "tcl commands": 0,
+                "tcl variables": 0,
+                "after callbacks": 0,
+            }
+            for name, limit in limits.items():
+                growth = usage[name] - baseline[name]
+                if growth > limit * rounds:
+                    failures.append("{0} grew by {1} in {2} rounds, at most {3} per round".format(
+                        name, growth, rounds, limit))
+
+        for name, durations in sorted(soak.timings.items()):
+            p95 = percentile(durations, 0.95) * 1000
+            worst = max(durations) * 1000
+            print("{0}: {1} times, 95% {2:.1f}ms, worst {3:.1f}ms".format(name, len(durations), p95, worst))
+            if p95 > args.max_latency:
+                failures.append("95% of {0} took up to {1:.1f}ms, at most {2}ms".format(
+                    name, p95, args.max_latency))
+
+        root.destroy()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for failure in failures:
+        print("FAILED:", failure)
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="gui_soak", description="Soak test of the editor's widgets")
+    parser.add_argument("--files", type=int, default=2000,
+                        help="Number of files in Artist/Album directories (default 2000)")
+    parser.add_argument("--wide", type=int, default=5000,
+                        help="Number of files in one large directory (default 5000)")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="Number of rounds, the first one warms up (default 5)")
+    parser.add_argument("--max-latency", type=float, default=250, metavar="MS",
+                        help="Bound on the 95th percentile time of each operation (default 250)")
+    parser.add_argument("--max-heap-growth", type=int, default=256, metavar="KIB",
+                        help="Bound on the Python heap growth per round (default 256)")
+    parser.add_argument("--max-object-growth", type=int, default=500, metavar="N",
+                        help="Bound on the growth of the number of Python objects per round (default 500)")
+    args = parser.parse_args()
+    if args.rounds < 2:
+        parser.error("--rounds must be at least 2")
+
+    server = None
+    if not os.environ.get("DISPLAY"):
+        server = start_xvfb()
+        if server is None:
+            print("There is no display and Xvfb could not be started", file=sys.stderr)
+            return 2
+    try:
+        return run(args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
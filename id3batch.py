@@ -0,0 +1,864 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Batch (command line) operations over a whole directory tree.
+#
+# Usage:
+#     python3 id3batch.py <command> [options] directory
+#
+
+# Python 3
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+import catalog_match
+import frame_inspector
+import id3frames
+import ingest
+import io_scheduler
+import library_scan
+import library_snapshot
+import snapshot_diff
+import tag_backup
+import tag_convert
+import tag_export
+import tag_formats
+import tag_lint
+import tag_query
+import tag_regions
+import tag_service
+import tag_vacuum
+import work_queue
+import write_journal
+
+
+def _process_files(args, files, work, journal=None, item_path=None, stop=None):
+    """
+    Run work over a set of files on the worker pool, printing each file
+    that changes.
+    :param args: Parsed command line (uses workers)
+    :param files: Iterable of file paths
+    :param work: Called as work(fn), returns a list of changes (empty for
+    no change) or None for a file that was not selected
+    :param journal: Optional WriteJournal, every processed file is recorded as done
+    :param item_path: Gets the file path from an item when the items are not paths
+    :param stop: Optional threading.Event, set to stop early
+    :return: A dict of counts (files, matched, changed, unchanged, failed)
+    """
+    counts = {"files": 0, "matched": 0, "changed": 0, "unchanged": 0, "failed": 0}
+    work = io_scheduler.default().throttled(work, path_of=item_path,
+                                            write=not getattr(args, "dry_run", False))
+    for item, changes, error in library_scan.parallel_map(work, files, workers=args.workers):
+        fn = item_path(item) if item_path else item
+        counts["files"] += 1
+        if error:
+            counts["failed"] += 1
+            print("{0}: ERROR {1}".format(fn, error))
+            continue
+        if changes is not None:
+            counts["matched"] += 1
+        if changes:
+            counts["changed"] += 1
+            print("{0}: {1}".format(fn, "; ".join(changes)))
+        elif changes is not None:
+            counts["unchanged"] += 1
+        if journal:
+            journal.complete(fn)
+        if stop and stop.is_set():
+            break
+    return counts
+
+
+def _print_summary(args, counts):
+    verb = "to change" if getattr(args, "dry_run", False) else "changed"
+    summary = "{0} files".format(counts.get("files", 0))
+    if counts.get("matched", 0) != counts.get("files", 0) - counts.get("failed", 0):
+        summary += ", {0} matched".format(counts.get("matched", 0))
+    print("{0}, {1} {2}, {3} unchanged, {4} failed".format(
+        summary, counts.get("changed", 0), verb, counts.get("unchanged", 0), counts.get("failed", 0)))
+
+
+def _run_batch(args, files, work, journal=None, item_path=None):
+    """
+    Process files (see _process_files) and print a summary at the end.
+    :return: Process exit code
+    """
+    counts = {}
+    try:
+        counts = _process_files(args, files, work, journal=journal, item_path=item_path)
+    except KeyboardInterrupt:
+        print("Interrupted. Files already started were finished.", file=sys.stderr)
+        if journal:
+            print("Rerun with --journal {0} to continue.".format(journal.path), file=sys.stderr)
+    finally:
+        if journal:
+            journal.close()
+
+    _print_summary(args, counts)
+    return 1 if counts.get("failed") else 0
+
+
+def _open_journal(args):
+    """
+    Open the journal named on the command line (if any) for a write job
+    :param args: Parsed command line
+    :return: A 2-tuple (journal or None, set of files completed by an earlier run)
+    """
+    if getattr(args, "dry_run", False) or not args.journal:
+        return None, set()
+    done = write_journal.completed_files(args.journal)
+    return write_journal.WriteJournal(args.journal), done
+
+
+def _convert_work(args, journal):
+    """
+    :return: The per file work function of the convert command
+    """
+    options = tag_convert.ConvertOptions(version=args.version, encoding=args.encoding,
+                                         strip_v1=args.strip_v1, strip_ape=args.strip_ape)
+    if args.dry_run:
+        return lambda fn: tag_convert.plan_conversion(fn, options)
+    return lambda fn: tag_convert.convert_file(fn, options, journal=journal)
+
+
+def _query_work(args, journal):
+    """
+    :return: The per file work function of the query command (updates only)
+    """
+    try:
+        query = tag_query.compile_query(args.query)
+    except tag_query.QueryError as ex:
+        raise ValueError("Query error: {0}".format(ex))
+    if not query.is_update:
+        raise ValueError("Only set ... queries can be run as a batch job")
+    return lambda fn: tag_query.update_file(fn, query, journal=journal, dry_run=args.dry_run)
+
+
+# Commands that can be split into shards and run by queue workers
+_SHARDABLE = {
+    "convert": _convert_work,
+    "query": _query_work,
+}
+
+
+def _file_filter(command):
+    """
+    :param command: Command name
+    :return: The filter for the files the command works on. The commands
+    that only change ID3 tags work on mp3 files, the others on every
+    format (see tag_formats).
+    """
+    if command in ("query", "match"):
+        return tag_formats.file_filter()
+    return library_scan.DEFAULT_FILTER
+
+
+def convert_command(args):
+    try:
+        _convert_work(args, None)
+    except ValueError as ex:
+        print(str(ex), file=sys.stderr)
+        return 2
+
+    journal, done = _open_journal(args)
+    files = (fn for fn in library_scan.scan_files(args.directory) if fn not in done)
+    return _run_batch(args, files, _convert_work(args, journal), journal=journal)
+
+
+def query_command(args):
+    try:
+        query = tag_query.compile_query(args.query)
+    except tag_query.QueryError as ex:
+        print("Query error: {0}".format(ex), file=sys.stderr)
+        return 2
+
+    files = library_scan.scan_files(args.directory, filter_regex=_file_filter(args.command))
+    if not query.is_update:
+        # A search just lists the matching files
+        matched = 0
+        work = io_scheduler.default().throttled(lambda fn: tag_query.match_file(fn, query))
+        for fn, is_match, error in library_scan.parallel_map(work, files, workers=args.workers):
+            if error:
+                print("{0}: ERROR {1}".format(fn, error), file=sys.stderr)
+            elif is_match:
+                matched += 1
+                print(fn)
+        print("{0} matched".format(matched), file=sys.stderr)
+        return 0
+
+    journal, done = _open_journal(args)
+    files = (fn for fn in files if fn not in done)
+    return _run_batch(args, files, _query_work(args, journal), journal=journal)
+
+
+def ingest_command(args):
+    try:
+        rules = ingest.load_rules(args.rules)
+    except (OSError, ValueError) as ex:
+        print("Rules error: {0}".format(ex), file=sys.stderr)
+        return 2
+
+    watcher = ingest.InboxWatcher(args.inbox)
+    work = lambda relpath: ingest.ingest_file(args.inbox, args.library, relpath, rules, dry_run=args.dry_run)
+    item_path = lambda relpath: os.path.join(args.inbox, relpath)
+    once = args.once or args.dry_run
+    totals = {}
+    try:
+        while True:
+            # Files are only taken once they have stopped changing between polls
+            ready = watcher.poll(wait_until_stable=not once)
+            for start in range(0, len(ready), args.batch_size):
+                counts = _process_files(args, ready[start:start + args.batch_size], work, item_path=item_path)
+                for k, v in counts.items():
+                    totals[k] = totals.get(k, 0) + v
+                if not once:
+                    print(time.strftime("%Y-%m-%d %H:%M:%S "), end="")
+                    _print_summary(args, counts)
+            if once:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("Stopped. Files already started were finished.", file=sys.stderr)
+
+    _print_summary(args, totals)
+    return 1 if totals.get("failed") else 0
+
+
+def match_command(args):
+    try:
+        index = catalog_match.CatalogIndex(catalog_match.load_catalog(args.catalog, table=args.table))
+    except (OSError, ValueError, sqlite3.Error) as ex:
+        print("Catalog error: {0}".format(ex), file=sys.stderr)
+        return 2
+    print("{0} catalog entries indexed".format(len(index)), file=sys.stderr)
+
+    def accepted():
+        # (path, values) of the files with an acceptable proposal
+        files = library_scan.scan_files(args.directory, filter_regex=_file_filter(args.command))
+        for fn, proposals, error in catalog_match.match_files(index, files, workers=args.processes):
+            if error:
+                print("{0}: ERROR {1}".format(fn, error), file=sys.stderr)
+                continue
+            proposal = catalog_match.accepted(proposals, min_confidence=args.min_confidence)
+            if proposal:
+                yield fn, proposal
+
+    if args.apply:
+        journal, done = _open_journal(args)
+        records = ((fn, sorted(p.values.items())) for fn, p in accepted() if fn not in done)
+        work = lambda record: tag_export.import_record(record, journal=journal, dry_run=args.dry_run)
+        return _run_batch(args, records, work, journal=journal, item_path=lambda record: record[0])
+
+    # Proposals are written as JSON Lines that import can apply after review
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for fn, proposal in accepted():
+            obj = {"path": os.path.relpath(fn, args.directory), "confidence": round(proposal.confidence, 3)}
+            obj.update(proposal.values)
+            out.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    except KeyboardInterrupt:
+        print("Interrupted. The proposals are incomplete.", file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def lint_command(args):
+    try:
+        options = tag_lint.LintOptions(rules=args.rules.split(",") if args.rules else None,
+                                       max_padding=args.max_padding, target_padding=args.target_padding)
+    except ValueError as ex:
+        print(str(ex), file=sys.stderr)
+        return 2
+
+    journal, done = _open_journal(args) if args.fix else (None, set())
+    if args.fix:
+        work = lambda fn: tag_lint.fix_file(fn, options, journal=journal, dry_run=args.dry_run)
+    else:
+        work = lambda fn: tag_lint.check_file(fn, options)
+    work = io_scheduler.default().throttled(work, write=args.fix and not args.dry_run)
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    files = (fn for fn in library_scan.scan_files(args.directory) if fn not in done)
+    counts = {"files": 0, "problems": 0, "fixed": 0, "failed": 0}
+    by_rule = {}
+    try:
+        for fn, findings, error in library_scan.parallel_map(work, files, workers=args.workers):
+            counts["files"] += 1
+            if error:
+                counts["failed"] += 1
+                print("{0}: ERROR {1}".format(fn, error), file=sys.stderr)
+                continue
+            for finding in findings:
+                counts["problems"] += 1
+                counts["fixed"] += finding.fixed
+                by_rule[finding.rule] = by_rule.get(finding.rule, 0) + 1
+                if args.format == "jsonl":
+                    out.write(json.dumps({"path": fn, "rule": finding.rule, "message": finding.message,
+                                          "fixable": finding.fixable, "fixed": finding.fixed},
+                                         ensure_ascii=False) + "\n")
+                else:
+                    if finding.fixed:
+                        status = " (to fix)" if args.dry_run else " (fixed)"
+                    else:
+                        status = " (fixable)" if finding.fixable else ""
+                    out.write("{0}: {1}: {2}{3}\n".format(fn, finding.rule, finding.message, status))
+            if journal:
+                journal.complete(fn)
+    except KeyboardInterrupt:
+        print("Interrupted. The report is incomplete.", file=sys.stderr)
+    finally:
+        if journal:
+            journal.close()
+        if out is not sys.stdout:
+            out.close()
+
+    verb = "to fix" if args.dry_run else "fixed"
+    print("{0} files, {1} problems, {2} {3}, {4} failed".format(
+        counts["files"], counts["problems"], counts["fixed"], verb, counts["failed"]), file=sys.stderr)
+    for rule, count in sorted(by_rule.items()):
+        print("  {0}: {1}".format(rule, count), file=sys.stderr)
+    return 1 if counts["problems"] > counts["fixed"] or counts["failed"] else 0
+
+
+def vacuum_command(args):
+    journal, done = _open_journal(args)
+    work = lambda fn: tag_vacuum.vacuum_file(fn, threshold=args.threshold, target=args.target,
+                                             journal=journal, dry_run=args.dry_run)
+    work = io_scheduler.default().throttled(work, write=not args.dry_run)
+    files = (fn for fn in library_scan.scan_files(args.directory) if fn not in done)
+    counts = {"files": 0, "vacuumed": 0, "failed": 0}
+    reclaimed = 0
+    try:
+        for fn, saved, error in library_scan.parallel_map(work, files, workers=args.workers):
+            counts["files"] += 1
+            if error:
+                counts["failed"] += 1
+                print("{0}: ERROR {1}".format(fn, error))
+                continue
+            if saved:
+                counts["vacuumed"] += 1
+                reclaimed += saved
+                print("{0}: {1:,} bytes".format(fn, saved))
+            if journal:
+                journal.complete(fn)
+    except KeyboardInterrupt:
+        print("Interrupted. Files already started were finished.", file=sys.stderr)
+    finally:
+        if journal:
+            journal.close()
+
+    print("{0} files, {1} {2}, {3:,} bytes {4}, {5} failed".format(
+        counts["files"], counts["vacuumed"], "to vacuum" if args.dry_run else "vacuumed",
+        reclaimed, "to reclaim" if args.dry_run else "reclaimed", counts["failed"]))
+    return 1 if counts["failed"] else 0
+
+
+def frames_command(args):
+    try:
+        stats, errors = frame_inspector.library_stats(args.directory, workers=args.workers)
+    except KeyboardInterrupt:
+        print("Interrupted.", file=sys.stderr)
+        return 1
+    for fn, error in errors:
+        print("{0}: ERROR {1}".format(fn, error), file=sys.stderr)
+    print("{0:<6} {1:>8} {2:>8} {3:>14} {4:>12}".format("Frame", "Files", "Frames", "Bytes", "Largest"))
+    for s in stats[:args.top]:
+        print("{0:<6} {1:>8,} {2:>8,} {3:>14,} {4:>12,}".format(s["id"], s["files"], s["frames"],
+                                                              s["bytes"], s["largest"]))
+    return 1 if errors else 0
+
+
+def backup_command(args):
+    if not os.path.isdir(args.directory):
+        print("{0} is not a directory".format(args.directory), file=sys.stderr)
+        return 2
+    counts = {"files": 0, "changed": 0, "unchanged": 0, "failed": 0}
+    with tag_backup.BackupStore(args.store) as store:
+        pack_size = os.path.getsize(os.path.join(args.store, tag_backup.PACK_NAME))
+        try:
+            for fn, status, error in store.backup(args.directory, workers=args.workers):
+                if fn is None:
+                    print("Snapshot {0}".format(status), file=sys.stderr)
+                    continue
+                counts["files"] += 1
+                counts[status] += 1
+                if error:
+                    print("{0}: ERROR {1}".format(fn, error))
+        except KeyboardInterrupt:
+            print("Interrupted. No snapshot was written.", file=sys.stderr)
+            return 1
+        added = os.path.getsize(os.path.join(args.store, tag_backup.PACK_NAME)) - pack_size
+    print("{0} files, {1} backed up, {2} unchanged, {3} failed, {4:,} bytes added".format(
+        counts["files"], counts["changed"], counts["unchanged"], counts["failed"], added))
+    return 1 if counts["failed"] else 0
+
+
+def restore_command(args):
+    with tag_backup.BackupStore(args.store) as store:
+        if args.list:
+            for name in store.snapshots():
+                print("{0}  {1}".format(name, store.read_snapshot(name)[0]))
+            return 0
+        name = args.snapshot or store.latest_snapshot()
+        if name not in store.snapshots():
+            print("No snapshot {0} in {1}".format(args.snapshot or "", args.store), file=sys.stderr)
+            return 2
+        root, entries = store.read_snapshot(name)
+        root = args.to or root
+        if args.path:
+            prefix = args.path.replace(os.sep, "/").strip("/")
+            entries = (e for e in entries if e["path"] == prefix or e["path"].startswith(prefix + "/"))
+        journal, done = _open_journal(args)
+        item_path = lambda entry: tag_backup.entry_path(root, entry)
+        entries = (e for e in entries if item_path(e) not in done)
+        work = lambda entry: store.restore_file(root, entry, journal=journal, dry_run=args.dry_run)
+        return _run_batch(args, entries, work, journal=journal, item_path=item_path)
+
+
+def _format_from(args, filename):
+    if args.format:
+        return args.format
+    return "jsonl" if filename and filename.endswith((".jsonl", ".json")) else "csv"
+
+
+def export_command(args):
+    fmt = _format_from(args, args.output)
+    frames = args.frames.upper().split(",") if args.frames else None
+    for k in frames or []:
+        if k not in id3frames.frame_keys():
+            print("Unknown frame {0}".format(k), file=sys.stderr)
+            return 2
+    if args.output:
+        out = open(args.output, "w", encoding="utf-8", newline="")
+    else:
+        out = sys.stdout
+    failed = 0
+    try:
+        for fn, error in tag_export.export_tags(args.directory, out, frames=frames, fmt=fmt,
+                                                workers=args.workers):
+            failed += 1
+            print("{0}: ERROR {1}".format(fn, error), file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Interrupted. The export is incomplete.", file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if failed else 0
+
+
+def import_command(args):
+    fmt = _format_from(args, args.input)
+    journal, done = _open_journal(args)
+    with open(args.input, "r", encoding="utf-8", newline="") as inp:
+        try:
+            records = (r for r in tag_export.read_records(inp, args.directory, fmt=fmt) if r[0] not in done)
+            work = lambda record: tag_export.import_record(record, journal=journal, dry_run=args.dry_run)
+            return _run_batch(args, records, work, journal=journal, item_path=lambda record: record[0])
+        except ValueError as ex:
+            print(str(ex), file=sys.stderr)
+            return 2
+
+
+def snapshot_command(args):
+    fmt = args.format or ("arrow" if args.output.endswith((".arrow", ".feather")) else "parquet")
+    failed = 0
+    try:
+        for fn, error in library_snapshot.write_snapshot(args.directory, args.output, fmt=fmt,
+                                                         batch_size=args.batch_size,
+                                                         workers=args.workers):
+            failed += 1
+            print("{0}: ERROR {1}".format(fn, error), file=sys.stderr)
+    except RuntimeError as ex:
+        print(str(ex), file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print("Interrupted. The snapshot is incomplete.", file=sys.stderr)
+        return 1
+    return 1 if failed else 0
+
+
+def diff_command(args):
+    if os.path.isdir(args.new):
+        differences = snapshot_diff.diff_tree(args.old, args.new, workers=args.workers)
+    else:
+        differences = (d + (None,) for d in snapshot_diff.diff_snapshots(args.old, args.new))
+    counts = {snapshot_diff.ADDED: 0, snapshot_diff.REMOVED: 0, snapshot_diff.CHANGED: 0}
+    failed = 0
+    try:
+        for path, status, changes, error in differences:
+            if error:
+                failed += 1
+                print("{0}: ERROR {1}".format(path, error), file=sys.stderr)
+                continue
+            counts[status] += 1
+            print("{0}: {1}; {2}".format(path, status, "; ".join(changes)))
+    except (RuntimeError, ValueError, OSError) as ex:
+        print(str(ex), file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print("Interrupted. The diff is incomplete.", file=sys.stderr)
+        return 1
+    print(", ".join("{0} {1}".format(n, status) for status, n in counts.items()) +
+          (", {0} failed".format(failed) if failed else ""), file=sys.stderr)
+    return 1 if failed else 0
+
+
+def serve_command(args):
+    token = os.environ.get("PYID3TAG_TOKEN") or tag_service.new_token()
+    print("Serving {0} on http://127.0.0.1:{1}/".format(args.directory, args.port), file=sys.stderr)
+    print("Token: {0}".format(token), file=sys.stderr)
+    try:
+        tag_service.serve(args.directory, token, port=args.port, workers=args.workers,
+                          cache_size=args.cache_size)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def queue_create_command(args):
+    if not args.job or args.job[0] not in _SHARDABLE:
+        print("The job must be one of: {0}".format(", ".join(sorted(_SHARDABLE))), file=sys.stderr)
+        return 2
+    # Check the job's arguments now rather than on every worker
+    job_args = _build_parser().parse_args(args.job + [args.directory])
+    try:
+        _SHARDABLE[job_args.command](job_args, None)
+    except ValueError as ex:
+        print(str(ex), file=sys.stderr)
+        return 2
+
+    # Workers may run in another directory or on another host
+    root = os.path.abspath(args.directory)
+    queue = work_queue.SQLiteWorkQueue(args.queue)
+    try:
+        count = queue.create_job(root, args.job,
+                                 work_queue.shard_directories(root, _file_filter(job_args.command)))
+    except ValueError as ex:
+        print(str(ex), file=sys.stderr)
+        return 2
+    finally:
+        queue.close()
+    print("{0} shards queued".format(count))
+    return 0
+
+
+def queue_work_command(args):
+    queue = work_queue.SQLiteWorkQueue(args.queue, lease_seconds=args.lease)
+    root, job = queue.job()
+    job_args = _build_parser().parse_args(job + [root])
+    job_args.workers = args.workers
+    journal = write_journal.WriteJournal(args.journal) if args.journal and not job_args.dry_run else None
+    work = _SHARDABLE[job_args.command](job_args, journal)
+    owner = args.owner or "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+    def process_shard(shard, lost):
+        if not os.path.isdir(shard.directory):
+            # e.g. storage not mounted here. Scanning it would find no files
+            # and the shard would be done without doing anything.
+            raise RuntimeError("Directory {0} not found".format(shard.directory))
+        files = library_scan.scan_files(shard.directory, filter_regex=_file_filter(job_args.command),
+                                        recursive=False)
+        counts = _process_files(job_args, files, work, journal=journal, stop=lost)
+        if lost.is_set():
+            raise RuntimeError("Lease lost")
+        return counts
+
+    try:
+        completed = work_queue.run_worker(queue, owner, process_shard)
+        print("{0} shards completed by {1}".format(completed, owner), file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Interrupted. The current shard was returned to the queue.", file=sys.stderr)
+    finally:
+        if journal:
+            journal.close()
+        queue.close()
+    return 0
+
+
+def queue_status_command(args):
+    queue = work_queue.SQLiteWorkQueue(args.queue)
+    try:
+        root, job = queue.job()
+        states, totals = queue.status()
+        failures = queue.failures()
+    finally:
+        queue.close()
+    print("Job: {0} {1}".format(" ".join(job), root))
+    print("Shards: " + ", ".join("{0} {1}".format(states.get(s, 0), s) for s in
+                                 (work_queue.PENDING, work_queue.LEASED, work_queue.DONE, work_queue.FAILED)))
+    _print_summary(argparse.Namespace(dry_run="--dry-run" in job), totals)
+    for directory, error in failures:
+        print("{0}: FAILED {1}".format(directory, error))
+    return 1 if failures else 0
+
+
+def rollback_command(args):
+    changed = write_journal.changed_files(args.journal)
+    blobs = write_journal.blob_offsets(args.journal)
+    work = lambda fn: write_journal.restore_file(args.journal, fn, changed[fn], blobs) or ["restored"]
+    return _run_batch(args, iter(changed), work)
+
+
+def _add_journal_argument(parser):
+    parser.add_argument("--journal", metavar="FILE",
+                        help="Journal of changed files. Rerunning with the same journal resumes "
+                             "an interrupted job and the journal can be used to roll it back.")
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog="id3batch",
+                                     description="Batch ID3 tag operations over a directory tree")
+    parser.add_argument("--max-bytes-per-sec", type=int, metavar="N",
+                        help="Limit the rate at which tag bytes are read and written")
+    parser.add_argument("--max-ops-per-sec", type=int, metavar="N",
+                        help="Limit the number of files processed per second")
+    parser.add_argument("--read-block", type=int, metavar="BYTES", default=tag_regions.read_block_size,
+                        help="Size of the first read of each file. Tags that fit are read in one request.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert",
+                                  help="Normalize ID3v2 version and text encoding")
+    convert.add_argument("directory", help="Root of the tree to convert")
+    convert.add_argument("--version", type=int, choices=(3, 4), default=4,
+                         help="ID3v2 version to write (default 4)")
+    convert.add_argument("--encoding", choices=sorted(tag_convert.ENCODINGS.keys()), default="utf16",
+                         help="Text encoding for text frames (default utf16)")
+    convert.add_argument("--strip-v1", action="store_true", help="Remove ID3v1 tags")
+    convert.add_argument("--strip-ape", action="store_true", help="Remove APEv2 tags")
+    convert.add_argument("--dry-run", action="store_true",
+                         help="Report what would change without writing anything")
+    _add_journal_argument(convert)
+    convert.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                         help="Number of worker threads")
+    convert.set_defaults(func=convert_command)
+
+    query = commands.add_parser("query",
+                                help="Find files with a query or update them with set ... where ...")
+    query.add_argument("query", help="Query text, e.g. \"set TCON=Jazz where TPE1 starts with 'Miles'\"")
+    query.add_argument("directory", help="Root of the tree to search")
+    query.add_argument("--dry-run", action="store_true",
+                       help="Report what would change without writing anything")
+    _add_journal_argument(query)
+    query.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                       help="Number of worker threads")
+    query.set_defaults(func=query_command)
+
+    export = commands.add_parser("export", help="Export tags as CSV or JSON Lines")
+    export.add_argument("directory", help="Root of the tree to export")
+    export.add_argument("-o", "--output", metavar="FILE", help="Output file (default stdout)")
+    export.add_argument("--format", choices=tag_export.FORMATS,
+                        help="Output format (default from the file extension, otherwise csv)")
+    export.add_argument("--frames", help="Comma separated frames to export (default all)")
+    export.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                        help="Number of worker threads")
+    export.set_defaults(func=export_command)
+
+    import_ = commands.add_parser("import", help="Apply tags from a CSV or JSON Lines export")
+    import_.add_argument("input", help="File written by export")
+    import_.add_argument("directory", help="Directory the exported paths are relative to")
+    import_.add_argument("--format", choices=tag_export.FORMATS,
+                         help="Input format (default from the file extension, otherwise csv)")
+    import_.add_argument("--dry-run", action="store_true",
+                         help="Report what would change without writing anything")
+    _add_journal_argument(import_)
+    import_.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                         help="Number of worker threads")
+    import_.set_defaults(func=import_command)
+
+    frames = commands.add_parser("frames", help="Show which unsupported frames take up the most space")
+    frames.add_argument("directory", help="Root of the tree to scan")
+    frames.add_argument("--top", type=int, default=20, help="Number of frame IDs shown (default 20)")
+    frames.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                        help="Number of worker threads")
+    frames.set_defaults(func=frames_command)
+
+    vacuum = commands.add_parser("vacuum", help="Reclaim unused padding in ID3v2 tags")
+    vacuum.add_argument("directory", help="Root of the tree to vacuum")
+    vacuum.add_argument("--threshold", type=int, default=tag_vacuum.DEFAULT_THRESHOLD,
+                        help="Padding in bytes above which a file is rewritten (default {0})".format(
+                            tag_vacuum.DEFAULT_THRESHOLD))
+    vacuum.add_argument("--target", type=int, default=tag_vacuum.DEFAULT_TARGET,
+                        help="Padding in bytes left in a rewritten file (default {0})".format(
+                            tag_vacuum.DEFAULT_TARGET))
+    vacuum.add_argument("--dry-run", action="store_true",
+                        help="Report what would be reclaimed without writing anything")
+    _add_journal_argument(vacuum)
+    vacuum.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                        help="Number of worker threads")
+    vacuum.set_defaults(func=vacuum_command)
+
+    backup = commands.add_parser("backup", help="Back up the tags (not the audio) of a tree")
+    backup.add_argument("store", help="Backup store directory, created if needed")
+    backup.add_argument("directory", help="Root of the tree to back up")
+    backup.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                        help="Number of worker threads")
+    backup.set_defaults(func=backup_command)
+
+    restore = commands.add_parser("restore", help="Put back the tags of a tree from a backup store")
+    restore.add_argument("store", help="Backup store directory")
+    restore.add_argument("--snapshot", metavar="NAME", help="Snapshot to restore (default the latest)")
+    restore.add_argument("--list", action="store_true", help="List the snapshots in the store")
+    restore.add_argument("--to", metavar="DIRECTORY",
+                         help="Root of the tree to restore (default the tree that was backed up)")
+    restore.add_argument("--path", help="Only restore this file or directory (relative to the root)")
+    restore.add_argument("--dry-run", action="store_true",
+                         help="Report the files that would be restored without writing anything")
+    _add_journal_argument(restore)
+    restore.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                         help="Number of worker threads")
+    restore.set_defaults(func=restore_command)
+
+    match = commands.add_parser("match", help="Fill in missing album, artist, track and year from a catalog")
+    match.add_argument("catalog", help="Catalog CSV file or SQLite database")
+    match.add_argument("directory", help="Root of the tree to match")
+    match.add_argument("--table", default="catalog", help="Table name in an SQLite catalog (default catalog)")
+    match.add_argument("--min-confidence", type=float, default=catalog_match.DEFAULT_MIN_CONFIDENCE,
+                       help="Lowest match score that is used (0 to 1, default {0})".format(
+                           catalog_match.DEFAULT_MIN_CONFIDENCE))
+    match.add_argument("-o", "--output", metavar="FILE",
+                       help="Write the proposals to a JSON Lines file for import (default stdout)")
+    match.add_argument("--apply", action="store_true", help="Write the proposals to the files")
+    match.add_argument("--dry-run", action="store_true",
+                       help="With --apply, report what would change without writing anything")
+    _add_journal_argument(match)
+    match.add_argument("--processes", type=int, help="Number of matching processes (default the number of CPUs)")
+    match.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                       help="Number of worker threads writing files")
+    match.set_defaults(func=match_command)
+
+    lint = commands.add_parser("lint", help="Check tags for problems and fix the mechanical ones")
+    lint.add_argument("directory", help="Root of the tree to check")
+    lint.add_argument("--rules", help="Comma separated rules to run (default all): {0}".format(
+        ", ".join(tag_lint.RULES.keys())))
+    lint.add_argument("--max-padding", type=int, default=tag_lint.DEFAULT_MAX_PADDING,
+                      help="Padding in bytes above which the padding rule reports a file")
+    lint.add_argument("--target-padding", type=int, default=tag_lint.DEFAULT_TARGET_PADDING,
+                      help="Padding in bytes left when too much padding is fixed")
+    lint.add_argument("--format", choices=("text", "jsonl"), default="text", help="Report format")
+    lint.add_argument("-o", "--output", metavar="FILE", help="Report file (default stdout)")
+    lint.add_argument("--fix", action="store_true", help="Fix the problems that can be fixed automatically")
+    lint.add_argument("--dry-run", action="store_true",
+                      help="With --fix, report what would be fixed without writing anything")
+    _add_journal_argument(lint)
+    lint.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                      help="Number of worker threads")
+    lint.set_defaults(func=lint_command)
+
+    snapshot = commands.add_parser("snapshot", help="Write a columnar (Parquet/Arrow) snapshot of a tree")
+    snapshot.add_argument("directory", help="Root of the tree to snapshot")
+    snapshot.add_argument("output", help="Snapshot file to write")
+    snapshot.add_argument("--format", choices=library_snapshot.FORMATS,
+                          help="Output format (default from the file extension, otherwise parquet)")
+    snapshot.add_argument("--batch-size", type=int, default=library_snapshot.DEFAULT_BATCH_SIZE,
+                          help="Rows per record batch")
+    snapshot.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                          help="Number of worker threads")
+    snapshot.set_defaults(func=snapshot_command)
+
+    diff = commands.add_parser("diff", help="List the files whose tags differ between two snapshots")
+    diff.add_argument("old", help="Earlier snapshot file")
+    diff.add_argument("new", help="Later snapshot file, or the directory the earlier one was taken of")
+    diff.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                      help="Number of worker threads (comparing with a directory)")
+    diff.set_defaults(func=diff_command)
+
+    ingest_ = commands.add_parser("ingest", help="Tag new files in an inbox by rules and move them into the library")
+    ingest_.add_argument("inbox", help="Directory new files arrive in")
+    ingest_.add_argument("library", help="Library directory the tagged files are moved to")
+    ingest_.add_argument("--rules", required=True, help="JSON rules file (see ingest.py)")
+    ingest_.add_argument("--interval", type=float, default=10,
+                         help="Seconds between looks at the inbox (default 10)")
+    ingest_.add_argument("--batch-size", type=int, default=1000,
+                         help="Maximum number of files processed together")
+    ingest_.add_argument("--once", action="store_true",
+                         help="Ingest the files in the inbox now and exit instead of watching it")
+    ingest_.add_argument("--dry-run", action="store_true",
+                         help="Report what would change without writing or moving anything (implies --once)")
+    ingest_.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                         help="Number of worker threads")
+    ingest_.set_defaults(func=ingest_command)
+
+    serve = commands.add_parser("serve", help="Run the tag service (JSON-RPC over loopback HTTP)")
+    serve.add_argument("directory", help="Root directory of the files served")
+    serve.add_argument("--port", type=int, default=tag_service.DEFAULT_PORT,
+                       help="TCP port (default {0})".format(tag_service.DEFAULT_PORT))
+    serve.add_argument("--cache-size", type=int, default=100000,
+                       help="Maximum number of files with parsed tags kept in memory")
+    serve.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                       help="Number of worker threads")
+    serve.set_defaults(func=serve_command)
+
+    queue_create = commands.add_parser("queue-create",
+                                       help="Split a convert or query job into a shared work queue")
+    queue_create.add_argument("queue", help="Queue database file")
+    queue_create.add_argument("directory", help="Root of the tree to process")
+    queue_create.add_argument("job", nargs=argparse.REMAINDER,
+                              help="The command and its options, e.g. convert --version 3")
+    queue_create.set_defaults(func=queue_create_command)
+
+    queue_work = commands.add_parser("queue-work", help="Work on a queued job until it is finished")
+    queue_work.add_argument("queue", help="Queue database file")
+    queue_work.add_argument("--owner", help="Worker name (default host:pid)")
+    queue_work.add_argument("--lease", type=int, default=work_queue.DEFAULT_LEASE_SECONDS,
+                            help="Seconds a shard stays leased without a heartbeat")
+    _add_journal_argument(queue_work)
+    queue_work.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                            help="Number of worker threads")
+    queue_work.set_defaults(func=queue_work_command)
+
+    queue_status = commands.add_parser("queue-status", help="Show the progress of a queued job")
+    queue_status.add_argument("queue", help="Queue database file")
+    queue_status.set_defaults(func=queue_status_command)
+
+    rollback = commands.add_parser("rollback",
+                                   help="Restore the original tags of every file in a journal")
+    rollback.add_argument("journal", help="Journal written by an earlier job")
+    rollback.add_argument("--workers", type=int, default=library_scan.DEFAULT_WORKERS,
+                          help="Number of worker threads")
+    rollback.set_defaults(func=rollback_command)
+
+    return parser
+
+
+def _print_io_stats():
+    stats = io_scheduler.default().stats()
+    seconds = stats["seconds"] or 1
+    print("I/O: {0:.1f} KiB/s, {1:.1f} files/s, queue depth up to {2}".format(
+        stats["bytes"] / seconds / 1024, stats["ops"] / seconds, stats["max_queue_depth"]),
+        file=sys.stderr)
+
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+    tag_regions.read_block_size = args.read_block
+    scheduler = io_scheduler.configure(bytes_per_sec=args.max_bytes_per_sec,
+                                       ops_per_sec=args.max_ops_per_sec)
+    try:
+        return args.func(args)
+    finally:
+        if scheduler.limited:
+            _print_io_stats()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,16 +23,31 @@
 #
 
 # Python 3
+import argparse
 import os.path
 import inspect
+import queue
+import threading
 from collections import OrderedDict
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, simpledialog
 from tkinter import Tk, Frame, Button, Label, LabelFrame, Entry, StringVar, Menu, PanedWindow
 from tkinter import ttk
 import tkinter
 import mutagen
 import mutagen.id3
+import catalog_match
+import event_bus
 import id3frames
+import io_scheduler
+import library_scan
+import session_state
+import tag_formats
+import tag_lint
+import tag_lock
+import tag_query
+import tag_records
+import tag_regions
+import ui_watchdog
 from filelist_widget import FileList
 from filetreeview import FileTreeView
 from id3tags_widget import ID3TagsWidget
@@ -58,8 +73,17 @@ class ID3EditorApp(Tk):
         self._filename = ""
         # The currently selected file (may not be open)
         self._selected_filename = ""
-        # TODO It would be nice to persist the last used path
-        self._mp3_dir = "./"
+        # Where the last session left off (see session_state)
+        self._session = session_state.load()
+        self._mp3_dir = self._session.get("mp3_dir", "./")
+        if not os.path.isdir(self._mp3_dir):
+            self._mp3_dir = "./"
+        # Set to stop a running find files query
+        self._find_stop = None
+        # Catalog for match proposals (see catalog_match)
+        self._catalog_index = None
+        # Events between the widgets and the app
+        self._bus = event_bus.EventBus(self)
 
         # ttk theme
         # s = ttk.Style()
@@ -92,11 +116,14 @@ class ID3EditorApp(Tk):
         # File menu
         self._file_menu = Menu(self._menu_bar, tearoff=0)
         self._file_menu.add_command(label="Open directory", command=self._open_directory_command)
+        self._file_menu.add_command(label="Find files", command=self._find_files_command)
         self._file_menu.add_command(label="Edit file", command=self._open_file_command,
                                     state=tkinter.DISABLED)
-        self._file_menu_edit_index = 1
+        self._file_menu_edit_index = 2
         self._file_menu.add_command(label="Save file", command=self._save_file_command, state=tkinter.DISABLED)
-        self._file_menu_save_index = 2
+        self._file_menu_save_index = 3
+        self._file_menu.add_command(label="Load catalog", command=self._load_catalog_command)
+        self._file_menu.add_command(label="Check files", command=self._check_files_command)
         self._file_menu.add_separator()
         self._file_menu.add_command(label="Quit", command=self._on_close)
         self._menu_bar.add_cascade(label="File", menu=self._file_menu)
@@ -124,7 +151,11 @@ class ID3EditorApp(Tk):
         self._filelist = FileTreeView(self._paned, ".",
                                       background=None,
                                       action=self._open_file,
-                                      select=self._select_file)
+                                      select=self._select_file,
+                                      bus=self._bus)
+        tree_state = self._session.get("tree")
+        if tree_state and os.path.isdir(tree_state.get("path", "")):
+            self._filelist.restore_session(tree_state)
 
         # Make the filetreeview resizable
         self._filelist.columnconfigure(0, weight=1)
@@ -138,10 +169,9 @@ class ID3EditorApp(Tk):
 
         # Tags widget
         self._tags_frame = ID3TagsWidget(self._rhframe, text="Tags", width=int(sw / 4) - 10,
-                                         height=10, borderwidth=2,
-                                         tag_changed=self._changed_tag,
-                                         tag_added=self._added_tag,
-                                         tag_deleted=self._deleted_tag)
+                                         height=10, borderwidth=2, bus=self._bus)
+        self._bus.subscribe((event_bus.TAG_CHANGED, event_bus.TAG_ADDED, event_bus.TAG_DELETED),
+                            self._on_tags_edited)
         self._tags_frame.grid(row=gr, column=0, sticky=tkinter.NSEW, padx=10)
 
         gr += 1
@@ -202,9 +232,11 @@ class ID3EditorApp(Tk):
         """
         if self._are_unsaved_changes():
             return False
+        session_state.update({"mp3_dir": self._mp3_dir, "tree": self._filelist.session_state()})
         self.destroy()
         return True
 
+    @ui_watchdog.instrumented
     def _save_file(self, fn):
         """
         Save the current tags into its file
@@ -212,10 +244,59 @@ class ID3EditorApp(Tk):
         :return: None
         """
         self._tags_frame.commit_tag_updates()
-        self.id3.save(fn)
+        scheduler = io_scheduler.default()
+        if not tag_formats.is_id3(fn):
+            if not self._save_record(fn):
+                self._status_bar.set("Tags not saved")
+                return
+            merged = []
+        else:
+            try:
+                with scheduler.operation(scheduler.estimate_bytes(fn), io_scheduler.INTERACTIVE):
+                    saved, merged = tag_lock.save_checked(fn, self.id3, self._loaded_tags)
+            except tag_lock.ConflictError as ex:
+                conflicts = "\n".join("{0}: yours {1!r}, on disk {2!r}".format(*c) for c in ex.conflicts)
+                if not messagebox.askyesno("Conflicting changes",
+                                           "The file was changed by another program since it was opened:\n\n" +
+                                           conflicts + "\n\nReplace these changes with yours?"):
+                    self._status_bar.set("Tags not saved")
+                    return
+                with scheduler.operation(scheduler.estimate_bytes(fn), io_scheduler.INTERACTIVE):
+                    saved, merged = tag_lock.save_checked(fn, self.id3, self._loaded_tags,
+                                                          resolve=tag_lock.RESOLVE_OURS)
+        if merged:
+            # Show the changes made by the other program too
+            self.id3 = saved
+            self._tags_frame.load_tags(self.id3)
+        self._tags_frame.tags_changed = False
         self._file_menu.entryconfigure(self._file_menu_save_index, state=tkinter.DISABLED)
-        self._status_bar.set("Tags saved to %s" % fn)
+        self._bus.publish(event_bus.FILE_SAVED, fn)
+        if merged:
+            self._status_bar.set("Tags saved to %s, merged with changes to %s" % (fn, ", ".join(merged)))
+        else:
+            self._status_bar.set("Tags saved to %s" % fn)
+
+    def _save_record(self, fn):
+        """
+        Save the current tags into a file that is not an mp3 file (see
+        tag_formats). Its tags are replaced, changes made by another program
+        since the file was opened are not merged.
+        :param fn: File where tags are to be saved
+        :return: False if the user chose not to replace changes made by another program
+        """
+        if tag_lock.stat_key(fn) != self._loaded_tags.key:
+            if not messagebox.askyesno("Conflicting changes",
+                                       "The file was changed by another program since it was opened.\n\n"
+                                       "Replace its tags with yours?"):
+                return False
+        scheduler = io_scheduler.default()
+        with scheduler.operation(scheduler.estimate_bytes(fn), io_scheduler.INTERACTIVE):
+            with tag_lock.locked(fn):
+                tag_formats.save_record(fn, tag_records.record_from_id3(self.id3))
+                self._loaded_tags = tag_lock.LoadedTags(tag_lock.stat_key(fn), self.id3)
+        return True
 
+    @ui_watchdog.instrumented
     def _open_file(self, fn):
         # If unsaved changes were not handled, abort opening file
         if self._are_unsaved_changes():
@@ -226,14 +307,25 @@ class ID3EditorApp(Tk):
         self.title("ID3 Tag Editor: " + fn)
         # Remember where the tags came from
         self._filename = fn
-        # TODO It would be nice to persist the last used path
         self._mp3_dir = os.path.dirname(fn)
 
         # Load tags from file
         try:
             # self.mp3 = mutagen.mp3.MP3(fn)
-            self.id3 = mutagen.id3.ID3(fn)
+            # Background scans wait while the file is read
+            scheduler = io_scheduler.default()
+            with scheduler.operation(scheduler.estimate_bytes(fn), io_scheduler.INTERACTIVE):
+                # Taken first, a change while the tags are read is seen when they are saved
+                key = tag_lock.stat_key(fn)
+                tag_format = tag_formats.format_for(fn)
+                if tag_format is None:
+                    self.id3 = tag_records.parse_id3(fn)
+                else:
+                    # Edited as ID3 frames, saved in the file's own format (see _save_record)
+                    self.id3 = tag_formats.id3_from_record(tag_format.read_record(fn))
+            self._loaded_tags = tag_lock.LoadedTags(key, self.id3)
             self._tags_frame.load_tags(self.id3)
+            self._show_proposals(fn)
             self._status_bar.set(fn)
             self._tags_frame.tags_changed = False
             self._file_menu.entryconfigure(self._file_menu_save_index, state=tkinter.DISABLED)
@@ -241,10 +333,59 @@ class ID3EditorApp(Tk):
             # messagebox.showerror("No Header Error", str(ex))
             self._status_bar.set(str(ex))
             self.id3 = mutagen.id3.ID3()
+            self._loaded_tags = tag_lock.LoadedTags(key, self.id3)
             self._tags_frame.load_tags(self.id3)
+            self._show_proposals(fn)
         except Exception as err:
             messagebox.showerror("Exception", str(err))
 
+    def _show_proposals(self, fn):
+        """
+        Show the catalog entries that match the open file, if a catalog is loaded
+        :param fn: The open file
+        :return: None
+        """
+        proposals = []
+        if self._catalog_index:
+            proposals = self._catalog_index.propose(tag_records.record_from_id3(self.id3), fn)
+        self._tags_frame.show_proposals(proposals)
+
+    def _load_catalog_command(self):
+        """
+        Load a catalog to match opened files against. The index is built
+        on a background thread.
+        :return: None
+        """
+        path = filedialog.askopenfilename(initialdir=self._mp3_dir, title="Select catalog",
+                                          filetypes=[("Catalog", "*.csv *.db *.sqlite *.sqlite3"),
+                                                     ("All files", "*")])
+        if not path:
+            return
+        self._status_bar.set("Loading catalog...")
+        result = queue.Queue()
+
+        def build():
+            try:
+                result.put(catalog_match.CatalogIndex(catalog_match.load_catalog(path)))
+            except Exception as ex:
+                result.put(ex)
+
+        threading.Thread(target=build, daemon=True).start()
+        self.after(100, self._poll_catalog, result)
+
+    def _poll_catalog(self, result):
+        try:
+            index = result.get_nowait()
+        except queue.Empty:
+            self.after(100, self._poll_catalog, result)
+            return
+        if isinstance(index, Exception):
+            self._status_bar.set("")
+            messagebox.showerror("Catalog error", str(index))
+            return
+        self._catalog_index = index
+        self._status_bar.set("{0} catalog entries loaded".format(len(index)))
+
     def _select_file(self, fn):
         """
         A file has been selected.
@@ -266,25 +407,147 @@ class ID3EditorApp(Tk):
     def _open_directory_command(self):
         directory = filedialog.askdirectory(initialdir=self._mp3_dir, title="Select directory")
         if directory:
+            self._stop_find_files()
             self._filelist.set_path(directory)
             # Since nothing is selected, disable the open file menu item
             self._file_menu.entryconfigure(self._file_menu_edit_index, state=tkinter.DISABLED)
 
+    def _find_files_command(self):
+        """
+        Show the files under the current directory that match a query.
+        The scan runs on a background thread and matches are added to the
+        file list as they are found.
+        :return: None
+        """
+        text = simpledialog.askstring("Find files", "Query (e.g. TPE1 starts with 'Miles')", parent=self)
+        if not text:
+            return
+        try:
+            query = tag_query.compile_query(text)
+        except tag_query.QueryError as ex:
+            messagebox.showerror("Query error", str(ex))
+            return
+
+        self._stop_find_files()
+        self._filelist.show_results("Query: " + text)
+        self._file_menu.entryconfigure(self._file_menu_edit_index, state=tkinter.DISABLED)
+        self._status_bar.set("Searching...")
+
+        self._find_stop = threading.Event()
+        results = queue.Queue()
+        threading.Thread(target=self._find_files, args=(self._filelist.path, query, results, self._find_stop),
+                         daemon=True).start()
+        self.after(100, self._poll_find_results, results, self._find_stop, 0)
+
+    def _find_files(self, root, query, results, stop):
+        """
+        Background thread. Puts matching file paths on the results queue,
+        then None when the scan is finished.
+        """
+        work = io_scheduler.default().throttled(lambda fn: tag_query.match_file(fn, query))
+        files = library_scan.scan_files(root, filter_regex=tag_formats.file_filter())
+        try:
+            for fn, is_match, error in library_scan.parallel_map(work, files):
+                if stop.is_set():
+                    break
+                if is_match:
+                    results.put(fn)
+        finally:
+            results.put(None)
+
+    def _poll_find_results(self, results, stop, count, add_result=None, found="files matched"):
+        """
+        Move results from a background scan into the file list
+        :param results: Queue of results, None when the scan is finished
+        :param stop: The scan's stop event, set when it is abandoned
+        :param count: Number of results so far
+        :param add_result: Called with each result, default FileTreeView.add_result
+        :param found: Description of the results for the status bar
+        :return: None
+        """
+        if stop.is_set():
+            return
+        add_result = add_result or self._filelist.add_result
+        finished = False
+        # Limit the work per call so the UI stays responsive
+        for i in range(500):
+            try:
+                result = results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                finished = True
+                break
+            add_result(result)
+            count += 1
+        if finished:
+            self._status_bar.set("{0} {1}".format(count, found))
+        else:
+            status = "Searching... {0} {1}".format(count, found)
+            scheduler = io_scheduler.default()
+            if scheduler.limited:
+                stats = scheduler.stats()
+                status += " ({0:.0f} KiB/s, {1:.0f} files/s, {2} waiting)".format(
+                    stats["bytes_per_sec"] / 1024, stats["ops_per_sec"], stats["queue_depth"])
+            self._status_bar.set(status)
+            self.after(100, self._poll_find_results, results, stop, count, add_result, found)
+
+    def _check_files_command(self):
+        """
+        Check the files under the current directory for tag problems (see
+        tag_lint). Files with problems are listed with their problems.
+        :return: None
+        """
+        self._stop_find_files()
+        self._filelist.show_results("Problems")
+        self._file_menu.entryconfigure(self._file_menu_edit_index, state=tkinter.DISABLED)
+        self._status_bar.set("Checking...")
+
+        self._find_stop = threading.Event()
+        results = queue.Queue()
+        threading.Thread(target=self._check_files, args=(self._filelist.path, results, self._find_stop),
+                         daemon=True).start()
+        self.after(100, self._poll_find_results, results, self._find_stop, 0,
+                   lambda result: self._filelist.add_problems(*result), "files with problems")
+
+    def _check_files(self, root, results, stop):
+        """
+        Background thread. Puts (file path, messages) of files with problems
+        on the results queue, then None when the scan is finished.
+        """
+        options = tag_lint.LintOptions()
+        work = io_scheduler.default().throttled(lambda fn: tag_lint.check_file(fn, options))
+        try:
+            for fn, findings, error in library_scan.parallel_map(work, library_scan.scan_files(root)):
+                if stop.is_set():
+                    break
+                if error:
+                    results.put((fn, [str(error)]))
+                elif findings:
+                    results.put((fn, ["{0}: {1}".format(f.rule, f.message) for f in findings]))
+        finally:
+            results.put(None)
+
+    def _stop_find_files(self):
+        if self._find_stop:
+            self._find_stop.set()
+            self._find_stop = None
+
     def _open_file_command(self):
         self._open_file(self._selected_filename)
 
     def _save_file_command(self):
         self._save_file(self._filename)
 
-    def _changed_tag(self, tag_name, tag_value):
-        self._file_menu.entryconfigure(self._file_menu_save_index, state=tkinter.NORMAL)
-        # TODO How to pass changed_tag event to filelist widget?
-
-    def _added_tag(self, tag_name):
-        self._file_menu.entryconfigure(self._file_menu_save_index, state=tkinter.NORMAL)
-
-    def _deleted_tag(self, tag_name):
+    def _on_tags_edited(self, events):
+        """
+        Tags of the open file were changed, added or deleted
+        :param events: The edits since the last delivery (see event_bus)
+        :return: None
+        """
         self._file_menu.entryconfigure(self._file_menu_save_index, state=tkinter.NORMAL)
+        # The file list marks the file
+        self._bus.publish(event_bus.FILE_DIRTY, self._filename)
 
     def _are_unsaved_changes(self):
         """
@@ -295,10 +558,29 @@ class ID3EditorApp(Tk):
         if self._tags_frame.tags_changed:
             # askyesno returns True if YES was chosen.
             # Discard changes means there are no changes to save, so we return False
-            return not messagebox.askyesno("Unsaved changes", "Discard changes?")
+            if not messagebox.askyesno("Unsaved changes", "Discard changes?"):
+                return True
+            self._bus.publish(event_bus.FILE_REVERTED, self._filename)
         return False
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="id3tag", description="ID3 Tag Editor")
+    parser.add_argument("--max-bytes-per-sec", type=int, metavar="N",
+                        help="Limit the rate at which background scans read tags")
+    parser.add_argument("--max-ops-per-sec", type=int, metavar="N",
+                        help="Limit the number of files background scans read per second")
+    parser.add_argument("--read-block", type=int, metavar="BYTES", default=tag_regions.read_block_size,
+                        help="Size of the first read of each file. Tags that fit are read in one request.")
+    parser.add_argument("--stall-threshold", type=int, metavar="MS", default=ui_watchdog.DEFAULT_THRESHOLD_MS,
+                        help="Log UI stalls longer than this to {0} (0 to not watch for stalls)".format(
+                            ui_watchdog.DEFAULT_LOG_FILE))
+    # Unknown arguments are ignored, app bundles may pass their own
+    args = parser.parse_known_args()[0]
+    io_scheduler.configure(bytes_per_sec=args.max_bytes_per_sec, ops_per_sec=args.max_ops_per_sec)
+    tag_regions.read_block_size = args.read_block
+
     main_frame = ID3EditorApp()
+    if args.stall_threshold > 0:
+        ui_watchdog.start(main_frame, threshold_ms=args.stall_threshold)
     main_frame.mainloop()
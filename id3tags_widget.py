@@ -15,19 +15,33 @@
 # along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import io
 from collections import OrderedDict
 from tkinter import filedialog, messagebox
 from tkinter import Tk, Frame, Button, Label, LabelFrame, Entry, StringVar, OptionMenu, \
     simpledialog
 import tkinter
+import PIL.Image
+import PIL.ImageTk
+import event_bus
+import frame_inspector
 import id3frames
+import ui_watchdog
 from tool_tip_popup import ToolTipPopup
 from tag_help_window import TagHelpWindow
+from frame_inspector_window import FrameInspectorWindow
+
+# Largest size of a picture shown in a tag's tool tip, in px
+THUMBNAIL_SIZE = (160, 160)
+# Typing pause after which tag edits are published, in ms
+TAG_CHANGED_DELAY = 300
 
 
 class ID3TagsWidget(LabelFrame):
-    def __init__(self, parent, text="", width=100, height=10, borderwidth=0,
-                 tag_changed=None, tag_added=None, tag_deleted=None):
+    def __init__(self, parent, text="", width=100, height=10, borderwidth=0, bus=None):
+        """
+        :param bus: EventBus that tag edits are published on (see event_bus)
+        """
         super(ID3TagsWidget, self).__init__(parent, text=text, width=width, height=height,
                                             borderwidth=borderwidth)
 
@@ -35,10 +49,14 @@ class ID3TagsWidget(LabelFrame):
         self.highlight_color = "#e0e0e0"
         self.id3 = None
         self._tags_changed = False
-        self._tag_changed_callback = tag_changed
-        self._tag_added_callback = tag_added
-        self._tag_deleted_callback = tag_deleted
+        self._bus = bus
+        # Tags edited since the last pause in typing, and the after() id of their publishing
+        self._changed_tags = []
+        self._changed_after = None
         self._tag_help_window = None
+        self._inspector_window = None
+        # Stored sizes of the unsupported frames (see frame_inspector.stored_sizes)
+        self._frame_sizes = {}
 
         # Each list item is a 2-tuple of tag label and tag text widget
         self._tag_widgets = []
@@ -80,6 +98,11 @@ class ID3TagsWidget(LabelFrame):
         self._tags_frame.columnconfigure(0, weight=1)
         # self._tags_frame.columnconfigure(1, weight=4)
 
+        # Catalog match proposals, one button per proposal
+        self._proposals_frame = Frame(self, width=width - 20)
+        self._proposals_frame.grid(row=2, column=0, sticky=tkinter.E + tkinter.W, padx=10, pady=5)
+        self._proposal_widgets = []
+
         self.columnconfigure(0, weight=1)
 
     @property
@@ -102,9 +125,7 @@ class ID3TagsWidget(LabelFrame):
         self._tags_changed = True
         # Reload all of the tags so they are sorted
         self.load_tags(self.id3)
-
-        if self._tag_added_callback:
-            self._tag_added_callback(tag)
+        self._publish(event_bus.TAG_ADDED, tag)
 
     def _get_comm_tag_parms(self):
         """
@@ -125,10 +146,17 @@ class ID3TagsWidget(LabelFrame):
                 valid = True
         return comm_parms
 
+    @ui_watchdog.instrumented
     def load_tags(self, id3):
         self.id3 = id3
+        # Edits to the previous tags are no longer news
+        self._cancel_changed()
         # Delete existing tags
         for t in self._tag_widgets:
+            t[0].tooltip.close()
+            # The tool tip refers back to the label, without this the label
+            # and its StringVar would wait for the garbage collector
+            t[0].tooltip = None
             t[0].destroy()
             t[1].destroy()
 
@@ -140,6 +168,10 @@ class ID3TagsWidget(LabelFrame):
 
         # Sort tags
         sorted_tags = OrderedDict(sorted(id3.items()))
+        # Only the frame headers are read, most files have no unsupported frames
+        self._frame_sizes = {}
+        if not all(frame_inspector.is_supported(tag) for tag in sorted_tags):
+            self._frame_sizes = frame_inspector.stored_sizes(id3)
 
         for tag in sorted_tags:
             # Tags we don't support or handle
@@ -182,17 +214,20 @@ class ID3TagsWidget(LabelFrame):
         gr = len(self._tag_widgets)
 
         # Tag name widget
+        key = tag
         # Some unsupported tags can be very long
         if len(tag) > 30:
             tag = tag[:4] + "[length={0}]".format(len(tag))
-        tw = self._add_tag_name_label(gr, tag)
+        tw = self._add_tag_name_label(gr, tag, key=key)
 
-        # Place holder tag value widget
-        v = StringVar(value="Unsupported")
+        # Summary of the frame, clicked to look inside it
+        summary = frame_inspector.frame_summary(self.id3[key], self._frame_sizes.get(key))
+        v = StringVar(value=summary)
         w = max(30, len(v.get()))
-        tvw = Label(self._tags_frame, textvariable=v, width=w, anchor=tkinter.W)
+        tvw = Label(self._tags_frame, textvariable=v, width=w, anchor=tkinter.W, cursor="hand2")
         tvw.value_var = v
         tvw.grid(row=gr, column=1, sticky=tkinter.W)
+        tvw.bind("<Button-1>", lambda event: self.inspect_frame(key))
 
         tvw.tooltip = id3frames.frame_tooltip(tag)
         tvw.label_widget = tw
@@ -204,21 +239,92 @@ class ID3TagsWidget(LabelFrame):
 
         self._tag_widgets.append((tw, tvw))
 
-    def _add_tag_name_label(self, gr, tag):
+    def _add_tag_name_label(self, gr, tag, key=None):
+        """
+        :param tag: Tag name shown
+        :param key: The frame's key in the tags, default tag
+        """
         # Tag name widget
         v = StringVar(value=tag)
         tw = Label(self._tags_frame, textvariable=v)
         tw.value_var = v
         tw.grid(row=gr, column=0, sticky=tkinter.E)
 
-        tw.tooltip = ToolTipPopup(tw, id3frames.frame_tooltip(tag[:4]))
+        key = key or tag
+        tw.tooltip = ToolTipPopup(tw, id3frames.frame_tooltip(tag[:4]),
+                                  preview=lambda: self._tag_preview(key))
 
         return tw
 
+    def _tag_preview(self, key):
+        """
+        Render the tool tip of a tag name. Comments are shown in full and
+        pictures as a thumbnail.
+        :param key: The frame's key in the tags
+        :return: A 2-tuple (text, PhotoImage or None), see ToolTipPopup
+        """
+        text = id3frames.frame_tooltip(key[:4])
+        frame = self.id3.get(key) if self.id3 is not None else None
+        if frame is None:
+            return text, None
+        if key.startswith("COMM"):
+            comments = list(frame.text)
+            # The text being edited, it reaches the tags when the entry loses focus
+            for t in self._tag_widgets:
+                if t[1].tag_name == key and comments:
+                    comments[0] = t[1].value_var.get()
+            return "{0}\n\n{1}".format(text, "\n".join(comments)), None
+        if key.startswith("APIC"):
+            text = "{0}\n{1}, {2} KB".format(text, frame.mime, len(frame.data) // 1024)
+            try:
+                image = PIL.Image.open(io.BytesIO(frame.data))
+                image.thumbnail(THUMBNAIL_SIZE)
+                return text, PIL.ImageTk.PhotoImage(image, master=self)
+            except (OSError, ValueError, PIL.Image.DecompressionBombError):
+                # Not an image Pillow can read, or too large to
+                return text, None
+        return text, None
+
     def _add_tag(self):
         t = self._add_this_tag.get()
         self.add_tag(t)
 
+    def show_proposals(self, proposals):
+        """
+        Show catalog match proposals (see catalog_match), best first.
+        Clicking one adds its frames to the tags.
+        :param proposals: List of catalog_match.Proposal, empty to clear
+        :return: None
+        """
+        for w in self._proposal_widgets:
+            w.destroy()
+        self._proposal_widgets = []
+        if not proposals:
+            return
+
+        label = Label(self._proposals_frame, text="Catalog matches:")
+        label.grid(row=0, column=0, sticky=tkinter.W)
+        self._proposal_widgets.append(label)
+        for i, proposal in enumerate(proposals):
+            entry = proposal.entry
+            text = "{0:.0%}  {1} - {2} ({3})".format(
+                proposal.confidence, entry.get("TPE1", "?"), entry.get("TALB", "?"),
+                ", ".join("{0}={1}".format(k, v) for k, v in proposal.values.items()))
+            b = Button(self._proposals_frame, text=text, anchor=tkinter.W,
+                       command=lambda p=proposal: self._apply_proposal(p))
+            b.grid(row=i + 1, column=0, sticky=tkinter.E + tkinter.W)
+            self._proposal_widgets.append(b)
+
+    def _apply_proposal(self, proposal):
+        for key, value in proposal.values.items():
+            # Only frames that are still missing, the user may have added some
+            if not self.id3.getall(key):
+                self.id3.add(id3frames.create(key, value))
+                self._tags_changed = True
+                self._publish(event_bus.TAG_ADDED, key)
+        self.load_tags(self.id3)
+        self.show_proposals([])
+
     def show_tag_help(self):
         if not self._tag_help_window:
             # Position the help window to the right of the main window
@@ -231,6 +337,24 @@ class ID3TagsWidget(LabelFrame):
         else:
             self._tag_help_window.show()
 
+    def inspect_frame(self, key):
+        """
+        Show the contents of a frame in the inspector window
+        :param key: The frame's key in the tags
+        :return: None
+        """
+        if not self._inspector_window:
+            top = self.winfo_toplevel()
+            self._inspector_window = FrameInspectorWindow(self,
+                                                          x=top.winfo_rootx() + top.winfo_width() + 1,
+                                                          y=top.winfo_rooty(),
+                                                          close=self._on_inspector_close)
+        self._inspector_window.show_frame(key, self.id3[key], size=self._frame_sizes.get(key))
+
+    def _on_inspector_close(self):
+        self._inspector_window = None
+        return True
+
     def _on_tag_help_close(self):
         """
         The help window was closed.
@@ -246,8 +370,11 @@ class ID3TagsWidget(LabelFrame):
         # Need to update tags list
         self.load_tags(self.id3)
         self.tags_changed = True
-        if self._tag_deleted_callback:
-            self._tag_deleted_callback(tag_name)
+        self._publish(event_bus.TAG_DELETED, tag_name)
+
+    def _publish(self, kind, tag_name):
+        if self._bus:
+            self._bus.publish(kind, tag_name)
 
     def _on_enter_tag(self, event):
         pass
@@ -279,6 +406,8 @@ class ID3TagsWidget(LabelFrame):
             self._update_tag(tag_name, tag_value)
 
         self._tags_changed = False
+        # Saved, a pause in typing after this must not mark the file changed again
+        self._cancel_changed()
 
     def _update_tag(self, name, value):
         f = id3frames.create(name, value)
@@ -306,8 +435,24 @@ class ID3TagsWidget(LabelFrame):
         # print("Tag changed event: <{0}><{1}><{2}>".format(action_code, reason, name))
         if reason == 'key' and action_code in ['0', '1']:
             self._tags_changed = True
-            changed_tag = changed[0].value_var.get()
-            new_value = changed[1].value_var.get()
-            if self._tag_changed_callback:
-                self._tag_changed_callback(changed_tag, new_value)
+            # Published once typing pauses, each key restarts the wait
+            tag_name = changed[0].value_var.get()
+            if tag_name not in self._changed_tags:
+                self._changed_tags.append(tag_name)
+            if self._changed_after is not None:
+                self.after_cancel(self._changed_after)
+            self._changed_after = self.after(TAG_CHANGED_DELAY, self._publish_changed)
         return True
+
+    def _publish_changed(self):
+        self._changed_after = None
+        changed_tags = self._changed_tags
+        self._changed_tags = []
+        for tag_name in changed_tags:
+            self._publish(event_bus.TAG_CHANGED, tag_name)
+
+    def _cancel_changed(self):
+        if self._changed_after is not None:
+            self.after_cancel(self._changed_after)
+            self._changed_after = None
+        self._changed_tags = []
@@ -0,0 +1,260 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Ingest of new files from an inbox directory: tag them by rules and move
+# them into the library.
+#
+# The rules are a JSON file:
+#     {
+#         "rules": [
+#             {"match": "(?P<TPE1>[^/]+)/(?P<TALB>[^/]+)/(?P<TRCK>\\d+) (?P<TIT2>.+)\\.mp3$"},
+#             {"match": "^Jazz/", "set": {"TCON": "Jazz"}}
+#         ],
+#         "catalog": "catalog.csv",
+#         "destination": "{TPE1}/{TALB}/{filename}",
+#         "overwrite": false
+#     }
+#
+# Each rule's regex is searched for in the file's path relative to the inbox
+# (with / separators). The named groups of a match and the rule's "set"
+# values are frame values. The optional catalog is an export (see
+# tag_export) whose records are matched by path, or else by file name, and
+# win over the rules. Only frames a file does not have are set unless
+# "overwrite" is true. The file is then moved to the destination, a path
+# in the library made from the file's tags and its file name.
+#
+
+import json
+import os
+import re
+import shutil
+import id3frames
+import library_scan
+import tag_export
+import tag_lock
+import tag_records
+
+DEFAULT_DESTINATION = "{TPE1}/{TALB}/{filename}"
+
+# Used in destination paths for frames a file does not have
+UNKNOWN = "Unknown"
+
+# Characters that are not allowed in file names on some platforms
+_UNSAFE_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+
+class IngestRules():
+    """
+    How incoming files are tagged and where they go
+    """
+    def __init__(self, rules, catalog=None, destination=DEFAULT_DESTINATION, overwrite=False):
+        """
+        :param rules: List of (compiled regex, dict of frame values) 2-tuples
+        :param catalog: Dict of path or file name to a list of (frame key, value) 2-tuples
+        :param destination: Library path template
+        :param overwrite: Replace frames the file already has
+        """
+        self.rules = rules
+        self.catalog = catalog or {}
+        self.destination = destination
+        self.overwrite = overwrite
+
+    def values_for(self, relpath):
+        """
+        The frame values the rules give a file
+        :param relpath: Path of the file relative to the inbox
+        :return: A dict of frame key to value
+        """
+        relpath = relpath.replace(os.sep, "/")
+        values = {}
+        for pattern, set_values in self.rules:
+            m = pattern.search(relpath)
+            if m:
+                values.update((k, v) for k, v in m.groupdict().items() if v)
+                values.update(set_values)
+        entry = self.catalog.get(relpath, self.catalog.get(os.path.basename(relpath)))
+        if entry:
+            values.update(entry)
+        return values
+
+    def destination_for(self, relpath, record):
+        """
+        :param relpath: Path of the file relative to the inbox
+        :param record: The file's tag record after tagging
+        :return: Destination path relative to the library
+        """
+        fields = _PathFields(record)
+        fields["filename"] = os.path.basename(relpath)
+        parts = [part.format_map(fields) for part in self.destination.split("/")]
+        return os.path.join(*[p for p in parts if p])
+
+
+class _PathFields(dict):
+    """
+    Template fields for destination paths. Values are made safe to use as
+    a single path component and missing frames are UNKNOWN.
+    """
+    def __init__(self, record):
+        super(_PathFields, self).__init__((k, _safe_name(v)) for k, v in record.items())
+
+    def __missing__(self, key):
+        if key not in id3frames.frame_keys():
+            raise KeyError(key)
+        return UNKNOWN
+
+
+def _safe_name(value):
+    value = _UNSAFE_CHARS.sub("_", value).strip(" .")
+    return value or UNKNOWN
+
+
+def load_rules(path):
+    """
+    Read a rules file
+    :param path: JSON rules file (see the top of this module)
+    :return: An IngestRules
+    :raises ValueError: The rules are not valid
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    rules = []
+    for rule in config.get("rules", []):
+        try:
+            pattern = re.compile(rule.get("match", ""))
+        except re.error as ex:
+            raise ValueError("Invalid regex {0}: {1}".format(rule.get("match"), ex))
+        set_values = {k: str(v) for k, v in rule.get("set", {}).items()}
+        for key in list(pattern.groupindex) + list(set_values):
+            _check_frame(key)
+        rules.append((pattern, set_values))
+
+    catalog = {}
+    if config.get("catalog"):
+        # Relative to the rules file
+        catalog_path = os.path.join(os.path.dirname(path), config["catalog"])
+        fmt = "jsonl" if catalog_path.endswith((".jsonl", ".json")) else "csv"
+        with open(catalog_path, "r", encoding="utf-8", newline="") as inp:
+            for entry_path, values in tag_export.read_records(inp, "", fmt=fmt):
+                entry_path = entry_path.replace(os.sep, "/")
+                catalog[entry_path] = values
+                catalog.setdefault(os.path.basename(entry_path), values)
+
+    destination = config.get("destination", DEFAULT_DESTINATION)
+    try:
+        IngestRules([], destination=destination).destination_for("x.mp3", {})
+    except (KeyError, ValueError, IndexError) as ex:
+        raise ValueError("Invalid destination {0}: {1}".format(destination, ex))
+    return IngestRules(rules, catalog=catalog, destination=destination,
+                       overwrite=bool(config.get("overwrite", False)))
+
+
+def _check_frame(key):
+    if key not in id3frames.frame_keys():
+        raise ValueError("Unknown frame {0}".format(key))
+    if id3frames.create(key, "") is None:
+        raise ValueError("{0} cannot be set".format(key))
+
+
+def ingest_file(inbox, library, relpath, rules, dry_run=False):
+    """
+    Tag one file and move it into the library. An existing file at the
+    destination is never replaced.
+    :param inbox: Inbox directory
+    :param library: Library directory
+    :param relpath: Path of the file relative to the inbox
+    :param rules: An IngestRules
+    :param dry_run: Work out the changes but do not write or move anything
+    :return: A list of changes, the last one is the move
+    """
+    fn = os.path.join(inbox, relpath)
+    with tag_lock.locked(fn):
+        id3 = tag_records.load_id3(fn)
+        record = tag_records.record_from_id3(id3)
+        values = [(k, v) for k, v in rules.values_for(relpath).items() if rules.overwrite or k not in record]
+        # The tags are changed in memory first, a file that cannot be moved is left as it was
+        changes = tag_records.set_values(fn, id3, values, dry_run=True)
+        dest = os.path.join(library, rules.destination_for(relpath, tag_records.record_from_id3(id3)))
+        if os.path.exists(dest):
+            raise FileExistsError("{0} already exists".format(dest))
+        if not dry_run:
+            if changes:
+                tag_records.save_id3(fn, id3)
+            _move(fn, dest)
+        changes.append("moved to {0}".format(dest))
+        return changes
+
+
+def _move(fn, dest):
+    """
+    Move a file without replacing an existing one, even when two workers
+    move files to the same place at once
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        # Fails if dest exists
+        os.link(fn, dest)
+    except FileExistsError:
+        raise FileExistsError("{0} already exists".format(dest))
+    except OSError:
+        # Another file system, or no hard links
+        if os.path.exists(dest):
+            raise FileExistsError("{0} already exists".format(dest))
+        shutil.move(fn, dest)
+        return
+    os.unlink(fn)
+
+
+class InboxWatcher():
+    """
+    Polls an inbox for files that are ready to ingest. A file is ready once
+    its size and modification time are the same on two polls in a row, so
+    files that are still being copied in are left alone. Each version of a
+    file is handed out once, a file that could not be ingested is only
+    tried again after it changes.
+    """
+    def __init__(self, inbox, filter_regex=library_scan.DEFAULT_FILTER):
+        self._inbox = inbox
+        self._filter_regex = filter_regex
+        # relative path -> stat key on the last poll
+        self._seen = {}
+        # relative path -> stat key when it was handed out
+        self._handed_out = {}
+
+    def poll(self, wait_until_stable=True):
+        """
+        :param wait_until_stable: False to hand out every file without waiting
+        :return: List of ready paths relative to the inbox
+        """
+        current = {}
+        for fn in library_scan.scan_files(self._inbox, filter_regex=self._filter_regex):
+            try:
+                st = os.stat(fn)
+            except OSError:
+                # Moved away since the scan
+                continue
+            current[os.path.relpath(fn, self._inbox)] = (st.st_size, st.st_mtime_ns)
+
+        ready = []
+        for relpath, key in current.items():
+            stable = not wait_until_stable or self._seen.get(relpath) == key
+            if stable and self._handed_out.get(relpath) != key:
+                self._handed_out[relpath] = key
+                ready.append(relpath)
+        self._seen = current
+        # Forget files that are gone
+        self._handed_out = {k: v for k, v in self._handed_out.items() if k in current}
+        return ready
@@ -0,0 +1,236 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Throttling of file I/O so bulk jobs do not saturate shared storage.
+#
+# Every file operation asks the scheduler first. Background operations
+# (scans, batch writes) wait while the bytes/sec or ops/sec budget is used
+# up, or while an interactive operation is running. Interactive operations
+# (opening or saving a file in the editor) never wait, but they use up the
+# budget so background work backs off.
+#
+# The bytes of an operation are estimated from the two reads of a tag read
+# (see tag_regions.CoalescedReader), which most tag writes touch too.
+# Without any budget nothing waits except for interactive operations.
+#
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import tag_regions
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Window in seconds over which the achieved rates are measured
+_RATE_WINDOW = 5.0
+
+
+class _TokenBucket():
+    """
+    Budget of rate units per second. Allowed to go into debt so a single
+    large operation is not blocked forever; later operations wait until
+    the debt is paid off.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        # Start empty so a short job cannot exceed the rate with a burst
+        self.tokens = 0
+        self._last = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait_time(self):
+        """
+        :return: Seconds until the bucket is out of debt
+        """
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class IOScheduler():
+    """
+    Bytes/sec and ops/sec budgets shared by all threads
+    """
+    def __init__(self, bytes_per_sec=None, ops_per_sec=None):
+        """
+        :param bytes_per_sec: Byte budget, None for unlimited
+        :param ops_per_sec: Operation budget, None for unlimited
+        """
+        self._bytes = _TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self._ops = _TokenBucket(ops_per_sec) if ops_per_sec else None
+        self._cond = threading.Condition()
+        self._interactive = 0
+        self._waiting = 0
+        # (time, bytes) of recent operations, for the achieved rates
+        self._history = deque()
+        self._started = time.monotonic()
+        self._total_bytes = 0
+        self._total_ops = 0
+        self._max_queue_depth = 0
+
+    @property
+    def limited(self):
+        return self._bytes is not None or self._ops is not None
+
+    def acquire(self, nbytes=0, priority=BACKGROUND):
+        """
+        Wait (background only) until an operation may start, then charge it
+        :param nbytes: Estimated bytes the operation reads or writes
+        :param priority: INTERACTIVE or BACKGROUND
+        :return: None
+        """
+        with self._cond:
+            if priority == BACKGROUND:
+                self._waiting += 1
+                self._max_queue_depth = max(self._max_queue_depth, self._waiting)
+                try:
+                    while True:
+                        delay = self._delay()
+                        if delay == 0 and self._interactive == 0:
+                            break
+                        # Woken early when an interactive operation ends
+                        self._cond.wait(delay if delay else None)
+                finally:
+                    self._waiting -= 1
+            self._charge(nbytes)
+
+    @contextmanager
+    def operation(self, nbytes=0, priority=BACKGROUND):
+        """
+        Context manager around a file operation. While an interactive
+        operation is inside, background operations do not start.
+        """
+        self.acquire(nbytes, priority)
+        if priority == INTERACTIVE:
+            with self._cond:
+                self._interactive += 1
+        try:
+            yield
+        finally:
+            if priority == INTERACTIVE:
+                with self._cond:
+                    self._interactive -= 1
+                    self._cond.notify_all()
+
+    def throttled(self, func, path_of=None, write=False):
+        """
+        Wrap a per file work function (see library_scan.parallel_map) so
+        every call is a background operation
+        :param func: Called as func(item)
+        :param path_of: Gets the file path from an item when items are not paths
+        :param write: The function writes the file (counts its bytes twice)
+        :return: The wrapped function
+        """
+        def run(item):
+            fn = path_of(item) if path_of else item
+            nbytes = self.estimate_bytes(fn) * (2 if write else 1)
+            with self.operation(nbytes, BACKGROUND):
+                return func(item)
+        return run
+
+    def estimate_bytes(self, fn):
+        """
+        Estimate the bytes a tag operation on a file touches. Without a
+        byte budget the estimate is not needed and is skipped (0).
+        :param fn: File path
+        :return: Estimated bytes
+        """
+        return estimate_bytes(fn) if self._bytes else 0
+
+    def stats(self):
+        """
+        :return: A dict with the achieved bytes_per_sec and ops_per_sec over
+        the last few seconds, the number of operations waiting (queue_depth)
+        and totals since the scheduler was created (bytes, ops, seconds,
+        max_queue_depth)
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._trim(now)
+            window = min(_RATE_WINDOW, now - self._started) or _RATE_WINDOW
+            return {
+                "bytes_per_sec": sum(b for t, b in self._history) / window,
+                "ops_per_sec": len(self._history) / window,
+                "queue_depth": self._waiting,
+                "bytes": self._total_bytes,
+                "ops": self._total_ops,
+                "seconds": now - self._started,
+                "max_queue_depth": self._max_queue_depth,
+            }
+
+    def _delay(self):
+        now = time.monotonic()
+        delay = 0
+        for bucket in (self._bytes, self._ops):
+            if bucket:
+                bucket.refill(now)
+                delay = max(delay, bucket.wait_time())
+        return delay
+
+    def _charge(self, nbytes):
+        now = time.monotonic()
+        if self._bytes:
+            self._bytes.refill(now)
+            self._bytes.tokens -= nbytes
+        if self._ops:
+            self._ops.refill(now)
+            self._ops.tokens -= 1
+        self._history.append((now, nbytes))
+        self._trim(now)
+        self._total_bytes += nbytes
+        self._total_ops += 1
+
+    def _trim(self, now):
+        while self._history and self._history[0][0] < now - _RATE_WINDOW:
+            self._history.popleft()
+
+
+def estimate_bytes(fn):
+    """
+    Estimate the bytes a tag operation touches: the two reads of a
+    CoalescedReader, one at the start and one at the end of the file.
+    Only the file's size is looked up, reading its header to size the
+    tag would cost a read of its own that the budget does not see.
+    :param fn: File path
+    :return: Estimated bytes
+    """
+    try:
+        size = os.stat(fn).st_size
+    except OSError:
+        return 0
+    return min(size, tag_regions.read_block_size + tag_regions.TAIL_BLOCK_SIZE)
+
+
+# The scheduler used by the app and the batch commands
+_default = IOScheduler()
+
+
+def default():
+    return _default
+
+
+def configure(bytes_per_sec=None, ops_per_sec=None):
+    """
+    Replace the default scheduler with one with the given budgets
+    :return: The new default scheduler
+    """
+    global _default
+    _default = IOScheduler(bytes_per_sec=bytes_per_sec, ops_per_sec=ops_per_sec)
+    return _default
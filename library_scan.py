@@ -0,0 +1,145 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# mp3 files, the files with ID3 tags. tag_formats.file_filter() matches
+# the files of every supported format.
+DEFAULT_FILTER = r".+\.mp3$"
+
+# Tag work is mostly waiting on the file system (often a NAS), so
+# threads are used and the pool can be larger than the core count.
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+def scan_files(root, filter_regex=DEFAULT_FILTER, recursive=True):
+    """
+    Walk a directory tree yielding the full path of every file whose
+    name matches the filter. Entries are visited depth first and sorted
+    by name, so the order is the same from run to run.
+    :param root: Directory (or single file) to scan
+    :param filter_regex: filter regex for files (does not apply to directories)
+    :param recursive: False to scan only the files directly in root
+    :return: A generator of file paths
+    """
+    pattern = re.compile(filter_regex)
+    if not os.path.isdir(root):
+        if pattern.match(os.path.basename(root)):
+            yield root
+        return
+
+    # Explicit stack instead of recursion so very deep trees are not a problem
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            # Unreadable directories are skipped rather than ending the scan
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif pattern.match(entry.name):
+                yield entry.path
+        if recursive:
+            # Reversed so the first subdirectory is popped first
+            stack.extend(reversed(subdirs))
+
+
+def scan_order_key(relpath):
+    """
+    Sort key putting paths relative to a scanned root in the order
+    scan_files yields them: in each directory its files by name, then
+    its subdirectories by name.
+    :param relpath: Path relative to the root
+    :return: A key, smaller for paths yielded earlier
+    """
+    parts = relpath.replace(os.sep, "/").split("/")
+    # Files (0) come before the subdirectories (1) of the same directory
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
+
+
+def parallel_map(func, items, workers=DEFAULT_WORKERS, max_pending=None, ordered=False,
+                 executor=None):
+    """
+    Apply func to every item on a thread pool, yielding results as they
+    complete. Only a bounded number of items are in flight at any time
+    so an arbitrarily long generator (e.g. scan_files) is consumed in
+    constant memory.
+
+    If the consumer stops early (break, KeyboardInterrupt) items that have
+    not started are cancelled and the ones already running are allowed to
+    finish, so no file is left half written.
+    :param func: Called as func(item)
+    :param items: Iterable of work items
+    :param workers: Number of worker threads
+    :param max_pending: Maximum items in flight, default 4 * workers
+    :param ordered: Yield results in the order of items instead of as they complete
+    :param executor: Existing executor to run on (e.g. a service's shared pool).
+    It is not shut down when the items are done.
+    :return: A generator of (item, result, error) 3-tuples. Exactly
+    one of result and error is meaningful.
+    """
+    if max_pending is None:
+        max_pending = workers * 4
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    pending = None
+    try:
+        if ordered:
+            pending = deque()
+            for item in items:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= max_pending:
+                    yield _future_result(*pending.popleft())
+            while pending:
+                yield _future_result(*pending.popleft())
+        else:
+            pending = {}
+            for item in items:
+                pending[executor.submit(func, item)] = item
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield _future_result(pending.pop(future), future)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _future_result(pending.pop(future), future)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        elif pending:
+            # Leave the shared executor running, just drop our queued work
+            futures = [f for _, f in pending] if ordered else list(pending)
+            for future in futures:
+                future.cancel()
+
+
+def _future_result(item, future):
+    error = future.exception()
+    if error:
+        return item, None, error
+    return item, future.result(), None
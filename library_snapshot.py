@@ -0,0 +1,152 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Columnar snapshot of a library for analytics. One row per file with
+# path, size, mtime, every frame in id3frames.frame_keys(), duration,
+# ID3 version and artwork size, written as Parquet or Arrow IPC.
+#
+# Requires pyarrow, which is not needed by the editor itself:
+#     pip install pyarrow
+#
+
+import os
+import mutagen
+import mutagen.mp3
+import id3frames
+import io_scheduler
+import library_scan
+import tag_formats
+import tag_records
+import tag_regions
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ("parquet", "arrow")
+
+# Rows per record batch (Parquet row group). Bounds the memory used
+# while writing regardless of the size of the library.
+DEFAULT_BATCH_SIZE = 10000
+
+
+def snapshot_schema():
+    """
+    :return: The pyarrow schema of a snapshot
+    """
+    fields = [
+        pyarrow.field("path", pyarrow.string(), nullable=False),
+        pyarrow.field("size", pyarrow.int64()),
+        pyarrow.field("mtime", pyarrow.timestamp("us")),
+    ]
+    fields += [pyarrow.field(k, pyarrow.string()) for k in id3frames.frame_keys()]
+    fields += [
+        pyarrow.field("duration", pyarrow.float64()),
+        pyarrow.field("tag_version", pyarrow.string()),
+        pyarrow.field("artwork_size", pyarrow.int64()),
+    ]
+    return pyarrow.schema(fields)
+
+
+def read_file_info(fn):
+    """
+    Everything a snapshot records about a file
+    :param fn: File of any supported format (see tag_formats)
+    :return: A dict with one entry per snapshot column (path is the full path)
+    """
+    st = os.stat(fn)
+    info = {"path": fn, "size": st.st_size, "mtime": int(st.st_mtime * 1000000)}
+    tag_format = tag_formats.format_for(fn)
+    if tag_format is not None:
+        # Not an mp3 file, there is no tag version
+        format_info = tag_format.read_info(fn)
+        info.update(format_info["record"])
+        info.update(duration=format_info["duration"], tag_version=None,
+                    artwork_size=format_info["artwork_size"])
+        return info
+    try:
+        with tag_regions.CoalescedReader(fn) as f:
+            mp3 = mutagen.mp3.MP3(f)
+        tags = mp3.tags
+        if tags is not None:
+            # Loaded from a file object, so mutagen does not know the file name
+            tags.filename = fn
+        info["duration"] = mp3.info.length
+    except mutagen.MutagenError:
+        # Not a valid MPEG stream, the tags may still be readable
+        tags = tag_records.load_id3(fn)
+        info["duration"] = None
+
+    if tags is not None and tags.filename is not None:
+        info["tag_version"] = ".".join(str(v) for v in tags.version[:2])
+        info["artwork_size"] = sum(len(f.data) for f in tags.getall("APIC"))
+        info.update(tag_records.record_from_id3(tags))
+    else:
+        info["tag_version"] = None
+        info["artwork_size"] = 0
+    return info
+
+
+def write_snapshot(root, path, fmt="parquet", batch_size=DEFAULT_BATCH_SIZE,
+                   workers=library_scan.DEFAULT_WORKERS):
+    """
+    Scan a directory tree into a snapshot file. Rows are in scan order
+    (see library_scan.scan_files) with paths relative to root.
+    :param root: Directory to scan
+    :param path: Snapshot file to write
+    :param fmt: "parquet" or "arrow"
+    :param batch_size: Rows per record batch
+    :param workers: Number of worker threads
+    :return: A generator of (path, error) 2-tuples for files that could not be read
+    """
+    if pyarrow is None:
+        raise RuntimeError("Snapshots require pyarrow (pip install pyarrow)")
+
+    schema = snapshot_schema()
+    if fmt == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pyarrow.ipc.new_file(path, schema)
+
+    columns = {name: [] for name in schema.names}
+    rows = 0
+    try:
+        files = library_scan.scan_files(root, filter_regex=tag_formats.file_filter())
+        for fn, info, error in library_scan.parallel_map(io_scheduler.default().throttled(read_file_info),
+                                                         files, workers=workers, ordered=True):
+            if error:
+                yield fn, error
+                continue
+            info["path"] = os.path.relpath(fn, root)
+            for name, values in columns.items():
+                values.append(info.get(name))
+            rows += 1
+            if rows >= batch_size:
+                _write_batch(writer, schema, columns)
+                rows = 0
+        if rows:
+            _write_batch(writer, schema, columns)
+    finally:
+        writer.close()
+
+
+def _write_batch(writer, schema, columns):
+    batch = pyarrow.RecordBatch.from_pydict(columns, schema=schema)
+    writer.write_batch(batch)
+    for values in columns.values():
+        values.clear()
@@ -0,0 +1,69 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# What the app remembers between runs: the last directories used, the
+# directories expanded in the file tree and their listings (see
+# FileTreeView.session_state). Kept as JSON in the user's home directory.
+#
+
+import json
+import os
+
+SESSION_FILE = os.path.join(os.path.expanduser("~"), ".pyid3tag", "session.json")
+
+
+def load(path=SESSION_FILE):
+    """
+    :param path: Session file
+    :return: A dict of the saved values, empty if there are none or they cannot be read
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save(state, path=SESSION_FILE):
+    """
+    Replace the saved values. The file is replaced in one step, so a crash
+    leaves the old values.
+    :param state: A dict of JSON serializable values
+    :param path: Session file
+    :return: None
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def update(values, path=SESSION_FILE):
+    """
+    Change some of the saved values, keeping the others
+    :param values: A dict of the values to change
+    :param path: Session file
+    :return: None
+    """
+    state = load(path)
+    state.update(values)
+    try:
+        save(state, path)
+    except OSError:
+        # Not being able to remember is not worth bothering the user about
+        pass
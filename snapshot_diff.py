@@ -0,0 +1,229 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Differences between the tags recorded in a library snapshot (see
+# library_snapshot) and a later snapshot or the live tree. Both sides are
+# in scan order (see library_scan.scan_order_key), so they are merged in
+# one pass holding a record batch of each at a time, whatever the size
+# of the library. The frames in id3frames.frame_keys() are compared.
+#
+# Against the live tree, a file whose size and modification time are
+# the ones in the snapshot is taken to be unchanged and is not read.
+#
+# Requires pyarrow (see library_snapshot).
+#
+
+import itertools
+import os
+import id3frames
+import io_scheduler
+import library_scan
+import library_snapshot
+import tag_formats
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+# Rows read from a snapshot at a time
+DEFAULT_BATCH_SIZE = 65536
+
+# The first bytes of the snapshot file formats
+_PARQUET_MAGIC = b"PAR1"
+_ARROW_MAGIC = b"ARROW1"
+
+# Frame values are compared as one string per file, joined with a
+# separator and with a marker for no frame
+_SEPARATOR = "\x1f"
+_NO_FRAME = "\x00"
+
+
+def _fingerprint(values):
+    return _SEPARATOR.join(_NO_FRAME if v is None else v for v in values)
+
+
+def read_rows(path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Read the rows of a snapshot one record batch at a time
+    :param path: Parquet or Arrow snapshot file (see library_snapshot.write_snapshot)
+    :param batch_size: Rows read at a time from a Parquet file
+    :return: A generator of rows, (path, size, mtime, fingerprint, batch,
+    index) 6-tuples where mtime is in microseconds. The frame values of
+    a row are only looked up when needed, see frame_values.
+    """
+    if pyarrow is None:
+        raise RuntimeError("Snapshot diffs require pyarrow (pip install pyarrow)")
+    columns = ["path", "size", "mtime"] + id3frames.frame_keys()
+    with open(path, "rb") as f:
+        magic = f.read(len(_ARROW_MAGIC))
+    if magic.startswith(_PARQUET_MAGIC):
+        batches = pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+    elif magic == _ARROW_MAGIC:
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path))
+        batches = (reader.get_batch(i).select(columns) for i in range(reader.num_record_batches))
+    else:
+        raise ValueError("{0} is not a Parquet or Arrow snapshot".format(path))
+
+    for batch in batches:
+        # Whole columns are converted at once, much faster than row by row
+        fingerprints = pyarrow.compute.binary_join_element_wise(
+            *[batch.column(k) for k in columns[3:]], _SEPARATOR,
+            null_handling="replace", null_replacement=_NO_FRAME)
+        yield from zip(batch.column("path").to_pylist(),
+                       batch.column("size").to_pylist(),
+                       batch.column("mtime").cast(pyarrow.int64()).to_pylist(),
+                       fingerprints.to_pylist(), itertools.repeat(batch), itertools.count())
+
+
+def frame_values(row):
+    """
+    :param row: A row of read_rows or of the live tree
+    :return: A tuple of the row's frame values in id3frames.frame_keys() order
+    """
+    source, index = row[4], row[5]
+    if index is None:
+        # Read from a file, the values are at hand
+        return source
+    return tuple(source.column(k)[index].as_py() for k in id3frames.frame_keys())
+
+
+def merge(old, new):
+    """
+    Pair up the items of two sequences sorted by path in scan order
+    :param old: Iterable of items, tuples starting with a path relative to the root
+    :param new: Iterable of items, tuples starting with a path relative to the root
+    :return: A generator of (path, old item or None, new item or None) 3-tuples
+    """
+    old = iter(old)
+    new = iter(new)
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None and b is not None:
+        if a[0] == b[0]:
+            yield a[0], a, b
+            a = next(old, None)
+            b = next(new, None)
+        elif library_scan.scan_order_key(a[0]) < library_scan.scan_order_key(b[0]):
+            yield a[0], a, None
+            a = next(old, None)
+        else:
+            yield b[0], None, b
+            b = next(new, None)
+    while a is not None:
+        yield a[0], a, None
+        a = next(old, None)
+    while b is not None:
+        yield b[0], None, b
+        b = next(new, None)
+
+
+def frame_changes(old_values, new_values):
+    """
+    :param old_values: Frame values in id3frames.frame_keys() order, None for no file
+    :param new_values: Frame values in id3frames.frame_keys() order, None for no file
+    :return: A list of changes, e.g. "TALB: Old -> New"
+    """
+    keys = id3frames.frame_keys()
+    old_values = old_values or (None,) * len(keys)
+    new_values = new_values or (None,) * len(keys)
+    changes = []
+    for key, old, new in zip(keys, old_values, new_values):
+        if old != new:
+            changes.append("{0}: {1} -> {2}".format(key, "(none)" if old is None else old,
+                                                    "(none)" if new is None else new))
+    return changes
+
+
+def _difference(path, old, new):
+    """
+    :return: A (path, status, changes) 3-tuple, None if the tags are the same
+    """
+    if new is None:
+        return path, REMOVED, frame_changes(frame_values(old), None)
+    if old is None:
+        return path, ADDED, frame_changes(None, frame_values(new))
+    if old[3] == new[3]:
+        return None
+    return path, CHANGED, frame_changes(frame_values(old), frame_values(new))
+
+
+def diff_snapshots(old_path, new_path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Compare the tags recorded in two snapshots of the same tree
+    :param old_path: Earlier snapshot file
+    :param new_path: Later snapshot file
+    :param batch_size: Rows read at a time from each snapshot
+    :return: A generator of (path, status, changes) 3-tuples, one per
+    added, removed or changed file in scan order. status is ADDED,
+    REMOVED or CHANGED and changes is a list of frame changes.
+    """
+    pairs = merge(read_rows(old_path, batch_size=batch_size), read_rows(new_path, batch_size=batch_size))
+    for path, old, new in pairs:
+        difference = _difference(path, old, new)
+        if difference:
+            yield difference
+
+
+def _live_row(relpath, fn, old, read):
+    """
+    :param read: Reads a file's snapshot columns (see library_snapshot.read_file_info)
+    :return: The row of the live file, the snapshot's row if the file
+    has not been modified since
+    """
+    if old is not None:
+        st = os.stat(fn)
+        if st.st_size == old[1] and int(st.st_mtime * 1000000) == old[2]:
+            return old
+    info = read(fn)
+    values = tuple(info.get(k) for k in id3frames.frame_keys())
+    return relpath, info["size"], info["mtime"], _fingerprint(values), values, None
+
+
+def diff_tree(old_path, root, batch_size=DEFAULT_BATCH_SIZE, workers=library_scan.DEFAULT_WORKERS):
+    """
+    Compare the tags recorded in a snapshot with the files of a tree now
+    :param old_path: Snapshot file
+    :param root: Directory the snapshot was taken of
+    :param batch_size: Rows read at a time from the snapshot
+    :param workers: Number of worker threads reading files
+    :return: A generator of (path, status, changes, error) 4-tuples in
+    scan order (see diff_snapshots). For a file that could not be read
+    status and changes are None and error is the exception.
+    """
+    files = ((os.path.relpath(fn, root), fn)
+             for fn in library_scan.scan_files(root, filter_regex=tag_formats.file_filter()))
+    pairs = merge(read_rows(old_path, batch_size=batch_size), files)
+    # Only reads are throttled, checking a file's size and time is cheap
+    read = io_scheduler.default().throttled(library_snapshot.read_file_info)
+
+    def compare(pair):
+        path, old, new = pair
+        if new is not None:
+            new = _live_row(path, new[1], old, read)
+        return _difference(path, old, new)
+
+    for pair, difference, error in library_scan.parallel_map(compare, pairs, workers=workers, ordered=True):
+        if error:
+            yield pair[0], None, None, error
+        elif difference:
+            yield difference + (None,)
@@ -0,0 +1,243 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Tag reads and writes for asyncio programs. The file I/O runs on a
+# thread pool of bounded size and the coroutines wait for it, so the
+# event loop is never blocked.
+#
+#     library = tag_async.AsyncTagLibrary(workers=8)
+#     record = await library.read_tags("a.flac")
+#     changes = await library.write_tags("a.mp3", {"TCON": "Jazz"})
+#     async for fn, record, error in library.scan("/music"):
+#         ...
+#
+# Files of every supported format can be used (see tag_formats).
+#
+# Cancelling a call drops it if it has not started. A call that is
+# already running on a worker thread cannot be stopped, it finishes (a
+# file is never left half written) and its result is discarded.
+#
+
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import io_scheduler
+import library_scan
+import tag_formats
+import tag_lock
+
+# Files read by one call on a worker during a scan. Handing over every
+# file on its own costs the event loop more than reading the file.
+_SCAN_BATCH = 8
+
+
+def _write_file(fn, values, journal, dry_run):
+    with tag_lock.locked(fn):
+        return tag_formats.set_file_values(fn, values, journal=journal, dry_run=dry_run)
+
+
+def _read_batch(read, paths):
+    """
+    :return: A list of (path, record, error) 3-tuples
+    """
+    results = []
+    for fn in paths:
+        try:
+            results.append((fn, read(fn), None))
+        except Exception as ex:
+            results.append((fn, None, ex))
+    return results
+
+
+def _take(items, count):
+    """
+    :return: A list of the next count items of an iterator, empty at its end
+    """
+    taken = []
+    for item in items:
+        taken.append(item)
+        if len(taken) >= count:
+            break
+    return taken
+
+
+class AsyncTagLibrary():
+    """
+    Coroutines for reading and writing tags on a worker thread pool
+    """
+    def __init__(self, workers=library_scan.DEFAULT_WORKERS, max_concurrency=None, executor=None):
+        """
+        :param workers: Number of worker threads
+        :param max_concurrency: Maximum calls running at once in an event
+        loop, default workers. The others wait their turn.
+        :param executor: Existing executor to run on. It is not shut down by close.
+        """
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=workers)
+        self._workers = workers
+        self._max_concurrency = max_concurrency or workers
+        # Event loop -> its Semaphore, asyncio primitives belong to one loop
+        self._limits = weakref.WeakKeyDictionary()
+
+    def close(self):
+        """
+        Shut down the worker threads, waiting for running calls
+        :return: None
+        """
+        if self._own_executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def _limit(self):
+        loop = asyncio.get_running_loop()
+        limit = self._limits.get(loop)
+        if limit is None:
+            limit = self._limits[loop] = asyncio.Semaphore(self._max_concurrency)
+        return limit
+
+    async def _run(self, func, *args):
+        """
+        Run func(*args) on a worker thread once the concurrency limit allows
+        :return: Its result
+        """
+        async with self._limit():
+            future = self._executor.submit(func, *args)
+            waiter = asyncio.wrap_future(future)
+            try:
+                return await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                if not future.cancel():
+                    # Already running. Its place is kept until it ends, so
+                    # the limit holds.
+                    await asyncio.wait([waiter])
+                raise
+
+    async def read_tags(self, fn):
+        """
+        :param fn: File path
+        :return: A dict of frame key to text value (see tag_formats.read_record)
+        """
+        return await self._run(tag_formats.read_record, fn)
+
+    async def write_tags(self, fn, values, journal=None, dry_run=False):
+        """
+        Set frame values in a file (see tag_formats.set_file_values). The
+        file is locked while it is read and written (see tag_lock).
+        :param fn: File path
+        :param values: A dict of frame key to value or an iterable of
+        (frame key, value) 2-tuples
+        :param journal: Optional WriteJournal recording the original tags
+        :param dry_run: Work out the changes but do not write them
+        :return: A list of changes
+        """
+        values = list(values.items() if isinstance(values, dict) else values)
+        return await self._run(_write_file, fn, values, journal, dry_run)
+
+    async def scan(self, root, filter_regex=None, recursive=True, max_pending=None):
+        """
+        Read the tags of the files in a directory tree, yielding them as
+        they are read (not in scan order). Directories are walked on the
+        worker threads too. Only a bounded number of reads are in flight,
+        so any size of tree is scanned in constant memory. Reads that have
+        not started are cancelled when iteration stops early.
+        :param root: Directory (or single file) to scan
+        :param filter_regex: Filter for file names, default every supported format
+        :param recursive: False to scan only the files directly in root
+        :param max_pending: Maximum reads in flight, default 4 * workers
+        :return: An async generator of (path, record, error) 3-tuples.
+        Exactly one of record and error is meaningful.
+        """
+        if filter_regex is None:
+            filter_regex = tag_formats.file_filter()
+        max_pending = max_pending or self._workers * 4
+        paths = library_scan.scan_files(root, filter_regex=filter_regex, recursive=recursive)
+        read = io_scheduler.default().throttled(tag_formats.read_record)
+        # Task reading a batch of files -> number of files
+        pending = {}
+        in_flight = 0
+        # Tasks as they finish
+        finished = asyncio.Queue()
+        walked = False
+        # The latest step of the walk, see _take
+        walk = None
+        try:
+            while True:
+                # Topped up in batches, each step of the walk is a trip to a worker
+                while not walked and in_flight <= max_pending // 2:
+                    walk = self._executor.submit(_take, paths, max_pending - in_flight)
+                    taken = await asyncio.wrap_future(walk)
+                    walked = not taken
+                    for start in range(0, len(taken), _SCAN_BATCH):
+                        batch = taken[start:start + _SCAN_BATCH]
+                        task = asyncio.ensure_future(self._run(_read_batch, read, batch))
+                        task.add_done_callback(finished.put_nowait)
+                        pending[task] = len(batch)
+                        in_flight += len(batch)
+                if not pending:
+                    return
+                task = await finished.get()
+                in_flight -= pending.pop(task)
+                for result in task.result():
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            if walk is not None and not walk.cancel() and not walk.done():
+                # The walk cannot be closed while a worker is in it
+                await asyncio.wait([asyncio.wrap_future(walk)])
+            paths.close()
+
+
+# The library used by the module level coroutines, see default
+_default = None
+
+
+def default():
+    """
+    :return: The shared AsyncTagLibrary, created on first use with the default settings
+    """
+    global _default
+    if _default is None:
+        _default = AsyncTagLibrary()
+    return _default
+
+
+async def read_tags(fn):
+    """
+    Read a file's tags with the shared library (see AsyncTagLibrary.read_tags)
+    """
+    return await default().read_tags(fn)
+
+
+async def write_tags(fn, values, journal=None, dry_run=False):
+    """
+    Write a file's tags with the shared library (see AsyncTagLibrary.write_tags)
+    """
+    return await default().write_tags(fn, values, journal=journal, dry_run=dry_run)
+
+
+def scan(root, filter_regex=None, recursive=True, max_pending=None):
+    """
+    Scan a tree with the shared library (see AsyncTagLibrary.scan)
+    """
+    return default().scan(root, filter_regex=filter_regex, recursive=recursive, max_pending=max_pending)
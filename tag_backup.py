@@ -0,0 +1,289 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Backups of the tags of a tree without the audio.
+#
+# A store is a directory:
+#     tags.pack           The tag areas (see tag_regions) of every file,
+#                         compressed and stored once however many files or
+#                         snapshots have the same bytes
+#     snapshots/*.jsonl   One file per backup. The first line names the
+#                         tree, then one line per file with its path, size,
+#                         modification time, audio fingerprint and the
+#                         hashes of its head and tail in the pack.
+#
+# A backup only reads the files whose size or modification time changed
+# since the last snapshot of the same tree, the others are copied from it.
+# A restore rewrites the tag areas of files whose audio still matches.
+#
+# A pack record is a 32 byte SHA-256 of the tag bytes, a 4 byte big endian
+# length and the zlib compressed bytes.
+#
+
+import datetime
+import hashlib
+import json
+import os
+import struct
+import zlib
+import io_scheduler
+import library_scan
+import tag_lock
+import tag_regions
+
+PACK_NAME = "tags.pack"
+SNAPSHOT_DIR = "snapshots"
+
+_RECORD_HEADER = struct.Struct(">32sI")
+
+# Bytes read at each end of the audio for its fingerprint
+_FINGERPRINT_BLOCK = 64 * 1024
+
+
+def audio_fingerprint(fn, head_size, tail_size):
+    """
+    Identify the audio of a file without reading all of it: a hash of its
+    length and its first and last blocks. Tag changes do not change it.
+    :param fn: mp3 file
+    :param head_size: Size of the file's ID3v2 tag
+    :param tail_size: Size of the file's APEv2/ID3v1 tags
+    :return: Hex digest
+    """
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        audio_size = f.tell() - head_size - tail_size
+        h.update(struct.pack(">Q", audio_size))
+        f.seek(head_size)
+        h.update(f.read(min(_FINGERPRINT_BLOCK, audio_size)))
+        if audio_size > _FINGERPRINT_BLOCK:
+            f.seek(head_size + max(_FINGERPRINT_BLOCK, audio_size - _FINGERPRINT_BLOCK))
+            h.update(f.read(min(_FINGERPRINT_BLOCK, audio_size - _FINGERPRINT_BLOCK)))
+    return h.hexdigest()
+
+
+def entry_path(root, entry):
+    """
+    :param root: Root of a tree
+    :param entry: A snapshot entry of a file in the tree
+    :return: The file's path
+    """
+    return os.path.join(root, *entry["path"].split("/"))
+
+
+class BackupStore():
+    """
+    A tag backup store (see the top of this module)
+    """
+    def __init__(self, path):
+        """
+        Open a store, creating it if needed
+        :param path: Store directory
+        """
+        self.path = path
+        os.makedirs(os.path.join(path, SNAPSHOT_DIR), exist_ok=True)
+        self._pack_path = os.path.join(path, PACK_NAME)
+        # Blob hash (hex) -> (offset of the compressed bytes, their length)
+        self._index = {}
+        self._pack = open(self._pack_path, "a+b")
+        self._load_index()
+
+    def close(self):
+        self._pack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load_index(self):
+        f = self._pack
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = 0
+        while pos + _RECORD_HEADER.size <= end:
+            f.seek(pos)
+            digest, length = _RECORD_HEADER.unpack(f.read(_RECORD_HEADER.size))
+            if pos + _RECORD_HEADER.size + length > end:
+                break
+            self._index[digest.hex()] = (pos + _RECORD_HEADER.size, length)
+            pos += _RECORD_HEADER.size + length
+        if pos != end:
+            # A record cut short by a crash, it is not in any snapshot
+            f.truncate(pos)
+
+    def has_blob(self, digest):
+        return digest in self._index
+
+    def add_blob(self, digest, compressed):
+        """
+        Append a blob unless the store already has it
+        :param digest: SHA-256 hex digest of the uncompressed bytes
+        :param compressed: zlib compressed bytes
+        :return: Number of bytes added to the pack
+        """
+        if digest in self._index:
+            return 0
+        f = self._pack
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        f.write(_RECORD_HEADER.pack(bytes.fromhex(digest), len(compressed)) + compressed)
+        self._index[digest] = (pos + _RECORD_HEADER.size, len(compressed))
+        return _RECORD_HEADER.size + len(compressed)
+
+    def read_blob(self, digest):
+        """
+        :param digest: SHA-256 hex digest of the bytes
+        :return: The bytes
+        :raises KeyError: The store does not have them
+        """
+        offset, length = self._index[digest]
+        # Own file object so threads can read at the same time
+        with open(self._pack_path, "rb") as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+    def snapshots(self):
+        """
+        :return: List of snapshot names, oldest first
+        """
+        names = [n[:-len(".jsonl")] for n in os.listdir(os.path.join(self.path, SNAPSHOT_DIR))
+                 if n.endswith(".jsonl")]
+        return sorted(names)
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.path, SNAPSHOT_DIR, name + ".jsonl")
+
+    def read_snapshot(self, name):
+        """
+        :param name: Snapshot name (see snapshots)
+        :return: A 2-tuple (root of the tree, generator of file entries). An
+        entry is a dict with path (relative to root), size, mtime_ns, audio,
+        head and tail.
+        """
+        def entries():
+            with open(self._snapshot_path(name), "r", encoding="utf-8") as f:
+                f.readline()
+                for line in f:
+                    yield json.loads(line)
+        return self._snapshot_root(name), entries()
+
+    def _snapshot_root(self, name):
+        with open(self._snapshot_path(name), "r", encoding="utf-8") as f:
+            return json.loads(f.readline())["root"]
+
+    def latest_snapshot(self, root=None):
+        """
+        :param root: Only snapshots of this tree, default any
+        :return: Name of the newest snapshot, None if there is none
+        """
+        for name in reversed(self.snapshots()):
+            if root is None or self._snapshot_root(name) == os.path.abspath(root):
+                return name
+        return None
+
+    def backup(self, root, workers=library_scan.DEFAULT_WORKERS):
+        """
+        Write a new snapshot of a tree. The snapshot only appears once every
+        file has been backed up.
+        :param root: Root of the tree
+        :param workers: Number of worker threads reading files
+        :return: A generator of (path, status, error) 3-tuples, one per file.
+        status is "unchanged" (copied from the last snapshot), "changed" or
+        "failed". The last item is (None, name of the new snapshot, None).
+        """
+        root = os.path.abspath(root)
+        previous = {}
+        last = self.latest_snapshot(root)
+        if last:
+            previous = {e["path"]: e for e in self.read_snapshot(last)[1]}
+
+        name = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        tmp = self._snapshot_path(name) + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as out:
+                out.write(json.dumps({"root": root}) + "\n")
+                work = lambda fn: self._backup_file(root, fn, previous)
+                work = io_scheduler.default().throttled(work)
+                for fn, result, error in library_scan.parallel_map(work, library_scan.scan_files(root),
+                                                                   workers=workers):
+                    if error:
+                        yield fn, "failed", error
+                        continue
+                    entry, blobs = result
+                    for digest, compressed in blobs or []:
+                        self.add_blob(digest, compressed)
+                    out.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                    yield fn, "unchanged" if blobs is None else "changed", None
+                # The pack first, a snapshot never refers to blobs that are not on disk
+                self._pack.flush()
+                os.fsync(self._pack.fileno())
+                out.flush()
+                os.fsync(out.fileno())
+        except BaseException:
+            # Interrupted, the blobs already added are used by the next backup
+            os.remove(tmp)
+            raise
+        os.replace(tmp, self._snapshot_path(name))
+        yield None, name, None
+
+    def _backup_file(self, root, fn, previous):
+        """
+        :return: A 2-tuple (entry, list of (digest, compressed bytes) of
+        blobs the store did not have). The list is None if the file did not
+        change since the previous snapshot.
+        """
+        path = os.path.relpath(fn, root).replace(os.sep, "/")
+        st = os.stat(fn)
+        entry = previous.get(path)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry, None
+        head, tail = tag_regions.read_regions(fn)
+        entry = {"path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                 "audio": audio_fingerprint(fn, len(head), len(tail))}
+        blobs = []
+        for region, data in (("head", head), ("tail", tail)):
+            digest = hashlib.sha256(data).hexdigest()
+            entry[region] = digest
+            if not self.has_blob(digest):
+                blobs.append((digest, zlib.compress(data)))
+        return entry, blobs
+
+    def restore_file(self, root, entry, journal=None, dry_run=False):
+        """
+        Put back the tags of one file from a snapshot. The audio is not touched.
+        :param root: Root of the tree the file is in
+        :param entry: The file's snapshot entry
+        :param journal: Optional WriteJournal recording the tags replaced
+        :param dry_run: Check the file but do not write it
+        :return: A list of changes, empty if the file already has the tags
+        :raises ValueError: The file's audio is not the audio that was backed up
+        """
+        fn = entry_path(root, entry)
+        head = self.read_blob(entry["head"])
+        tail = self.read_blob(entry["tail"])
+        with tag_lock.locked(fn):
+            current = tag_regions.read_regions(fn)
+            if current == (head, tail):
+                return []
+            if audio_fingerprint(fn, len(current[0]), len(current[1])) != entry["audio"]:
+                raise ValueError("The audio is not the audio that was backed up")
+            if not dry_run:
+                if journal:
+                    journal.begin(fn, ["restored"])
+                tag_regions.replace_regions(fn, head, tail)
+        return ["restored"]
@@ -0,0 +1,109 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import tag_formats
+
+
+class TagCache():
+    """
+    Thread safe cache of parsed tag records (see tag_formats). An entry is
+    only used while the file's size and modification time are unchanged,
+    so files changed by other programs are re-read automatically.
+    """
+    def __init__(self, max_entries=100000, loader=tag_formats.read_record):
+        """
+        :param max_entries: Least recently used entries beyond this are dropped
+        :param loader: Called as loader(fn) to parse a file on a cache miss
+        """
+        self._max_entries = max_entries
+        self._loader = loader
+        self._lock = threading.Lock()
+        # path -> (stat key, record)
+        self._entries = OrderedDict()
+        # path -> Future for loads in progress, so concurrent
+        # requests for the same file parse it only once
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, fn):
+        """
+        Get a file's tag record, parsing the file if necessary
+        :param fn: File path
+        :return: A dict of frame key to value. Do not modify it.
+        """
+        key = _stat_key(fn)
+        with self._lock:
+            entry = self._entries.get(fn)
+            if entry and entry[0] == key:
+                self._entries.move_to_end(fn)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            future = self._loading.get(fn)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[fn] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            record = self._loader(fn)
+        except BaseException as ex:
+            with self._lock:
+                del self._loading[fn]
+            future.set_exception(ex)
+            raise
+        self.put(fn, record, key=key)
+        with self._lock:
+            del self._loading[fn]
+        future.set_result(record)
+        return record
+
+    def put(self, fn, record, key=None):
+        """
+        Store a record, e.g. after the file has been written
+        :param fn: File path
+        :param record: The file's tag record
+        :param key: The file's stat key when the record was read, default the current one
+        :return: None
+        """
+        if key is None:
+            key = _stat_key(fn)
+        with self._lock:
+            self._entries[fn] = (key, record)
+            self._entries.move_to_end(fn)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, fn):
+        with self._lock:
+            self._entries.pop(fn, None)
+
+
+def _stat_key(fn):
+    st = os.stat(fn)
+    return st.st_size, st.st_mtime_ns
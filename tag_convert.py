@@ -0,0 +1,164 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import mutagen.apev2
+import mutagen.id3
+import tag_lock
+import tag_records
+import tag_regions
+
+# Text encodings by the names used on the command line
+ENCODINGS = {
+    "latin1": mutagen.id3.Encoding.LATIN1,
+    "utf16": mutagen.id3.Encoding.UTF16,
+    "utf16be": mutagen.id3.Encoding.UTF16BE,
+    "utf8": mutagen.id3.Encoding.UTF8,
+}
+
+_ENCODING_NAMES = {int(v): k for k, v in ENCODINGS.items()}
+
+# ID3v2.3 only knows about latin1 and utf16
+V23_ENCODINGS = ("latin1", "utf16")
+
+
+def tail_tags(fn):
+    """
+    Look for tags appended to the end of a file
+    :param fn: File to be checked
+    :return: A 2-tuple of booleans (has ID3v1, has APEv2)
+    """
+    with open(fn, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        v1, ape = tag_regions.tail_tags(f, f.tell())
+    return v1 is not None, ape is not None
+
+
+class ConvertOptions():
+    """
+    What a file should look like after conversion
+    """
+    def __init__(self, version=4, encoding="utf16", strip_v1=False, strip_ape=False):
+        """
+        :param version: ID3v2 minor version, 3 or 4
+        :param encoding: A key of ENCODINGS
+        :param strip_v1: Remove any ID3v1 tag
+        :param strip_ape: Remove any APEv2 tag
+        """
+        if version not in (3, 4):
+            raise ValueError("ID3v2 version must be 3 or 4")
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding {0}".format(encoding))
+        if version == 3 and encoding not in V23_ENCODINGS:
+            raise ValueError("ID3v2.3 does not support {0}".format(encoding))
+        self.version = version
+        self.encoding = encoding
+        self.strip_v1 = strip_v1
+        self.strip_ape = strip_ape
+
+
+def plan_conversion(fn, options, id3=None):
+    """
+    Work out what has to change in a file without changing it
+    :param fn: File to be checked
+    :param options: A ConvertOptions instance
+    :param id3: Already loaded tags for fn, if available
+    :return: A list of human readable changes. Empty if the file already conforms.
+    """
+    changes = []
+    if id3 is None:
+        id3 = tag_records.load_id3(fn)
+
+    # A file with no tags at all is left alone (there is nothing to convert)
+    if id3.filename is not None and id3.version[:2] != (2, options.version):
+        changes.append("ID3v{0} -> ID3v2.{1}".format(".".join(str(v) for v in id3.version[:2]),
+                                                       options.version))
+
+    target = ENCODINGS[options.encoding]
+    for frame in id3.values():
+        encoding = getattr(frame, "encoding", None)
+        if encoding is not None and encoding != target and _encodable(frame, options.encoding):
+            changes.append("{0} encoding {1} -> {2}".format(frame.HashKey, _ENCODING_NAMES[encoding],
+                                                            options.encoding))
+
+    has_v1, has_ape = tail_tags(fn)
+    if options.strip_v1 and has_v1:
+        changes.append("strip ID3v1")
+    if options.strip_ape and has_ape:
+        changes.append("strip APEv2")
+    return changes
+
+
+def convert_file(fn, options, journal=None):
+    """
+    Normalize a file's tags. Nothing is written if the file already conforms.
+    :param fn: File to be converted
+    :param options: A ConvertOptions instance
+    :param journal: Optional WriteJournal recording the original tags
+    :return: The list of changes made (see plan_conversion)
+    """
+    with tag_lock.locked(fn):
+        id3 = tag_records.load_id3(fn)
+        changes = plan_conversion(fn, options, id3=id3)
+        if not changes:
+            return changes
+        if journal:
+            journal.begin(fn, changes)
+
+        # APEv2 goes first. It sits at the end of the file so it does
+        # not move the ID3v2 tag at the front.
+        if options.strip_ape and "strip APEv2" in changes:
+            mutagen.apev2.delete(fn)
+
+        if id3.filename is None:
+            # No ID3v2 tag to rewrite, only a trailing ID3v1 tag to remove
+            if "strip ID3v1" in changes:
+                tag_regions.remove_id3v1(fn)
+            return changes
+
+        target = ENCODINGS[options.encoding]
+        for frame in id3.values():
+            if getattr(frame, "encoding", None) is not None and _encodable(frame, options.encoding):
+                frame.encoding = target
+        if options.version == 3:
+            id3.update_to_v23()
+        else:
+            id3.update_to_v24()
+
+        # v1=1 keeps an ID3v1 tag if it is there. mutagen only finds one
+        # at the very end of the file, so it is removed separately.
+        id3.save(fn, v1=1, v2_version=options.version)
+        if "strip ID3v1" in changes:
+            tag_regions.remove_id3v1(fn)
+        return changes
+
+
+def _encodable(frame, encoding):
+    """
+    Latin1 cannot hold every string. Frames that do not fit keep their
+    current (unicode) encoding rather than losing characters.
+    """
+    if encoding != "latin1":
+        return True
+    try:
+        for text in getattr(frame, "text", []):
+            str(text).encode("latin1")
+        for attr in ("desc", "owner"):
+            str(getattr(frame, attr, "")).encode("latin1")
+    except UnicodeEncodeError:
+        return False
+    return True
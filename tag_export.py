@@ -0,0 +1,120 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Export and import of tags as CSV or JSON Lines. Both directions stream
+# one record per file, so memory use does not depend on the number of files.
+#
+# CSV: a header row of "path" followed by frame keys, then one row per file.
+# An empty cell means the file has no such frame.
+# JSON Lines: one object per line, {"path": ..., "TALB": ..., ...}.
+# Frames the file does not have are left out.
+#
+# Paths are written relative to the exported directory.
+#
+# Import only ever sets values. Empty or missing values are ignored,
+# they do not delete frames.
+#
+
+import csv
+import json
+import os
+import id3frames
+import io_scheduler
+import library_scan
+import tag_formats
+import tag_lock
+
+FORMATS = ("csv", "jsonl")
+
+
+def export_tags(root, out, frames=None, fmt="csv", workers=library_scan.DEFAULT_WORKERS):
+    """
+    Write one record per file in a directory tree. Records are written
+    in the order the files are read, which is not necessarily sorted.
+    :param root: Directory to export
+    :param out: Text file to write to (opened with newline="" for CSV)
+    :param frames: List of frame keys to export, default all of id3frames.frame_keys()
+    :param fmt: "csv" or "jsonl"
+    :param workers: Number of worker threads
+    :return: A generator of (path, error) 2-tuples for files that could not be read
+    """
+    frames = frames or id3frames.frame_keys()
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(["path"] + frames)
+
+    files = library_scan.scan_files(root, filter_regex=tag_formats.file_filter())
+    for fn, record, error in library_scan.parallel_map(io_scheduler.default().throttled(tag_formats.read_record),
+                                                          files, workers=workers):
+        if error:
+            yield fn, error
+            continue
+        path = os.path.relpath(fn, root)
+        if fmt == "csv":
+            writer.writerow([path] + [record.get(k, "") for k in frames])
+        else:
+            obj = {"path": path}
+            for k in frames:
+                if k in record:
+                    obj[k] = record[k]
+            out.write(json.dumps(obj, ensure_ascii=False) + "\n")
+
+
+def read_records(inp, root, fmt="csv"):
+    """
+    Read exported records one at a time
+    :param inp: Text file to read from (opened with newline="" for CSV)
+    :param root: Directory that relative paths are relative to
+    :param fmt: "csv" or "jsonl"
+    :return: A generator of (file path, [(frame key, value), ...]) 2-tuples
+    """
+    keys = id3frames.frame_keys()
+    if fmt == "csv":
+        reader = csv.reader(inp)
+        header = next(reader, None)
+        if not header or header[0] != "path":
+            raise ValueError("CSV header must start with path")
+        for k in header[1:]:
+            if k not in keys:
+                raise ValueError("Unknown frame {0} in CSV header".format(k))
+        frames = header[1:]
+        for row in reader:
+            if not row:
+                continue
+            values = [(k, v) for k, v in zip(frames, row[1:]) if v != ""]
+            yield os.path.join(root, row[0]), values
+    else:
+        for line in inp:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            path = obj.pop("path")
+            values = [(k, v) for k, v in obj.items() if k in keys and v != ""]
+            yield os.path.join(root, path), values
+
+
+def import_record(record, journal=None, dry_run=False):
+    """
+    Apply one imported record. Only frames whose value differs are
+    changed and the file is written only if something changed.
+    :param record: A (file path, values) 2-tuple from read_records
+    :param journal: Optional WriteJournal recording the original tags
+    :param dry_run: Work out the changes but do not write them
+    :return: A list of changes
+    """
+    fn, values = record
+    with tag_lock.locked(fn):
+        return tag_formats.set_file_values(fn, values, journal=journal, dry_run=dry_run)
@@ -0,0 +1,680 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Tags of files that are not mp3 files. FLAC and Ogg (Vorbis and Opus)
+# files have Vorbis comments, MP4 (m4a) files have ilst atoms. Their
+# values are mapped to the ID3 frame keys of id3frames, so records (see
+# tag_records) look the same whatever the format of the file.
+#
+# Reading a record only parses the metadata: the FLAC metadata blocks,
+# the first two Ogg packets or the MP4 moov atom, read through a
+# tag_regions.CoalescedReader. Writing goes through mutagen.
+#
+# Each format is a TagFormat registered for its file name extensions
+# (see register). Files with other extensions are mp3 files with ID3
+# tags, handled by tag_records. read_record and set_file_values work for
+# every format.
+#
+
+import io
+import os
+import re
+import struct
+from collections import OrderedDict
+import mutagen.flac
+import mutagen.id3
+import mutagen.mp4
+import mutagen.oggopus
+import mutagen.oggvorbis
+import id3frames
+import tag_records
+import tag_regions
+
+ID3_EXTENSIONS = (".mp3",)
+
+# Vorbis comment name of each frame key
+_VORBIS_NAMES = OrderedDict([
+    ("COMM", "COMMENT"),
+    ("TALB", "ALBUM"),
+    ("TBPM", "BPM"),
+    ("TCON", "GENRE"),
+    ("TCOP", "COPYRIGHT"),
+    ("TDRC", "DATE"),
+    ("TIT1", "GROUPING"),
+    ("TIT2", "TITLE"),
+    ("TIT3", "SUBTITLE"),
+    ("TPE1", "ARTIST"),
+    ("TPE2", "ALBUMARTIST"),
+    ("TPE3", "CONDUCTOR"),
+    ("TPE4", "REMIXER"),
+    ("TPOS", "DISCNUMBER"),
+    ("TRCK", "TRACKNUMBER"),
+])
+# Vorbis comment name -> frame key, with names other programs use
+_VORBIS_KEYS = dict((name, key) for key, name in _VORBIS_NAMES.items())
+_VORBIS_KEYS.update({"ALBUM ARTIST": "TPE2", "DESCRIPTION": "COMM", "YEAR": "TDRC"})
+# Totals kept apart from the track and disc numbers, shown as "number/total"
+_VORBIS_TOTALS = {"TRACKTOTAL": "TRCK", "TOTALTRACKS": "TRCK", "DISCTOTAL": "TPOS", "TOTALDISCS": "TPOS"}
+
+# MP4 item name of each frame key. The keys without an iTunes atom are
+# freeform items, named like the Vorbis comments.
+_FREEFORM = "----:com.apple.iTunes:"
+_MP4_NAMES = OrderedDict([
+    ("COMM", "\xa9cmt"),
+    ("TALB", "\xa9alb"),
+    ("TBPM", "tmpo"),
+    ("TCON", "\xa9gen"),
+    ("TCOP", "cprt"),
+    ("TDRC", "\xa9day"),
+    ("TIT1", "\xa9grp"),
+    ("TIT2", "\xa9nam"),
+    ("TIT3", _FREEFORM + "SUBTITLE"),
+    ("TPE1", "\xa9ART"),
+    ("TPE2", "aART"),
+    ("TPE3", _FREEFORM + "CONDUCTOR"),
+    ("TPE4", _FREEFORM + "REMIXER"),
+    ("TPOS", "disk"),
+    ("TRCK", "trkn"),
+])
+_MP4_KEYS = dict((name, key) for key, name in _MP4_NAMES.items())
+# Number pairs, shown as "number/total"
+_MP4_PAIRS = ("trkn", "disk")
+
+# Bytes read from the end of an Ogg file for its last page
+_OGG_TAIL = 64 * 1024
+
+
+def _vorbis_record(comments):
+    """
+    :param comments: Iterable of (name, value) Vorbis comments
+    :return: A dict of frame key to text value
+    """
+    record = {}
+    totals = {}
+    for name, value in comments:
+        name = name.upper()
+        if name in _VORBIS_TOTALS:
+            totals.setdefault(_VORBIS_TOTALS[name], value)
+            continue
+        key = _VORBIS_KEYS.get(name)
+        if key and key not in record and value:
+            record[key] = value
+    for key, total in totals.items():
+        if key in record and "/" not in record[key] and total:
+            record[key] += "/" + total
+    return record
+
+
+def parse_vorbis_comment(data):
+    """
+    :param data: A Vorbis comment block, without any framing
+    :return: A list of (NAME, value) 2-tuples, names in upper case
+    """
+    try:
+        vendor_length, = struct.unpack_from("<I", data, 0)
+        pos = 4 + vendor_length
+        count, = struct.unpack_from("<I", data, pos)
+        pos += 4
+        comments = []
+        for _ in range(count):
+            length, = struct.unpack_from("<I", data, pos)
+            pos += 4
+            name, sep, value = data[pos:pos + length].decode("utf-8", "replace").partition("=")
+            pos += length
+            if sep:
+                comments.append((name.upper(), value))
+    except struct.error:
+        raise ValueError("Truncated Vorbis comment")
+    return comments
+
+
+def _picture_size(comments):
+    # Base64 encoded METADATA_BLOCK_PICTURE comments
+    return sum(len(value) * 3 // 4 for name, value in comments if name == "METADATA_BLOCK_PICTURE")
+
+
+class TagFormat():
+    """
+    A file format with its own kind of tags. Subclasses parse the
+    metadata themselves (see parse) and map mutagen's tags for writing.
+    """
+    # Format name, e.g. "flac"
+    name = None
+    # File name extensions, lower case with the dot
+    extensions = ()
+
+    def read_record(self, fn):
+        """
+        :param fn: File path
+        :return: A dict of frame key to text value (empty if the file has no tags)
+        """
+        return self.read_info(fn)["record"]
+
+    def read_info(self, fn):
+        """
+        :param fn: File path
+        :return: A dict with record (see read_record), duration in seconds
+        (None if unknown) and artwork_size in bytes
+        """
+        with tag_regions.CoalescedReader(fn) as f:
+            return self.parse(f)
+
+    def parse(self, f):
+        """
+        Read a file's metadata
+        :param f: Seekable binary file object
+        :return: See read_info
+        :raises ValueError: The file is not in this format
+        """
+        raise NotImplementedError
+
+    def load(self, fn):
+        """
+        :param fn: File path
+        :return: The mutagen file object, with tags (added if it had none)
+        """
+        raise NotImplementedError
+
+    def tags_record(self, tags):
+        """
+        :param tags: The tags of a mutagen file object from load
+        :return: A dict of frame key to text value
+        """
+        raise NotImplementedError
+
+    def set_tag(self, tags, key, value):
+        """
+        Change a value in the tags of a mutagen file object
+        :param tags: The tags
+        :param key: Frame key
+        :param value: New text value, None to remove it
+        :return: False if the key has no equivalent in this format
+        """
+        raise NotImplementedError
+
+    def set_values(self, fn, values, journal=None, dry_run=False, where=None, remove=()):
+        """
+        Set frame values in a file's tags (see tag_records.set_values). The
+        file is written only if a value actually changes.
+        :param fn: File path
+        :param values: Iterable of (frame key, value) 2-tuples
+        :param journal: Optional WriteJournal recording the old values
+        :param dry_run: Work out the changes but do not write them
+        :param where: Optional function of the file's record, the file is
+        only changed if it returns True
+        :param remove: Frame keys to remove
+        :return: None if where rejected the file, otherwise a list of changes
+        """
+        audio = self.load(fn)
+        record = self.tags_record(audio.tags)
+        if where and not where(record):
+            return None
+        changes = []
+        # The value of each changed key before the first change, None if it had none
+        old_values = {}
+        for key, new in values:
+            old = record.get(key)
+            if old == new or not self.set_tag(audio.tags, key, new):
+                continue
+            old_values.setdefault(key, old)
+            record[key] = new
+            changes.append(tag_records.format_change(key, old, new))
+        for key in remove:
+            if key in record and self.set_tag(audio.tags, key, None):
+                old_values.setdefault(key, record[key])
+                changes.append("{0}: {1} -> (none)".format(key, record.pop(key)))
+
+        if changes and not dry_run:
+            if journal:
+                journal.begin_values(fn, changes, old_values)
+            audio.save()
+        return changes
+
+
+class VorbisCommentFormat(TagFormat):
+    """
+    Formats with Vorbis comments
+    """
+    def tags_record(self, tags):
+        return _vorbis_record(tags)
+
+    def set_tag(self, tags, key, value):
+        name = _VORBIS_NAMES.get(key)
+        if name is None:
+            return False
+        for other, other_key in list(_VORBIS_KEYS.items()) + list(_VORBIS_TOTALS.items()):
+            if other_key == key and other in tags:
+                del tags[other]
+        if value is not None:
+            number, sep, total = value.partition("/")
+            if sep and name in ("TRACKNUMBER", "DISCNUMBER"):
+                tags[name] = [number]
+                tags[name.replace("NUMBER", "TOTAL")] = [total]
+            else:
+                tags[name] = [value]
+        return True
+
+
+def _flac_picture_size(block):
+    # Type, MIME type, description, 16 bytes of dimensions, then the data
+    try:
+        mime_length, = struct.unpack_from(">I", block, 4)
+        description_length, = struct.unpack_from(">I", block, 8 + mime_length)
+        size, = struct.unpack_from(">I", block, 12 + mime_length + description_length + 16)
+    except struct.error:
+        return 0
+    return size
+
+
+class FlacFormat(VorbisCommentFormat):
+    name = "flac"
+    extensions = (".flac",)
+
+    def parse(self, f):
+        # Some programs put an ID3v2 tag in front
+        start = tag_regions.id3v2_size(f.read(tag_regions.ID3V2_HEADER_SIZE))
+        f.seek(start)
+        if f.read(4) != b"fLaC":
+            raise ValueError("Not a FLAC file")
+        comments = []
+        duration = None
+        artwork_size = 0
+        last = False
+        while not last:
+            header = f.read(4)
+            if len(header) < 4:
+                raise ValueError("Truncated FLAC metadata")
+            last = bool(header[0] & 0x80)
+            block_type = header[0] & 0x7f
+            length = int.from_bytes(header[1:], "big")
+            if block_type == 0:
+                # STREAMINFO: 20 bit sample rate and 36 bit sample count
+                info = f.read(length)
+                bits = int.from_bytes(info[10:18], "big")
+                rate = bits >> 44
+                samples = bits & 0xfffffffff
+                if rate and samples:
+                    duration = samples / rate
+            elif block_type == 4:
+                comments = parse_vorbis_comment(f.read(length))
+            elif block_type == 6:
+                artwork_size += _flac_picture_size(f.read(length))
+            else:
+                f.seek(length, os.SEEK_CUR)
+        return {"record": _vorbis_record(comments), "duration": duration,
+                "artwork_size": artwork_size + _picture_size(comments)}
+
+    def load(self, fn):
+        audio = mutagen.flac.FLAC(fn)
+        if audio.tags is None:
+            audio.add_tags()
+        return audio
+
+
+def _ogg_packets(f, count):
+    """
+    :param f: Ogg file
+    :param count: Number of packets
+    :return: A 2-tuple (first count packets of the first stream, its serial number)
+    """
+    packets = []
+    partial = []
+    serial = None
+    while len(packets) < count:
+        header = f.read(27)
+        if len(header) < 27 or header[:4] != b"OggS":
+            raise ValueError("Not an Ogg page")
+        page_serial, = struct.unpack_from("<I", header, 14)
+        lacing = f.read(header[26])
+        body = f.read(sum(lacing))
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            # Another stream
+            continue
+        pos = 0
+        for size in lacing:
+            partial.append(body[pos:pos + size])
+            pos += size
+            if size < 255:
+                packets.append(b"".join(partial))
+                partial = []
+                if len(packets) == count:
+                    break
+    return packets, serial
+
+
+def _ogg_last_granule(f, serial):
+    """
+    :return: The granule position of the last page of a stream, None if it is not found
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - _OGG_TAIL))
+    data = f.read()
+    pos = data.rfind(b"OggS")
+    while pos >= 0:
+        if pos + 27 <= len(data):
+            granule, page_serial = struct.unpack_from("<qI", data, pos + 6)
+            if page_serial == serial and granule >= 0:
+                return granule
+        pos = data.rfind(b"OggS", 0, pos)
+    return None
+
+
+class OggFormat(VorbisCommentFormat):
+    name = "ogg"
+    extensions = (".ogg", ".oga", ".opus")
+
+    def parse(self, f):
+        (ident, comment), serial = _ogg_packets(f, 2)
+        if ident.startswith(b"\x01vorbis") and comment.startswith(b"\x03vorbis"):
+            rate, = struct.unpack_from("<I", ident, 12)
+            skip = 0
+            comments = parse_vorbis_comment(comment[7:])
+        elif ident.startswith(b"OpusHead") and comment.startswith(b"OpusTags"):
+            # Opus positions are always in 48 kHz samples
+            rate = 48000
+            skip, = struct.unpack_from("<H", ident, 10)
+            comments = parse_vorbis_comment(comment[8:])
+        else:
+            raise ValueError("Not an Ogg Vorbis or Opus file")
+        granule = _ogg_last_granule(f, serial)
+        duration = max(0, granule - skip) / rate if granule is not None and rate else None
+        return {"record": _vorbis_record(comments), "duration": duration,
+                "artwork_size": _picture_size(comments)}
+
+    def load(self, fn):
+        with open(fn, "rb") as f:
+            opus = f.read(64).find(b"OpusHead") >= 0
+        audio = mutagen.oggopus.OggOpus(fn) if opus else mutagen.oggvorbis.OggVorbis(fn)
+        if audio.tags is None:
+            audio.add_tags()
+        return audio
+
+
+def _mp4_atoms(f, start, end):
+    """
+    :return: A generator of (name, start of data, end) 3-tuples of the atoms
+    between two offsets
+    """
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, name = struct.unpack(">I4s", f.read(8))
+        offset = 8
+        if size == 1:
+            size, = struct.unpack(">Q", f.read(8))
+            offset = 16
+        elif size == 0:
+            # Up to the end of the file
+            size = end - pos
+        if size < offset or pos + size > end:
+            raise ValueError("Bad MP4 atom {0!r}".format(name))
+        yield name, pos + offset, pos + size
+        pos += size
+
+
+def _mp4_child(f, start, end, name):
+    for child, child_start, child_end in _mp4_atoms(f, start, end):
+        if child == name:
+            return child_start, child_end
+    return None
+
+
+def _mp4_text(name, value):
+    """
+    :param name: Item name, e.g. "trkn"
+    :param value: A value of the item as mutagen or parse_ilst has it
+    :return: The value as text
+    """
+    if name in _MP4_PAIRS:
+        number, total = value
+        return "{0}/{1}".format(number, total) if total else str(number)
+    if isinstance(value, bytes):
+        # Freeform values
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+def _mp4_record(items):
+    """
+    :param items: Iterable of (item name, value) 2-tuples
+    :return: A dict of frame key to text value
+    """
+    record = {}
+    for name, value in items:
+        key = _MP4_KEYS.get(name)
+        if key is None and name.startswith("----:"):
+            key = _VORBIS_KEYS.get(name.rsplit(":", 1)[1].upper())
+        if key and key not in record:
+            text = _mp4_text(name, value)
+            if text:
+                record[key] = text
+    return record
+
+
+def parse_ilst(data):
+    """
+    :param data: The contents of an ilst atom
+    :return: A 2-tuple (list of (item name, value) 2-tuples, size of the artwork)
+    """
+    f = io.BytesIO(data)
+    items = []
+    artwork_size = 0
+    for atom, start, end in _mp4_atoms(f, 0, len(data)):
+        name = atom.decode("latin-1")
+        mean = ""
+        for child, child_start, child_end in _mp4_atoms(f, start, end):
+            payload = data[child_start:child_end]
+            if child in (b"mean", b"name"):
+                # After 4 bytes of version and flags
+                text = payload[4:].decode("utf-8", "replace")
+                if child == b"mean":
+                    mean = text
+                else:
+                    name = "----:{0}:{1}".format(mean, text)
+                continue
+            if child != b"data" or len(payload) < 8:
+                continue
+            data_type = int.from_bytes(payload[1:4], "big")
+            value = payload[8:]
+            if name == "covr":
+                artwork_size += len(value)
+            elif name in _MP4_PAIRS:
+                if len(value) >= 6:
+                    items.append((name, struct.unpack_from(">HH", value, 2)))
+            elif name == "gnre":
+                if len(value) == 2:
+                    genre, = struct.unpack(">H", value)
+                    if 0 < genre <= len(mutagen.id3.TCON.GENRES):
+                        items.append(("\xa9gen", mutagen.id3.TCON.GENRES[genre - 1]))
+            elif data_type == 21 and value:
+                items.append((name, int.from_bytes(value, "big", signed=True)))
+            elif data_type == 1 or name.startswith("----:"):
+                items.append((name, value.decode("utf-8", "replace")))
+            elif data_type == 2:
+                items.append((name, value.decode("utf-16-be", "replace")))
+    return items, artwork_size
+
+
+class Mp4Format(TagFormat):
+    name = "mp4"
+    extensions = (".m4a", ".m4b", ".mp4")
+
+    def parse(self, f):
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        moov = _mp4_child(f, 0, size, b"moov")
+        if moov is None:
+            raise ValueError("Not an MP4 file")
+        duration = None
+        mvhd = _mp4_child(f, moov[0], moov[1], b"mvhd")
+        if mvhd:
+            f.seek(mvhd[0])
+            header = f.read(32)
+            if header[0] == 1:
+                timescale, length = struct.unpack_from(">IQ", header, 20)
+            else:
+                timescale, length = struct.unpack_from(">II", header, 12)
+            if timescale:
+                duration = length / timescale
+        items = []
+        artwork_size = 0
+        udta = _mp4_child(f, moov[0], moov[1], b"udta")
+        meta = udta and _mp4_child(f, udta[0], udta[1], b"meta")
+        if meta:
+            # A full atom: 4 bytes of version and flags before the children,
+            # except in QuickTime files
+            f.seek(meta[0])
+            start = meta[0] if f.read(8)[4:] == b"hdlr" else meta[0] + 4
+            ilst = _mp4_child(f, start, meta[1], b"ilst")
+            if ilst:
+                f.seek(ilst[0])
+                items, artwork_size = parse_ilst(f.read(ilst[1] - ilst[0]))
+        return {"record": _mp4_record(items), "duration": duration, "artwork_size": artwork_size}
+
+    def load(self, fn):
+        audio = mutagen.mp4.MP4(fn)
+        if audio.tags is None:
+            audio.add_tags()
+        return audio
+
+    def tags_record(self, tags):
+        return _mp4_record((name, value) for name, values in tags.items() for value in values)
+
+    def set_tag(self, tags, key, value):
+        name = _MP4_NAMES.get(key)
+        if name is None:
+            return False
+        if value is None:
+            tags.pop(name, None)
+        elif name in _MP4_PAIRS:
+            number, sep, total = value.partition("/")
+            tags[name] = [(int(number), int(total) if total else 0)]
+        elif name == "tmpo":
+            tags[name] = [int(value)]
+        elif name.startswith("----:"):
+            tags[name] = [mutagen.mp4.MP4FreeForm(value.encode("utf-8"))]
+        else:
+            tags[name] = [value]
+        return True
+
+
+# Extension -> TagFormat
+_formats = OrderedDict()
+
+
+def register(tag_format):
+    """
+    Use a format for the files with its extensions
+    :param tag_format: A TagFormat instance
+    :return: None
+    """
+    for extension in tag_format.extensions:
+        _formats[extension] = tag_format
+
+
+register(FlacFormat())
+register(OggFormat())
+register(Mp4Format())
+
+
+def format_for(fn):
+    """
+    :param fn: File path
+    :return: The TagFormat of the file, None for an mp3 file
+    """
+    return _formats.get(os.path.splitext(fn)[1].lower())
+
+
+def is_id3(fn):
+    return format_for(fn) is None
+
+
+def extensions():
+    """
+    :return: The extensions of every supported file, with the dot
+    """
+    return ID3_EXTENSIONS + tuple(_formats)
+
+
+def file_filter():
+    """
+    :return: A file name regex matching every supported file (see library_scan.scan_files)
+    """
+    return r".+\.({0})$".format("|".join(re.escape(e[1:]) for e in extensions()))
+
+
+def read_record(fn):
+    """
+    Read the frame values of a file of any supported format
+    :param fn: File path
+    :return: A dict of frame key to text value (empty if the file has no tags)
+    """
+    tag_format = format_for(fn)
+    if tag_format is None:
+        return tag_records.read_record(fn)
+    return tag_format.read_record(fn)
+
+
+def set_file_values(fn, values, journal=None, dry_run=False, where=None):
+    """
+    Set frame values in a file of any supported format. The caller holds
+    the file's lock (see tag_lock.locked).
+    :param fn: File path
+    :param values: Iterable of (frame key, value) 2-tuples
+    :param journal: Optional WriteJournal recording the original tags (the
+    old values of the changed frames of files that are not mp3 files)
+    :param dry_run: Work out the changes but do not write them
+    :param where: Optional function of the file's record, the file is only
+    changed if it returns True
+    :return: None if where rejected the file, otherwise a list of changes
+    """
+    tag_format = format_for(fn)
+    if tag_format is not None:
+        return tag_format.set_values(fn, values, journal=journal, dry_run=dry_run, where=where)
+    id3 = tag_records.load_id3(fn)
+    if where and not where(tag_records.record_from_id3(id3)):
+        return None
+    return tag_records.set_values(fn, id3, values, journal=journal, dry_run=dry_run)
+
+
+def save_record(fn, record):
+    """
+    Make the tags of a file that is not an mp3 file match a record:
+    values in the record are set and the other values removed
+    :param fn: File path
+    :param record: A dict of frame key to text value
+    :return: The list of changes
+    """
+    tag_format = format_for(fn)
+    return tag_format.set_values(fn, sorted(record.items()),
+                                 remove=[k for k in id3frames.frame_keys() if k not in record])
+
+
+def id3_from_record(record):
+    """
+    Tags for the tags widget from the record of a file that is not an mp3 file
+    :param record: A dict of frame key to text value
+    :return: A mutagen.id3.ID3 instance
+    """
+    id3 = mutagen.id3.ID3()
+    for key, value in record.items():
+        frame = id3frames.create(key, value)
+        if frame is not None:
+            id3.add(frame)
+    return id3
@@ -0,0 +1,295 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Validation of tags. Each rule checks one kind of problem and returns
+# findings. Findings of mechanical problems carry a fix that can be
+# applied to the loaded tags.
+#
+
+import datetime
+import re
+from collections import OrderedDict
+import tag_lock
+import tag_records
+import tag_regions
+
+# Padding above this is reported by the padding rule
+DEFAULT_MAX_PADDING = 64 * 1024
+# Padding left by the padding rule's fix
+DEFAULT_TARGET_PADDING = 1024
+
+_NUMBER_PAIR = re.compile(r"^\d+(/\d+)?$")
+# A number (and total) somewhere in a malformed value, e.g. "03 of 12", "7."
+_LOOSE_NUMBER_PAIR = re.compile(r"^\D*?(\d+)(?:\s*(?:/|of)\s*(\d+))?\D*$", re.IGNORECASE)
+_TIMESTAMP_FORMATS = {
+    4: "%Y",
+    7: "%Y-%m",
+    10: "%Y-%m-%d",
+    13: "%Y-%m-%dT%H",
+    16: "%Y-%m-%dT%H:%M",
+    19: "%Y-%m-%dT%H:%M:%S",
+}
+_YEAR = re.compile(r"\b(\d{4})\b")
+
+
+class Finding():
+    """
+    A problem found in a file
+    """
+    def __init__(self, rule, message, fix=None):
+        """
+        :param rule: Name of the rule that found it
+        :param message: Description of the problem
+        :param fix: Called as fix(id3) to correct the loaded tags, None if
+        the problem cannot be fixed automatically
+        """
+        self.rule = rule
+        self.message = message
+        self.fix = fix
+        self.fixed = False
+
+    @property
+    def fixable(self):
+        return self.fix is not None
+
+
+class LintOptions():
+    """
+    Settings of a lint run
+    """
+    def __init__(self, rules=None, max_padding=DEFAULT_MAX_PADDING, target_padding=DEFAULT_TARGET_PADDING):
+        """
+        :param rules: Names of the rules to run, default all of RULES
+        :param max_padding: Padding above this is a problem
+        :param target_padding: Padding left when too much padding is fixed
+        """
+        rules = list(rules or RULES.keys())
+        for name in rules:
+            if name not in RULES:
+                raise ValueError("Unknown rule {0}".format(name))
+        self.rules = rules
+        self.max_padding = max_padding
+        self.target_padding = target_padding
+
+
+class _Context():
+    """
+    What the rules look at. The padding is only measured if a rule asks.
+    """
+    def __init__(self, fn, id3, options):
+        self.fn = fn
+        self.id3 = id3
+        self.options = options
+        self._padding = None
+
+    @property
+    def padding(self):
+        if self._padding is None:
+            with tag_regions.CoalescedReader(self.fn) as f:
+                self._padding = tag_regions.padding_size(f)[1]
+        return self._padding
+
+
+def _check_no_tag(ctx):
+    if ctx.id3.filename is None:
+        return [Finding("no-tag", "No ID3 tag")]
+    if ctx.id3.version < (2, 2, 0):
+        return [Finding("no-tag", "Only an ID3v1 tag")]
+    return []
+
+
+def _check_number_pair(rule, key):
+    def check(ctx):
+        findings = []
+        for frame in ctx.id3.getall(key):
+            value = str(frame.text[0]) if frame.text else ""
+            if _NUMBER_PAIR.match(value):
+                continue
+            m = _LOOSE_NUMBER_PAIR.match(value)
+            fix = None
+            if m:
+                fixed = m.group(1).lstrip("0") or "0"
+                if m.group(2):
+                    fixed += "/" + (m.group(2).lstrip("0") or "0")
+                fix = _set_text(key, fixed)
+            findings.append(Finding(rule, "{0} is not a number: {1!r}".format(key, value), fix))
+        return findings
+    return check
+
+
+def _check_timestamp(ctx):
+    findings = []
+    for frame in ctx.id3.getall("TDRC"):
+        for stamp in frame.text:
+            value = str(stamp)
+            if _valid_timestamp(value):
+                continue
+            m = _YEAR.search(value)
+            fix = _fix_timestamp(m.group(1)) if m else None
+            findings.append(Finding("timestamp", "TDRC is not a valid timestamp: {0!r}".format(value), fix))
+    return findings
+
+
+def _valid_timestamp(value):
+    # mutagen separates the date and time with a space, e.g. "2001-05-03 10:20",
+    # also for the TYER/TDAT/TIME frames of v2.3 tags
+    value = value.replace(" ", "T", 1)
+    fmt = _TIMESTAMP_FORMATS.get(len(value))
+    if fmt is None:
+        return False
+    try:
+        datetime.datetime.strptime(value, fmt)
+    except ValueError:
+        return False
+    return True
+
+
+def _check_duplicate_comm(ctx):
+    findings = []
+    seen = set()
+    # English first, it is the comment kept
+    for frame in sorted(ctx.id3.getall("COMM"), key=lambda f: f.lang != "eng"):
+        if len(frame.text) > 1:
+            # Frames with the same description and language are merged into one when loaded
+            findings.append(Finding("duplicate-comm",
+                                    "{0} frames with description {1!r}".format(len(frame.text), frame.desc),
+                                    _keep_first_text(frame.HashKey)))
+        # Compared by description and first text (the one kept by the fix
+        # above), so only the language differs. Comments with another
+        # description, e.g. iTunNORM, are different comments even when
+        # their text is the same.
+        key = (frame.desc, str(frame.text[0]) if frame.text else "")
+        if key in seen:
+            findings.append(Finding("duplicate-comm",
+                                    "Duplicate comment {0!r} in language {1!r}".format(frame.desc, frame.lang),
+                                    _delete_frame(frame.HashKey)))
+        seen.add(key)
+    return findings
+
+
+def _check_empty_frame(ctx):
+    findings = []
+    for key, frame in ctx.id3.items():
+        if hasattr(frame, "text") and not any(str(t).strip() for t in frame.text):
+            findings.append(Finding("empty-frame", "{0} is empty".format(key), _delete_frame(key)))
+    return findings
+
+
+def _check_padding(ctx):
+    if ctx.id3.filename is None or ctx.id3.version < (2, 2, 0):
+        return []
+    padding = ctx.padding
+    if padding <= ctx.options.max_padding:
+        return []
+    # The fix is done when the tags are saved, see fix_file
+    return [Finding("padding", "{0:,} bytes of padding".format(padding), lambda id3: None)]
+
+
+def _set_text(key, value):
+    def fix(id3):
+        id3.getall(key)[0].text = [value]
+    return fix
+
+
+def _fix_timestamp(year):
+    def fix(id3):
+        frame = id3.getall("TDRC")[0]
+        # Only ever cut an invalid timestamp down to its year
+        if not all(_valid_timestamp(str(stamp)) for stamp in frame.text):
+            frame.text = [year]
+    return fix
+
+
+def _keep_first_text(hash_key):
+    def fix(id3):
+        frame = id3.get(hash_key)
+        if frame is not None:
+            frame.text = frame.text[:1]
+    return fix
+
+
+def _delete_frame(hash_key):
+    def fix(id3):
+        id3.pop(hash_key, None)
+    return fix
+
+
+# Rule name -> (description, check). A check is called with a _Context
+# and returns a list of Finding.
+RULES = OrderedDict([
+    ("no-tag", ("File has no ID3v2 tag", _check_no_tag)),
+    ("track-number", ("TRCK is not a number or number/total", _check_number_pair("track-number", "TRCK"))),
+    ("disc-number", ("TPOS is not a number or number/total", _check_number_pair("disc-number", "TPOS"))),
+    ("timestamp", ("TDRC is not a valid ID3v2.4 timestamp", _check_timestamp)),
+    ("duplicate-comm", ("Duplicated COMM frames", _check_duplicate_comm)),
+    ("empty-frame", ("Text frames without text", _check_empty_frame)),
+    ("padding", ("More padding than the limit", _check_padding)),
+])
+
+
+def check_id3(fn, id3, options):
+    """
+    Run the rules on loaded tags
+    :param fn: The file the tags came from
+    :param id3: The file's tags (see tag_records.load_id3)
+    :param options: LintOptions
+    :return: A list of Finding
+    """
+    ctx = _Context(fn, id3, options)
+    findings = []
+    for name in options.rules:
+        findings.extend(RULES[name][1](ctx))
+    return findings
+
+
+def check_file(fn, options):
+    """
+    Run the rules on a file
+    :param fn: mp3 file
+    :param options: LintOptions
+    :return: A list of Finding
+    """
+    return check_id3(fn, tag_records.load_id3(fn), options)
+
+
+def fix_file(fn, options, journal=None, dry_run=False):
+    """
+    Run the rules on a file and fix what can be fixed. The file is written
+    once, in its own ID3v2 version, if there is anything to fix.
+    :param fn: mp3 file
+    :param options: LintOptions
+    :param journal: Optional WriteJournal recording the original tags
+    :param dry_run: Find what would be fixed but do not write anything
+    :return: A list of Finding, the fixed ones have fixed set
+    """
+    with tag_lock.locked(fn):
+        id3 = tag_records.load_id3(fn)
+        findings = check_id3(fn, id3, options)
+        fixable = [f for f in findings if f.fixable]
+        if not fixable:
+            return findings
+
+        for finding in fixable:
+            finding.fix(id3)
+            finding.fixed = True
+        if not dry_run:
+            if journal:
+                journal.begin(fn, ["{0}: {1}".format(f.rule, f.message) for f in fixable])
+            padding = None
+            if any(f.rule == "padding" for f in fixable):
+                padding = lambda info: options.target_padding
+            tag_records.save_id3(fn, id3, padding=padding)
+        return findings
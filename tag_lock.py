@@ -0,0 +1,182 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Safe writes when the editor and batch jobs work on the same files.
+#
+# Every writer holds an advisory lock on the file (see locked) from the
+# time it reads the tags until they are written, so writers in any
+# process take turns. The editor keeps a file open for a long time, so it
+# does not hold the lock: it remembers the file's size and modification
+# time when the tags were loaded (see LoadedTags). If the file changed by
+# the time the tags are saved, the changes are merged frame by frame with
+# the tags now on disk (see save_checked).
+#
+# Locks are flock locks on POSIX systems. Elsewhere nothing is locked.
+#
+
+import os
+from contextlib import contextmanager
+import tag_records
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+# save_checked resolution: a frame changed in the editor and on disk is saved as in the editor
+RESOLVE_OURS = "ours"
+
+
+def stat_key(fn):
+    """
+    :param fn: File path
+    :return: A value that changes when the file is written
+    """
+    st = os.stat(fn)
+    return st.st_size, st.st_mtime_ns
+
+
+@contextmanager
+def locked(fn):
+    """
+    Context manager holding an exclusive advisory lock on a file. Files
+    replaced by a rename (see tag_regions.replace_regions) are handled:
+    the lock is always on the file that is at the path.
+    Locks are not reentrant, a file must not be locked twice by a thread.
+    :param fn: File to lock
+    """
+    if fcntl is None:
+        yield
+        return
+    while True:
+        f = open(fn, "rb")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            locked_st = os.fstat(f.fileno())
+            try:
+                st = os.stat(fn)
+            except FileNotFoundError:
+                st = None
+        except BaseException:
+            f.close()
+            raise
+        if st is not None and (st.st_dev, st.st_ino) == (locked_st.st_dev, locked_st.st_ino):
+            break
+        # Replaced while waiting for the lock, lock the new file
+        f.close()
+    try:
+        yield
+    finally:
+        # Closing releases the lock
+        f.close()
+
+
+def frame_snapshot(id3):
+    """
+    :param id3: A mutagen.id3.ID3 instance
+    :return: A dict of frame hash key (e.g. COMM::eng) to a description of
+    the frame's contents, for finding the frames that changed
+    """
+    return {key: repr(frame) for key, frame in id3.items()}
+
+
+class LoadedTags():
+    """
+    The state of a file's tags when they were loaded into the editor
+    """
+    def __init__(self, key, id3):
+        """
+        :param key: The file's stat_key, taken before the tags were read
+        :param id3: The tags as loaded, before they are changed
+        """
+        self.key = key
+        self.frames = frame_snapshot(id3)
+
+
+class ConflictError(Exception):
+    """
+    The same frames were changed in the editor and on disk
+    """
+    def __init__(self, fn, conflicts):
+        """
+        :param fn: The file
+        :param conflicts: List of (frame key, value in the editor, value on
+        disk) 3-tuples. A value is None if the frame was deleted.
+        """
+        self.fn = fn
+        self.conflicts = conflicts
+        super(ConflictError, self).__init__(
+            "{0} was changed by another program: {1}".format(fn, ", ".join(c[0] for c in conflicts)))
+
+
+def _frame_value(frame):
+    if frame is None:
+        return None
+    if getattr(frame, "text", None):
+        return str(frame.text[0])
+    return frame.pprint()
+
+
+def save_checked(fn, id3, loaded, resolve=None):
+    """
+    Save tags that were loaded earlier. If the file was not written since
+    the tags were loaded they are saved as they are. Otherwise the frames
+    changed in id3 are applied to the tags now on disk, which keep the
+    frames changed by the other program.
+    :param fn: mp3 file
+    :param id3: The changed tags
+    :param loaded: The LoadedTags of the file, updated to the saved state
+    :param resolve: How a frame changed both in id3 and on disk is saved.
+    None raises ConflictError, RESOLVE_OURS saves the frame of id3. Only
+    the conflicting frames are taken from id3, the other frames changed on
+    disk are kept either way.
+    :return: A 2-tuple (tags saved, list of frame keys taken from the disk).
+    The tags saved are id3 unless changes were merged.
+    :raises ConflictError: A frame was changed both in id3 and on disk and
+    resolve is None. Nothing is saved.
+    """
+    with locked(fn):
+        merged = []
+        if stat_key(fn) != loaded.key:
+            disk = tag_records.load_id3(fn)
+            ours = frame_snapshot(id3)
+            theirs = frame_snapshot(disk)
+            conflicts = []
+            for key in sorted(set(loaded.frames) | set(ours) | set(theirs)):
+                base = loaded.frames.get(key)
+                if ours.get(key) == base:
+                    if theirs.get(key) != base:
+                        merged.append(key)
+                    continue
+                if theirs.get(key) not in (base, ours.get(key)):
+                    conflicts.append((key, _frame_value(id3.get(key)), _frame_value(disk.get(key))))
+                    if resolve != RESOLVE_OURS:
+                        continue
+                if key in id3:
+                    disk[key] = id3[key]
+                else:
+                    disk.pop(key, None)
+            if conflicts and resolve != RESOLVE_OURS:
+                raise ConflictError(fn, conflicts)
+            if merged:
+                id3 = disk
+        tag_records.save_id3(fn, id3)
+        loaded.key = stat_key(fn)
+        # What was written, as it reads back
+        loaded.frames = frame_snapshot(tag_records.load_id3(fn))
+    return id3, merged
@@ -0,0 +1,299 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# A small query language over ID3 frames.
+#
+#     set TCON='Jazz', TIT1='Bebop' where TPE1 starts with 'Miles'
+#     where TDRC < 1970 and not TCON exists
+#     TALB contains 'live' or TIT2 matches '(?i)\blive\b'
+#
+# Frames are named by the keys in id3frames. A frame's value is the text
+# shown in the tags widget (the first text of the first matching frame).
+#
+# Conditions:
+#     FRAME = value, FRAME != value           exact comparison
+#     FRAME < value (also <=, >, >=)          numeric when both sides are numbers
+#     FRAME starts with value                 these three ignore case
+#     FRAME ends with value
+#     FRAME contains value
+#     FRAME matches 'regex'                   Python regular expression search
+#     FRAME exists, FRAME missing
+# combined with and, or, not and parentheses. Values are quoted strings
+# or bare words/numbers.
+#
+
+import re
+import id3frames
+import tag_formats
+import tag_lock
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+      | (?P<op>!=|<=|>=|=|<|>|,|\(|\))
+      | (?P<word>[^\s'"=!<>,()]+)
+    )""", re.VERBOSE)
+
+_KEYWORDS = ("set", "where", "and", "or", "not", "starts", "ends", "with",
+             "contains", "matches", "exists", "missing")
+
+_NUMBER_RE = re.compile(r"\s*(-?\d+(?:\.\d+)?)")
+
+
+class QueryError(Exception):
+    pass
+
+
+class Query():
+    """
+    A compiled query. Create with compile_query().
+    """
+    def __init__(self, text, predicate, assignments, frames):
+        """
+        :param text: The query source text
+        :param predicate: Called as predicate(record), returns True for matching records
+        :param assignments: List of (frame key, value) 2-tuples to set, empty for a search
+        :param frames: The frame keys the query refers to
+        """
+        self.text = text
+        self.predicate = predicate
+        self.assignments = assignments
+        self.frames = frames
+
+    @property
+    def is_update(self):
+        return len(self.assignments) > 0
+
+    def matches(self, record):
+        """
+        Evaluate the where clause
+        :param record: A dict of frame key to value (see tag_records)
+        :return: True if the record matches
+        """
+        return self.predicate(record)
+
+
+def compile_query(text):
+    """
+    Parse a query once into a Query that can be evaluated many times
+    :param text: Query text
+    :return: A Query instance
+    """
+    parser = _Parser(text)
+    return parser.parse()
+
+
+def _number(value):
+    # Leading number so that e.g. "3/12" (TRCK) compares as 3
+    m = _NUMBER_RE.match(value)
+    return float(m.group(1)) if m else None
+
+
+def _compare(op, left, right):
+    left_n = _number(left)
+    right_n = _number(right)
+    if left_n is not None and right_n is not None:
+        left, right = left_n, right_n
+    if op == "<":
+        return left < right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    return left >= right
+
+
+class _Parser():
+    def __init__(self, text):
+        self._text = text
+        self._tokens = self._tokenize(text)
+        self._pos = 0
+        self._frames = set()
+
+    def _tokenize(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = _TOKEN_RE.match(text, pos)
+            if not m or m.end() == pos:
+                raise QueryError("Unexpected character at position {0}: {1}".format(pos, text[pos:]))
+            pos = m.end()
+            if m.group("string"):
+                s = m.group("string")[1:-1]
+                tokens.append(("value", re.sub(r"\\(.)", r"\1", s)))
+            elif m.group("op"):
+                tokens.append(("op", m.group("op")))
+            else:
+                word = m.group("word")
+                if word.lower() in _KEYWORDS:
+                    tokens.append(("keyword", word.lower()))
+                else:
+                    tokens.append(("word", word))
+        return tokens
+
+    def _peek(self, kind=None, value=None):
+        if self._pos >= len(self._tokens):
+            return None
+        token = self._tokens[self._pos]
+        if kind and token[0] != kind:
+            return None
+        if value and token[1] != value:
+            return None
+        return token
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise QueryError("Unexpected end of query")
+        self._pos += 1
+        return token
+
+    def _expect(self, kind, value=None):
+        token = self._next()
+        if token[0] != kind or (value and token[1] != value):
+            raise QueryError("Expected {0} but found {1}".format(value or kind, token[1]))
+        return token
+
+    def parse(self):
+        assignments = []
+        if self._peek("keyword", "set"):
+            self._next()
+            assignments.append(self._assignment())
+            while self._peek("op", ","):
+                self._next()
+                assignments.append(self._assignment())
+            if self._peek("keyword", "where"):
+                self._next()
+                predicate = self._or()
+            else:
+                # No where clause updates every file
+                predicate = lambda record: True
+        else:
+            if self._peek("keyword", "where"):
+                self._next()
+            predicate = self._or()
+        if self._peek():
+            raise QueryError("Unexpected {0}".format(self._peek()[1]))
+        return Query(self._text, predicate, assignments, sorted(self._frames))
+
+    def _frame(self):
+        token = self._next()
+        key = token[1].upper()
+        if token[0] != "word" or key not in id3frames.frame_keys():
+            raise QueryError("Unknown frame {0}".format(token[1]))
+        self._frames.add(key)
+        return key
+
+    def _value(self):
+        token = self._next()
+        if token[0] not in ("value", "word"):
+            raise QueryError("Expected a value but found {0}".format(token[1]))
+        return token[1]
+
+    def _assignment(self):
+        key = self._frame()
+        if id3frames.create(key, "") is None:
+            raise QueryError("{0} cannot be set".format(key))
+        self._expect("op", "=")
+        return key, self._value()
+
+    def _or(self):
+        left = self._and()
+        while self._peek("keyword", "or"):
+            self._next()
+            right = self._and()
+            left = (lambda a, b: lambda r: a(r) or b(r))(left, right)
+        return left
+
+    def _and(self):
+        left = self._not()
+        while self._peek("keyword", "and"):
+            self._next()
+            right = self._not()
+            left = (lambda a, b: lambda r: a(r) and b(r))(left, right)
+        return left
+
+    def _not(self):
+        if self._peek("keyword", "not"):
+            self._next()
+            operand = self._not()
+            return lambda r: not operand(r)
+        if self._peek("op", "("):
+            self._next()
+            inner = self._or()
+            self._expect("op", ")")
+            return inner
+        return self._condition()
+
+    def _condition(self):
+        key = self._frame()
+        token = self._next()
+        kind, op = token
+
+        if kind == "keyword" and op == "exists":
+            return lambda r: key in r
+        if kind == "keyword" and op == "missing":
+            return lambda r: key not in r
+        if kind == "keyword" and op in ("starts", "ends"):
+            self._expect("keyword", "with")
+            value = self._value().lower()
+            if op == "starts":
+                return lambda r: key in r and r[key].lower().startswith(value)
+            return lambda r: key in r and r[key].lower().endswith(value)
+        if kind == "keyword" and op == "contains":
+            value = self._value().lower()
+            return lambda r: key in r and value in r[key].lower()
+        if kind == "keyword" and op == "matches":
+            value = self._value()
+            try:
+                regex = re.compile(value)
+            except re.error as ex:
+                raise QueryError("Invalid regex {0}: {1}".format(value, ex))
+            return lambda r: key in r and regex.search(r[key]) is not None
+        if kind == "op" and op == "=":
+            value = self._value()
+            return lambda r: r.get(key) == value
+        if kind == "op" and op == "!=":
+            value = self._value()
+            return lambda r: r.get(key) != value
+        if kind == "op" and op in ("<", "<=", ">", ">="):
+            value = self._value()
+            return lambda r: key in r and _compare(op, r[key], value)
+        raise QueryError("Unknown condition {0}".format(op))
+
+
+def match_file(fn, query):
+    """
+    :param fn: File of any supported format (see tag_formats)
+    :param query: A compiled Query
+    :return: True if the file's tags match the query
+    """
+    return query.matches(tag_formats.read_record(fn))
+
+
+def update_file(fn, query, journal=None, dry_run=False):
+    """
+    Apply a query's assignments to a file if it matches
+    :param fn: File of any supported format (see tag_formats)
+    :param query: A compiled Query
+    :param journal: Optional WriteJournal recording the original tags
+    :param dry_run: Work out the changes but do not write them
+    :return: None if the file does not match, otherwise the list of changes made
+    """
+    with tag_lock.locked(fn):
+        return tag_formats.set_file_values(fn, query.assignments, journal=journal, dry_run=dry_run,
+                                           where=query.matches)
@@ -0,0 +1,135 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Tag "records" are the plain form of a file's tags used by the batch
+# operations: a dict of frame key (e.g. TALB) to the text value shown in
+# the tags widget.
+#
+
+import mutagen.id3
+import id3frames
+import tag_regions
+
+
+def parse_id3(fn):
+    """
+    Parse a file's ID3 tags, reading the file with as few requests as possible
+    (see tag_regions.CoalescedReader)
+    :param fn: mp3 file
+    :return: A mutagen.id3.ID3 instance
+    :raises mutagen.id3.ID3NoHeaderError: The file has no ID3 tags
+    """
+    with tag_regions.CoalescedReader(fn) as f:
+        id3 = mutagen.id3.ID3(f)
+    # Loaded from a file object, so mutagen does not know the file name
+    id3.filename = fn
+    return id3
+
+
+def load_id3(fn):
+    """
+    Load a file's ID3 tags
+    :param fn: mp3 file
+    :return: A mutagen.id3.ID3 instance. Empty (with no filename) if the file has no ID3v2 tag.
+    """
+    try:
+        return parse_id3(fn)
+    except mutagen.id3.ID3NoHeaderError:
+        return mutagen.id3.ID3()
+
+
+# Separator of the values of a multi-valued text frame in ID3v2.3
+V23_SEP = "/"
+
+
+def save_id3(fn, id3, padding=None):
+    """
+    Save tags in the ID3v2 version they were read in, mutagen would write
+    v2.4. Tags read from a v2.2 file or from no tags at all are written
+    as v2.4. Changing the version is up to the convert command.
+    :param fn: mp3 file
+    :param id3: A mutagen.id3.ID3 instance (see load_id3)
+    :param padding: Optional padding function, see mutagen.id3.ID3.save
+    :return: None
+    """
+    if id3.version[1] == 3:
+        id3.save(fn, v2_version=3, v23_sep=V23_SEP, padding=padding)
+    else:
+        id3.save(fn, v2_version=4, padding=padding)
+
+
+def record_from_id3(id3):
+    """
+    Extract the frame values from loaded tags
+    :param id3: A mutagen.id3.ID3 instance
+    :return: A dict of frame key to text value
+    """
+    record = {}
+    for frame in id3.values():
+        key = frame.FrameID
+        if key not in record and hasattr(frame, "text") and frame.text:
+            record[key] = str(frame.text[0])
+    return record
+
+
+def read_record(fn):
+    """
+    Read the frame values of a file
+    :param fn: mp3 file
+    :return: A dict of frame key to text value (empty if the file has no tags)
+    """
+    return record_from_id3(load_id3(fn))
+
+
+def format_change(key, old, new):
+    return "{0}: {1} -> {2}".format(key, "(none)" if old is None else old, new)
+
+
+def set_values(fn, id3, values, journal=None, dry_run=False):
+    """
+    Set frame values in a file's tags. The file is written only if a
+    value actually changes.
+    :param fn: mp3 file the tags were loaded from
+    :param id3: The file's loaded tags (see load_id3)
+    :param values: Iterable of (frame key, value) 2-tuples
+    :param journal: Optional WriteJournal recording the original tags
+    :param dry_run: Work out the changes but do not write them
+    :return: A list of changes (see format_change)
+    """
+    record = record_from_id3(id3)
+    changes = []
+    for key, new in values:
+        old = record.get(key)
+        if old == new:
+            continue
+        existing = id3.getall(key)
+        if existing and hasattr(existing[0], "text"):
+            # Keep the frame's encoding, description, etc.
+            existing[0].text = [new]
+        else:
+            frame = id3frames.create(key, new)
+            if frame is None:
+                # Skip tags without a creator
+                continue
+            id3.add(frame)
+        record[key] = new
+        changes.append(format_change(key, old, new))
+
+    if changes and not dry_run:
+        if journal:
+            journal.begin(fn, changes)
+        save_id3(fn, id3)
+    return changes
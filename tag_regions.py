@@ -0,0 +1,358 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Raw access to the tag areas of an mp3 file. The "head" is the ID3v2 tag
+# at the start of the file and the "tail" is whatever APEv2 and ID3v1 tags
+# follow the audio. Everything in between is audio and is never touched.
+#
+# References
+# http://id3.org/id3v2.4.0-structure
+# https://wiki.hydrogenaud.io/index.php?title=APEv2_specification
+#
+
+import io
+import os
+import struct
+
+ID3V2_HEADER_SIZE = 10
+ID3V1_SIZE = 128
+APE_FOOTER_SIZE = 32
+
+# Size of the first read of a file by CoalescedReader. Tags smaller than this
+# (and the start of the audio) are read in one request. Configurable, e.g.
+# larger for high latency network file systems.
+read_block_size = 64 * 1024
+# Size of the read at the end of a file, enough for ID3v1 and most APEv2 tags
+TAIL_BLOCK_SIZE = 8 * 1024
+
+
+def id3v2_size(header):
+    """
+    Size of an ID3v2 tag from its 10 byte header
+    :param header: The first 10 (or more) bytes of a file
+    :return: Total tag size in bytes including header (and footer), 0 if there is no tag
+    """
+    if len(header) < ID3V2_HEADER_SIZE or header[:3] != b"ID3":
+        return 0
+    size = _syncsafe(header[6:10]) + ID3V2_HEADER_SIZE
+    # Flag bit 4 indicates a footer (v2.4 only)
+    if header[5] & 0x10:
+        size += ID3V2_HEADER_SIZE
+    return size
+
+
+def padding_size(fileobj):
+    """
+    Unused padding at the end of the ID3v2 tag at the start of a file. Only
+    the tag and frame headers are read, frame contents are skipped.
+    :param fileobj: Open binary file
+    :return: A 2-tuple (tag size, padding size) in bytes, (0, 0) if there is no tag
+    """
+    fileobj.seek(0)
+    header = fileobj.read(ID3V2_HEADER_SIZE)
+    tag_size = id3v2_size(header)
+    if not tag_size:
+        return 0, 0
+    # The end of the frames area, before any footer
+    end = ID3V2_HEADER_SIZE + _syncsafe(header[6:10])
+    pos = _frames_start(fileobj, header)
+    if pos is None:
+        return tag_size, 0
+    for frame_id, offset, size in frame_headers(fileobj):
+        pos = offset + size
+    return tag_size, max(0, end - pos)
+
+
+def frame_headers(fileobj):
+    """
+    Walk the frames of the ID3v2 tag at the start of a file. Only the
+    frame headers are read, frame contents are skipped.
+    :param fileobj: Open binary file
+    :return: A generator of (frame id, offset, size) 3-tuples, the offset
+    and size in bytes of each frame's contents as stored (not decompressed
+    or unsynchronised)
+    """
+    fileobj.seek(0)
+    header = fileobj.read(ID3V2_HEADER_SIZE)
+    if not id3v2_size(header):
+        return
+    version = header[3]
+    end = ID3V2_HEADER_SIZE + _syncsafe(header[6:10])
+    pos = _frames_start(fileobj, header)
+    if pos is None:
+        return
+
+    frame_header_size = 6 if version == 2 else 10
+    id_size = 3 if version == 2 else 4
+    while pos + frame_header_size <= end:
+        fileobj.seek(pos)
+        frame_header = fileobj.read(frame_header_size)
+        if len(frame_header) < frame_header_size or frame_header[0] == 0:
+            break
+        if version == 2:
+            size = int.from_bytes(frame_header[3:6], "big")
+        elif version == 4:
+            size = _syncsafe(frame_header[4:8])
+        else:
+            size = struct.unpack(">I", frame_header[4:8])[0]
+        yield frame_header[:id_size].decode("latin-1"), pos + frame_header_size, size
+        pos += frame_header_size + size
+
+
+def _frames_start(fileobj, header):
+    """
+    :return: Offset of the first frame, after any extended header. None
+    if the extended header is cut short.
+    """
+    pos = ID3V2_HEADER_SIZE
+    if header[5] & 0x40:
+        # Extended header
+        fileobj.seek(pos)
+        ext = fileobj.read(4)
+        if len(ext) < 4:
+            return None
+        pos += _syncsafe(ext) if header[3] == 4 else 4 + struct.unpack(">I", ext)[0]
+    return pos
+
+
+def syncsafe_bytes(size):
+    """
+    Encode a size as a 4 byte syncsafe integer, as in an ID3v2 header
+    """
+    return bytes((size >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+
+def _syncsafe(data):
+    # A "syncsafe" integer has 7 bits per byte
+    size = 0
+    for b in data:
+        size = (size << 7) | (b & 0x7f)
+    return size
+
+
+def tail_tags(fileobj, file_size):
+    """
+    Find the APEv2 and ID3v1 tags at the end of a file. Either may come
+    last: most taggers put ID3v1 last, but mutagen appends an APEv2 tag
+    after an existing ID3v1 tag.
+    :param fileobj: Open binary file
+    :param file_size: Size of the file in bytes
+    :return: A 2-tuple (ID3v1 offset, APEv2 offset), None for a tag that is not there
+    """
+    v1 = ape = None
+    end = file_size
+    while v1 is None or ape is None:
+        if ape is None and end >= APE_FOOTER_SIZE:
+            fileobj.seek(end - APE_FOOTER_SIZE)
+            footer = fileobj.read(APE_FOOTER_SIZE)
+            if footer[:8] == b"APETAGEX":
+                ape_size, _, flags = struct.unpack("<III", footer[12:24])
+                # The size excludes the optional 32 byte header
+                if flags & 0x80000000:
+                    ape_size += APE_FOOTER_SIZE
+                ape = end = max(0, end - ape_size)
+                continue
+        if v1 is None and end >= ID3V1_SIZE:
+            fileobj.seek(end - ID3V1_SIZE)
+            if fileobj.read(3) == b"TAG":
+                v1 = end = end - ID3V1_SIZE
+                continue
+        break
+    return v1, ape
+
+
+def tail_size(fileobj, file_size):
+    """
+    Size of the APEv2 and ID3v1 tags at the end of a file, in either order
+    :param fileobj: Open binary file
+    :param file_size: Size of the file in bytes
+    :return: Number of bytes at the end of the file that are tags
+    """
+    starts = [offset for offset in tail_tags(fileobj, file_size) if offset is not None]
+    return file_size - min(starts) if starts else 0
+
+
+def read_regions(fn):
+    """
+    Read the raw tag areas of a file
+    :param fn: File to be read
+    :return: A 2-tuple of bytes (head, tail). Either may be empty.
+    """
+    with open(fn, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        f.seek(0)
+        head_size = id3v2_size(f.read(ID3V2_HEADER_SIZE))
+        f.seek(0)
+        head = f.read(head_size)
+        size = tail_size(f, file_size)
+        f.seek(file_size - size)
+        tail = f.read(size) if size else b""
+    return head, tail
+
+
+def remove_id3v1(fn):
+    """
+    Remove an ID3v1 tag from the end of a file, in front of or behind an
+    APEv2 tag. The other tags and the audio are left as they are.
+    :param fn: File to be rewritten
+    :return: True if there was an ID3v1 tag
+    """
+    with open(fn, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        v1, ape = tail_tags(f, file_size)
+    if v1 is None:
+        return False
+    head, tail = read_regions(fn)
+    pos = v1 - (file_size - len(tail))
+    replace_regions(fn, head, tail[:pos] + tail[pos + ID3V1_SIZE:])
+    return True
+
+
+def replace_regions(fn, head, tail, chunk_size=1024 * 1024):
+    """
+    Replace the tag areas of a file leaving the audio untouched. The new
+    file is written next to the old one and moved into place, so the
+    file is never left half written.
+    :param fn: File to be rewritten
+    :param head: New ID3v2 bytes (may be empty)
+    :param tail: New APEv2/ID3v1 bytes (may be empty)
+    :param chunk_size: Copy buffer size
+    :return: None
+    """
+    tmp = fn + ".id3tmp"
+    with open(fn, "rb") as src:
+        src.seek(0, os.SEEK_END)
+        file_size = src.tell()
+        src.seek(0)
+        audio_start = id3v2_size(src.read(ID3V2_HEADER_SIZE))
+        audio_end = file_size - tail_size(src, file_size)
+        src.seek(audio_start)
+        with open(tmp, "wb") as dst:
+            dst.write(head)
+            remaining = audio_end - audio_start
+            while remaining > 0:
+                data = src.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                dst.write(data)
+                remaining -= len(data)
+            dst.write(tail)
+            dst.flush()
+            os.fsync(dst.fileno())
+    st = os.stat(fn)
+    os.chmod(tmp, st.st_mode)
+    os.replace(tmp, fn)
+
+
+class CoalescedReader():
+    """
+    Read only file object that serves a tag parser (e.g. mutagen) from two
+    large reads: one at the start of the file covering the whole ID3v2 tag,
+    and one at the end covering the ID3v1/APEv2 tags. On network file
+    systems every read is a round trip, and a parser makes many small ones.
+    Reads outside the two blocks go to the file.
+    """
+    def __init__(self, fn, block_size=None):
+        """
+        :param fn: File to read
+        :param block_size: Minimum size of the first read, default read_block_size
+        """
+        self.name = fn
+        self.requests = 0
+        self._file = open(fn, "rb", buffering=0)
+        try:
+            self._size = os.fstat(self._file.fileno()).st_size
+            self._pos = 0
+            head = self._read_at(0, min(block_size or read_block_size, self._size))
+            # One more read if the tag is larger than the first block (e.g. artwork)
+            tag_size = min(id3v2_size(head), self._size)
+            if tag_size > len(head):
+                head += self._read_at(len(head), tag_size - len(head))
+            # (start, data) of the buffered regions
+            self._blocks = [(0, head)]
+
+            if len(head) < self._size:
+                start = max(len(head), self._size - TAIL_BLOCK_SIZE)
+                tail = self._read_at(start, self._size - start)
+                # An APEv2 tag larger than the tail block
+                tags_start = max(len(head), self._size - tail_size(io.BytesIO(tail), len(tail)))
+                if tags_start < start:
+                    tail = self._read_at(tags_start, start - tags_start) + tail
+                    start = tags_start
+                self._blocks.append((start, tail))
+        except BaseException:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self._file.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek position {0}".format(offset))
+        self._pos = offset
+        return self._pos
+
+    def read(self, size=-1):
+        end = self._size if size is None or size < 0 else min(self._size, self._pos + size)
+        pieces = []
+        while self._pos < end:
+            data = self._buffered(self._pos, end)
+            if data is None:
+                # Not buffered, read from the file up to the next block
+                stop = min([start for start, block in self._blocks if start > self._pos] + [end])
+                data = self._read_at(self._pos, stop - self._pos)
+                if not data:
+                    break
+            pieces.append(data)
+            self._pos += len(data)
+        return b"".join(pieces)
+
+    def _buffered(self, pos, end):
+        for start, block in self._blocks:
+            if start <= pos < start + len(block):
+                return block[pos - start:end - start]
+        return None
+
+    def _read_at(self, pos, size):
+        self.requests += 1
+        self._file.seek(pos)
+        return self._file.read(size)
@@ -0,0 +1,289 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Headless tag service. JSON-RPC 2.0 over HTTP POST on the loopback interface.
+#
+# Methods (paths are relative to the service's root directory):
+#     read(paths)               {path: record} for a list of paths. Files that
+#                               cannot be read map to {"error": message}.
+#     write(path, values)       Set frame values, e.g. {"TCON": "Jazz"}.
+#                               Values must be strings. Returns the list
+#                               of changes.
+#     search(query, directory)  {"matched": paths, "errors": {path: message}}.
+#                               The files under directory (default the
+#                               root) matching a tag_query where clause,
+#                               and the files that could not be read.
+#     stats()                   Cache and request counters.
+#
+# A JSON array of requests is a batch. The requests in a batch run in
+# parallel on the worker pool and the responses are returned together.
+#
+# Listening on the loopback interface is not enough to keep other programs
+# out: a web page can post to it, or reach it through DNS rebinding. So
+# every request must carry the service's token (see new_token) as a bearer
+# token, be sent as application/json, be addressed to 127.0.0.1 or
+# localhost and not come from a foreign web page (Origin).
+#
+# Example:
+#     curl -H "Authorization: Bearer $TOKEN" -H "Content-Type: application/json" \
+#         -d '{"jsonrpc": "2.0", "id": 1, "method": "read", "params": {"paths": ["a.mp3"]}}' \
+#         http://127.0.0.1:8765/
+#
+
+import hmac
+import json
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import library_scan
+import tag_cache
+import tag_formats
+import tag_lock
+import tag_query
+
+DEFAULT_PORT = 8765
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super(RPCError, self).__init__(message)
+        self.code = code
+
+
+class TagService():
+    """
+    The service methods, independent of the transport
+    """
+    def __init__(self, root, workers=library_scan.DEFAULT_WORKERS, cache_size=100000):
+        """
+        :param root: Only files under this directory are served
+        :param workers: Size of the worker pool that does all file I/O
+        :param cache_size: Maximum number of parsed files to keep
+        """
+        self._root = os.path.realpath(root)
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._dispatcher = ThreadPoolExecutor(max_workers=workers)
+        self._cache = tag_cache.TagCache(max_entries=cache_size)
+        # Writes to the same file are serialized, striped over a fixed set of locks
+        self._write_locks = [threading.Lock() for i in range(64)]
+        self._requests = 0
+        self._requests_lock = threading.Lock()
+        self._methods = {
+            "read": self.read,
+            "write": self.write,
+            "search": self.search,
+            "stats": self.stats,
+        }
+
+    def close(self):
+        self._dispatcher.shutdown(wait=True, cancel_futures=True)
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _resolve(self, path):
+        fn = os.path.realpath(os.path.join(self._root, path))
+        if fn != self._root and not fn.startswith(self._root + os.sep):
+            raise RPCError(INVALID_PARAMS, "{0} is outside the service root".format(path))
+        return fn
+
+    def read(self, paths):
+        if not isinstance(paths, list):
+            raise RPCError(INVALID_PARAMS, "paths must be a list")
+        results = {}
+        work = lambda path: self._cache.get(self._resolve(path))
+        for path, record, error in library_scan.parallel_map(work, paths, executor=self._executor):
+            results[path] = record if error is None else {"error": str(error)}
+        return results
+
+    def write(self, path, values):
+        if not isinstance(values, dict):
+            raise RPCError(INVALID_PARAMS, "values must be an object")
+        for key, value in values.items():
+            # Otherwise null would be written as the text "None"
+            if not isinstance(value, str):
+                raise RPCError(INVALID_PARAMS, "The value of {0} must be a string".format(key))
+        fn = self._resolve(path)
+        return self._executor.submit(self._write, fn, values).result()
+
+    def _write(self, fn, values):
+        with self._write_locks[hash(fn) % len(self._write_locks)]:
+            with tag_lock.locked(fn):
+                changes = tag_formats.set_file_values(fn, values.items())
+                if changes:
+                    self._cache.put(fn, tag_formats.read_record(fn))
+        return changes
+
+    def search(self, query, directory=""):
+        try:
+            compiled = tag_query.compile_query(query)
+        except tag_query.QueryError as ex:
+            raise RPCError(INVALID_PARAMS, str(ex))
+        if compiled.is_update:
+            raise RPCError(INVALID_PARAMS, "search does not update files, use write")
+        files = library_scan.scan_files(self._resolve(directory), filter_regex=tag_formats.file_filter())
+        work = lambda fn: compiled.matches(self._cache.get(fn))
+        matched = []
+        errors = {}
+        for fn, is_match, error in library_scan.parallel_map(work, files, executor=self._executor,
+                                                             max_pending=self._workers * 4):
+            if error is not None:
+                errors[os.path.relpath(fn, self._root)] = str(error)
+            elif is_match:
+                matched.append(os.path.relpath(fn, self._root))
+        return {"matched": sorted(matched), "errors": errors}
+
+    def stats(self):
+        return {"requests": self._requests, "cached": len(self._cache),
+                "hits": self._cache.hits, "misses": self._cache.misses}
+
+    def handle(self, request):
+        """
+        Handle a decoded JSON-RPC request or batch
+        :param request: A request object or a list of them
+        :return: The response (list for a batch), None if there is nothing to send
+        """
+        if isinstance(request, list):
+            if not request:
+                return _error_response(None, INVALID_REQUEST, "Empty batch")
+            # The requests of a batch are dispatched on their own pool. They
+            # wait on the worker pool, which only ever runs file I/O.
+            responses = [r for r in self._dispatcher.map(self._handle_one, request) if r is not None]
+            return responses or None
+        return self._handle_one(request)
+
+    def _handle_one(self, request):
+        with self._requests_lock:
+            self._requests += 1
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return _error_response(None, INVALID_REQUEST, "Invalid request")
+        request_id = request.get("id")
+        method = self._methods.get(request["method"])
+        if method is None:
+            return _error_response(request_id, METHOD_NOT_FOUND, "Unknown method " + request["method"])
+        params = request.get("params", {})
+        try:
+            if isinstance(params, list):
+                result = method(*params)
+            else:
+                result = method(**params)
+        except TypeError as ex:
+            return _error_response(request_id, INVALID_PARAMS, str(ex))
+        except RPCError as ex:
+            return _error_response(request_id, ex.code, str(ex))
+        except Exception as ex:
+            return _error_response(request_id, SERVER_ERROR, str(ex))
+        if "id" not in request:
+            # A notification, no response
+            return None
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+
+def _error_response(request_id, code, message):
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+
+def new_token():
+    """
+    :return: A random token for a service, see serve
+    """
+    return secrets.token_urlsafe(32)
+
+
+class _RPCHandler(BaseHTTPRequestHandler):
+    # Set on the server class, see serve()
+    service = None
+    token = None
+    port = None
+
+    def do_POST(self):
+        status = self._check_request()
+        if status:
+            self.send_error(status)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            response = _error_response(None, PARSE_ERROR, "Parse error")
+        else:
+            response = self.service.handle(request)
+
+        body = json.dumps(response).encode("utf-8") if response is not None else b""
+        self.send_response(200 if body else 204)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _check_request(self):
+        """
+        :return: The HTTP error status of a request that is not allowed, None if it is
+        """
+        hosts = ["{0}:{1}".format(name, self.port) for name in ("127.0.0.1", "localhost")]
+        if self.headers.get("Host", "") not in hosts:
+            # Not addressed to the loopback interface, e.g. DNS rebinding
+            return 403
+        origin = self.headers.get("Origin")
+        if origin is not None and origin not in ["http://" + host for host in hosts]:
+            return 403
+        authorization = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization.encode("utf-8"), "Bearer {0}".format(self.token).encode("utf-8")):
+            return 401
+        # A web page can only post other types without a preflight request
+        if self.headers.get_content_type() != "application/json":
+            return 415
+        return None
+
+    def log_message(self, format, *args):
+        # Keep the console quiet, a busy service handles many requests
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog of 5 drops connections with many clients
+    request_queue_size = 128
+
+
+def serve(root, token, port=DEFAULT_PORT, workers=library_scan.DEFAULT_WORKERS, cache_size=100000):
+    """
+    Run the service until interrupted. Only listens on the loopback interface.
+    :param root: Directory of files to serve
+    :param token: Token every request must carry (see new_token)
+    :param port: TCP port
+    :param workers: Worker pool size
+    :param cache_size: Maximum number of parsed files to cache
+    :return: None
+    """
+    if not token:
+        raise ValueError("The service needs a token")
+    service = TagService(root, workers=workers, cache_size=cache_size)
+    handler = type("RPCHandler", (_RPCHandler,), {"service": service, "token": token, "port": port})
+    server = _Server(("127.0.0.1", port), handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
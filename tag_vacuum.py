@@ -0,0 +1,70 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Reclaiming unused ID3v2 padding. The padding is measured from the frame
+# headers alone and a file with too much of it gets its tag rewritten
+# byte for byte with less padding. The frames themselves are not parsed
+# or re-encoded.
+#
+
+import tag_lock
+import tag_regions
+
+# Padding above this is reclaimed
+DEFAULT_THRESHOLD = 64 * 1024
+# Padding left after a file is vacuumed
+DEFAULT_TARGET = 1024
+
+# Header flags of tags whose layout is not rewritten: unsynchronisation,
+# extended header (which can hold the padding size) and footer
+_UNSUPPORTED_FLAGS = 0x80 | 0x40 | 0x10
+
+
+def measure(fn):
+    """
+    :param fn: mp3 file
+    :return: A 2-tuple (ID3v2 tag size, padding size) in bytes
+    """
+    with open(fn, "rb") as f:
+        return tag_regions.padding_size(f)
+
+
+def vacuum_file(fn, threshold=DEFAULT_THRESHOLD, target=DEFAULT_TARGET, journal=None, dry_run=False):
+    """
+    Reduce a file's padding to target bytes if it has more than threshold
+    :param fn: mp3 file
+    :param threshold: Padding in bytes above which the file is rewritten
+    :param target: Padding in bytes left in a rewritten file
+    :param journal: Optional WriteJournal recording the original tags
+    :param dry_run: Work out the bytes reclaimed but do not write anything
+    :return: Number of bytes reclaimed, 0 if the file was left alone
+    """
+    with tag_lock.locked(fn):
+        tag_size, padding = measure(fn)
+        if padding <= threshold or padding <= target:
+            return 0
+
+        head, tail = tag_regions.read_regions(fn)
+        if head[5] & _UNSUPPORTED_FLAGS:
+            raise ValueError("Tags with unsynchronisation, an extended header or a footer are not vacuumed")
+        if not dry_run:
+            frames_end = tag_size - padding
+            new_head = (head[:6] + tag_regions.syncsafe_bytes(frames_end - tag_regions.ID3V2_HEADER_SIZE + target) +
+                        head[tag_regions.ID3V2_HEADER_SIZE:frames_end] + bytes(target))
+            if journal:
+                journal.begin(fn, ["padding: {0} -> {1} bytes".format(padding, target)])
+            tag_regions.replace_regions(fn, new_head, tail)
+        return padding - target
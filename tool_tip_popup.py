@@ -14,12 +14,89 @@
 # You should have received a copy of the GNU General Public License
 # along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
 #
+# One preview window per app is created on first use and shared by every
+# tool tip. Hovering moves it and changes its contents instead of creating
+# and destroying a window each time, which is slow when the pointer moves
+# over many rows. A tool tip can render a preview (text and an image)
+# each time it is shown, so it follows edits to what it previews.
+#
 # Attribution
 # Adapted from https://www.daniweb.com/programming/software-development/code/484591/a-tooltip-class-for-tkinter
 #
 
 from tkinter import Label, Toplevel
 
+# Previews longer than this are cut short
+MAX_PREVIEW_CHARS = 2000
+
+
+class PreviewWindow():
+    """
+    The window shared by the tool tips of an app, hidden between tips
+    """
+    def __init__(self, root):
+        """
+        :param root: The app's Tk root
+        """
+        self._tw = Toplevel(root)
+        # Leaves only the label and removes the app window
+        self._tw.wm_overrideredirect(True)
+        self._tw.withdraw()
+        self._label = Label(self._tw, justify='left', relief='solid', borderwidth=1,
+                            compound='top', wraplength=600)
+        self._label.pack(ipadx=1)
+        # The tip being shown
+        self.owner = None
+        self._close_id = None
+
+    def show(self, owner, x, y, text, image=None, fg="black", bg="#a6e1fc", auto_close=3000):
+        """
+        Show a tip, replacing the one being shown
+        :param owner: The tip's ToolTipPopup
+        :param x: Screen position
+        :param y: Screen position
+        :param text: Text of the tip
+        :param image: Optional PhotoImage shown above the text. The caller keeps a reference to it.
+        :param auto_close: time in ms until the tip automatically closes
+        :return: None
+        """
+        self._cancel_close()
+        self.owner = owner
+        self._label.configure(text=text, image=image or "", fg=fg, bg=bg)
+        self._tw.wm_geometry("+%d+%d" % (x, y))
+        self._tw.deiconify()
+        self._tw.lift()
+        self._close_id = self._tw.after(auto_close, self.hide)
+
+    def hide(self):
+        """
+        Take the tip down
+        :return: None
+        """
+        self._cancel_close()
+        self.owner = None
+        self._tw.withdraw()
+        # Let go of the image, its owner may be gone before the next tip
+        self._label.configure(image="")
+
+    def _cancel_close(self):
+        if self._close_id:
+            # Otherwise the callback outlives the tip
+            self._tw.after_cancel(self._close_id)
+            self._close_id = None
+
+
+def preview_window(widget):
+    """
+    :param widget: Any widget of the app
+    :return: The app's PreviewWindow, created on first use
+    """
+    root = widget._root()
+    window = getattr(root, "_preview_window", None)
+    if window is None:
+        window = root._preview_window = PreviewWindow(root)
+    return window
+
 
 class ToolTipPopup():
     '''
@@ -27,7 +104,7 @@ class ToolTipPopup():
     '''
     def __init__(self, widget, text='widget info',
                  fg="black", bg="#a6e1fc", auto_close=3000,
-                 dx=25, dy=20):
+                 dx=25, dy=20, preview=None):
         """
         Create a tool tip instance
         :param widget: parent widget
@@ -37,6 +114,9 @@ class ToolTipPopup():
         :param auto_close: time in ms until tool tip automatically closes
         :param dx: tooltip x offset from parent widget origin, default 25px
         :param dy: tooltip y offset from parent widget origin, default 20px
+        :param preview: Optional function rendering the tip, called each time
+        it is shown. Returns a 2-tuple (text, PhotoImage or None) used
+        instead of text.
         """
         self._widget = widget
         self._text = text
@@ -45,7 +125,8 @@ class ToolTipPopup():
         self._auto_close = auto_close
         self._dx = dx
         self._dy = dy
-        self._tw = None
+        self._preview = preview
+        self._image = None
         self._widget.bind("<Enter>", self.enter)
         self._widget.bind("<Leave>", self.close)
 
@@ -62,16 +143,15 @@ class ToolTipPopup():
         # Offset tool tip from parent widget
         x += self._widget.winfo_rootx() + self._dx
         y += self._widget.winfo_rooty() + self._dy
-        # creates a toplevel window
-        self._tw = Toplevel(self._widget)
-        # Leaves only the label and removes the app window
-        self._tw.wm_overrideredirect(True)
-        self._tw.wm_geometry("+%d+%d" % (x, y))
-        label = Label(self._tw, text=self._text, justify='left',
-                      fg=self._fg, bg=self._bg, relief='solid', borderwidth=1)
-        label.pack(ipadx=1)
-        # Auto close after 3 sec
-        label.after(self._auto_close, self.close)
+        text = self._text
+        if self._preview:
+            # Rendered on every hover, what it shows may have been edited since.
+            # Only while the tip is shown is the image kept.
+            text, self._image = self._preview()
+            if len(text) > MAX_PREVIEW_CHARS:
+                text = text[:MAX_PREVIEW_CHARS] + "..."
+        preview_window(self._widget).show(self, x, y, text, image=self._image,
+                                          fg=self._fg, bg=self._bg, auto_close=self._auto_close)
 
     def close(self, event=None):
         """
@@ -79,6 +159,8 @@ class ToolTipPopup():
         :param event:
         :return:
         """
-        if self._tw:
-            self._tw.destroy()
-            self._tw = None
+        window = getattr(self._widget._root(), "_preview_window", None)
+        # The window may already show another widget's tip
+        if window is not None and window.owner is self:
+            window.hide()
+        self._image = None
@@ -0,0 +1,210 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Detection of UI stalls. A tick is scheduled on the Tk event loop every
+# interval; a tick that runs late by more than the threshold is a stall.
+# While the loop is stalled a sampler thread records the stack of the Tk
+# thread and the instrumented operations (see operation) that are running.
+# Each stall is written as a JSON line to a rotating log.
+#
+
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+DEFAULT_INTERVAL_MS = 100
+DEFAULT_THRESHOLD_MS = 250
+DEFAULT_LOG_FILE = os.path.join(os.path.expanduser("~"), ".pyid3tag", "stalls.log")
+DEFAULT_MAX_LOG_BYTES = 1024 * 1024
+DEFAULT_LOG_BACKUPS = 3
+
+# Stack samples kept per stall
+_MAX_SAMPLES = 5
+# Finished operations remembered for attributing a stall
+_RECENT_OPERATIONS = 100
+
+
+class Watchdog():
+    """
+    Measures how late Tk event loop ticks run and logs stalls
+    """
+    def __init__(self, widget, interval_ms=DEFAULT_INTERVAL_MS, threshold_ms=DEFAULT_THRESHOLD_MS,
+                 log_file=DEFAULT_LOG_FILE, max_log_bytes=DEFAULT_MAX_LOG_BYTES,
+                 log_backups=DEFAULT_LOG_BACKUPS):
+        """
+        :param widget: Any Tk widget, used to schedule ticks
+        :param interval_ms: Time between ticks
+        :param threshold_ms: A tick later than this is a stall
+        :param log_file: Stall log, rotated when it reaches max_log_bytes
+        :param max_log_bytes: Size of each log file
+        :param log_backups: Number of rotated log files kept
+        """
+        self._widget = widget
+        self._interval = interval_ms / 1000.0
+        self._threshold = threshold_ms / 1000.0
+        self._tk_thread = threading.get_ident()
+        # Operations running on the Tk thread: list of (name, start)
+        self._running = []
+        # Finished operations: (name, start, end)
+        self._finished = deque(maxlen=_RECENT_OPERATIONS)
+        self._lock = threading.Lock()
+        self._last_tick = None
+        self._samples = []
+        self._stop = threading.Event()
+        self.stalls = 0
+        self.worst_ms = 0
+
+        self._logger = logging.getLogger("pyid3tag.stalls")
+        self._logger.propagate = False
+        if log_file:
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            self._handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_log_bytes, backupCount=log_backups, encoding="utf-8")
+            self._logger.addHandler(self._handler)
+            self._logger.setLevel(logging.INFO)
+        else:
+            self._handler = None
+
+    def start(self):
+        """
+        Start ticking and sampling
+        :return: None
+        """
+        self._last_tick = time.monotonic()
+        self._widget.after(int(self._interval * 1000), self._tick)
+        threading.Thread(target=self._sample_loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._handler:
+            self._logger.removeHandler(self._handler)
+            self._handler.close()
+            self._handler = None
+
+    @contextmanager
+    def operation(self, name):
+        """
+        Context manager around an operation on the Tk thread, so stalls
+        during it are attributed to it
+        :param name: Operation name, e.g. "_open_file"
+        """
+        entry = (name, time.monotonic())
+        with self._lock:
+            self._running.append(entry)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running.remove(entry)
+                self._finished.append((name, entry[1], time.monotonic()))
+
+    def _tick(self):
+        if self._stop.is_set():
+            return
+        now = time.monotonic()
+        late = now - self._last_tick - self._interval
+        if late > self._threshold:
+            self._record(self._last_tick + self._interval, now)
+        with self._lock:
+            self._samples = []
+            self._last_tick = now
+        self._widget.after(int(self._interval * 1000), self._tick)
+
+    def _sample_loop(self):
+        """
+        Runs on a worker thread. Samples the Tk thread while the loop is stalled.
+        """
+        while not self._stop.wait(self._interval):
+            with self._lock:
+                stalled = time.monotonic() - self._last_tick - self._interval
+                if stalled <= self._threshold or len(self._samples) >= _MAX_SAMPLES:
+                    continue
+                running = [name for name, start in self._running]
+            frame = sys._current_frames().get(self._tk_thread)
+            stack = traceback.format_stack(frame) if frame else []
+            with self._lock:
+                self._samples.append({"ms": round(stalled * 1000), "operations": running,
+                                      "stack": [line.rstrip() for line in stack]})
+
+    def _record(self, due, now):
+        """
+        Log a stall
+        :param due: When the late tick should have run
+        :param now: When it ran
+        """
+        with self._lock:
+            operations = [name for name, start in self._running if start < now]
+            # Finished ones that overlapped the stall
+            operations += [name for name, start, end in self._finished if end > due and start < now]
+            samples = self._samples
+        stall_ms = round((now - due) * 1000)
+        self.stalls += 1
+        self.worst_ms = max(self.worst_ms, stall_ms)
+        self._logger.info(json.dumps({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "stall_ms": stall_ms,
+            "operations": sorted(set(operations)),
+            "samples": samples,
+        }))
+
+
+# The watchdog the instrumented operations report to, see start
+_current = None
+
+
+def start(widget, **kwargs):
+    """
+    Start the watchdog that instrumented operations report to
+    :param widget: Any Tk widget
+    :param kwargs: Watchdog settings
+    :return: The Watchdog
+    """
+    global _current
+    _current = Watchdog(widget, **kwargs)
+    _current.start()
+    return _current
+
+
+@contextmanager
+def operation(name):
+    """
+    Context manager for an operation on the Tk thread (see Watchdog.operation).
+    Does nothing if no watchdog is running.
+    """
+    if _current is None:
+        yield
+    else:
+        with _current.operation(name):
+            yield
+
+
+def instrumented(func):
+    """
+    Decorator making every call of a method an operation named after it
+    """
+    @wraps(func)
+    def run(*args, **kwargs):
+        with operation(func.__name__):
+            return func(*args, **kwargs)
+    return run
@@ -0,0 +1,297 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Persistent work queue for running one batch job on many workers.
+#
+# A job is split into shards, one per directory (the files directly in
+# that directory). Workers lease a shard, renew the lease with heartbeats
+# while they work on it and then complete or fail it. A shard whose lease
+# runs out (the worker died) is handed to the next worker that asks, and a
+# failed shard is retried up to max_attempts times.
+#
+# SQLiteWorkQueue keeps the queue in an SQLite database file that every
+# worker can open. Another broker can be used by implementing the same
+# methods (create_job, job, lease, heartbeat, complete, fail, release, status).
+#
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import library_scan
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    root TEXT NOT NULL,
+    command TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shard (
+    id INTEGER PRIMARY KEY,
+    directory TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS shard_state ON shard (state, lease_expires);
+"""
+
+
+class Shard():
+    """
+    A leased unit of work
+    """
+    def __init__(self, shard_id, directory, attempts):
+        self.id = shard_id
+        self.directory = directory
+        self.attempts = attempts
+
+
+class SQLiteWorkQueue():
+    """
+    Work queue for one job, stored in an SQLite database
+    """
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param path: Database file. Created if it does not exist.
+        :param lease_seconds: How long a lease lasts without a heartbeat
+        :param max_attempts: Number of times a shard is tried before it is failed for good
+        """
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        # Autocommit mode, transactions are started explicitly
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        # The connection is shared with the heartbeat thread
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._db.close()
+
+    @property
+    def lease_seconds(self):
+        return self._lease_seconds
+
+    def create_job(self, root, command, directories):
+        """
+        Define the job. A queue holds exactly one job.
+        :param root: Root directory of the job
+        :param command: The batch command as a list of arguments (see id3batch.py)
+        :param directories: Iterable of directories, one shard each
+        :return: Number of shards
+        """
+        with self._lock:
+            with _Transaction(self._db):
+                if self._db.execute("SELECT COUNT(*) FROM job").fetchone()[0]:
+                    raise ValueError("The queue already has a job")
+                self._db.execute("INSERT INTO job (id, root, command, created) VALUES (1, ?, ?, ?)",
+                                 (root, json.dumps(command), time.time()))
+                self._db.executemany("INSERT INTO shard (directory, state) VALUES (?, ?)",
+                                     ((d, PENDING) for d in directories))
+                return self._db.execute("SELECT COUNT(*) FROM shard").fetchone()[0]
+
+    def job(self):
+        """
+        :return: A 2-tuple (root, command) of the queue's job
+        """
+        with self._lock:
+            row = self._db.execute("SELECT root, command FROM job").fetchone()
+            if row is None:
+                raise ValueError("The queue has no job")
+            return row[0], json.loads(row[1])
+
+    def lease(self, owner):
+        """
+        Take the next available shard
+        :param owner: Unique name of the worker (e.g. host:pid)
+        :return: A Shard, or None when there is no work left to hand out
+        """
+        with self._lock:
+            now = time.time()
+            with _Transaction(self._db):
+                # Shards whose workers keep dying are not handed out forever
+                self._db.execute(
+                    "UPDATE shard SET state = ?, error = ? "
+                    "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                    (FAILED, "lease expired", LEASED, now, self._max_attempts))
+                row = self._db.execute(
+                    "SELECT id, directory, attempts FROM shard "
+                    "WHERE state = ? OR (state = ? AND lease_expires < ?) "
+                    "ORDER BY id LIMIT 1", (PENDING, LEASED, now)).fetchone()
+                if row is None:
+                    return None
+                self._db.execute(
+                    "UPDATE shard SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE id = ?", (LEASED, owner, now + self._lease_seconds, row[0]))
+            return Shard(row[0], row[1], row[2] + 1)
+
+    def heartbeat(self, shard, owner):
+        """
+        Extend a lease
+        :return: False if the lease has been lost (it expired and was given to another worker)
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE shard SET lease_expires = ? WHERE id = ? AND owner = ? AND state = ?",
+                (time.time() + self._lease_seconds, shard.id, owner, LEASED))
+            return cursor.rowcount == 1
+
+    def complete(self, shard, owner, result):
+        """
+        Mark a shard done
+        :param result: A dict of counts (files, changed, unchanged, failed)
+        :return: False if the lease had been lost, in which case the result is discarded
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE shard SET state = ?, result = ?, lease_expires = NULL, error = NULL "
+                "WHERE id = ? AND owner = ? AND state = ?",
+                (DONE, json.dumps(result), shard.id, owner, LEASED))
+            return cursor.rowcount == 1
+
+    def fail(self, shard, owner, error):
+        """
+        Give a shard back after an error. It is retried unless it has
+        used up its attempts.
+        :param error: Description of the error
+        :return: None
+        """
+        with self._lock:
+            state = PENDING if shard.attempts < self._max_attempts else FAILED
+            self._db.execute(
+                "UPDATE shard SET state = ?, error = ?, lease_expires = NULL "
+                "WHERE id = ? AND owner = ? AND state = ?",
+                (state, str(error), shard.id, owner, LEASED))
+
+    def release(self, shard, owner):
+        """
+        Give a shard back without counting the attempt, e.g. when the worker is stopped
+        :return: None
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE shard SET state = ?, attempts = attempts - 1, lease_expires = NULL "
+                "WHERE id = ? AND owner = ? AND state = ?",
+                (PENDING, shard.id, owner, LEASED))
+
+    def status(self):
+        """
+        Progress of the job
+        :return: A 2-tuple (dict of shard state to count, dict of summed result counts)
+        """
+        with self._lock:
+            states = dict(self._db.execute("SELECT state, COUNT(*) FROM shard GROUP BY state").fetchall())
+            totals = {}
+            for (result,) in self._db.execute("SELECT result FROM shard WHERE state = ?", (DONE,)):
+                for k, v in json.loads(result).items():
+                    totals[k] = totals.get(k, 0) + v
+            return states, totals
+
+    def failures(self):
+        """
+        :return: List of (directory, error) 2-tuples for shards that failed for good
+        """
+        with self._lock:
+            return self._db.execute("SELECT directory, error FROM shard WHERE state = ?", (FAILED,)).fetchall()
+
+
+class _Transaction():
+    """
+    BEGIN IMMEDIATE takes the database write lock up front, so two workers
+    cannot lease the same shard.
+    """
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        self._db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self._db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def shard_directories(root, filter_regex=library_scan.DEFAULT_FILTER):
+    """
+    The directories of a tree that contain files, i.e. the shards of a job over it
+    :param root: Root directory
+    :param filter_regex: filter regex for files
+    :return: A generator of directory paths
+    """
+    pattern = re.compile(filter_regex)
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort()
+        if any(pattern.match(f) for f in files):
+            yield directory
+
+
+def run_worker(queue, owner, process_shard, heartbeat_interval=None):
+    """
+    Lease and process shards until there are none left
+    :param queue: A work queue (e.g. SQLiteWorkQueue) with a lease_seconds property
+    :param owner: Unique name of this worker
+    :param process_shard: Called as process_shard(shard, lost) and returns a dict of
+    counts. lost is a threading.Event set if the lease is lost, the work should stop.
+    :param heartbeat_interval: Seconds between heartbeats, default a third of the lease time
+    :return: Number of shards completed by this worker
+    """
+    if heartbeat_interval is None:
+        heartbeat_interval = queue.lease_seconds / 3
+    completed = 0
+    while True:
+        shard = queue.lease(owner)
+        if shard is None:
+            return completed
+
+        lost = threading.Event()
+        finished = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(heartbeat_interval):
+                if not queue.heartbeat(shard, owner):
+                    lost.set()
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            result = process_shard(shard, lost)
+        except KeyboardInterrupt:
+            queue.release(shard, owner)
+            raise
+        except Exception as ex:
+            queue.fail(shard, owner, ex)
+            continue
+        finally:
+            finished.set()
+            heartbeat_thread.join()
+
+        if not lost.is_set() and queue.complete(shard, owner, result):
+            completed += 1
@@ -0,0 +1,298 @@
+# coding: utf-8
+#
+# Copyright © 2019 Dave Hocker (email: AtHomeX10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Append-only journal for batch writes.
+#
+# The journal is a text file with one JSON record per line:
+#     {"op": "blob", "id": ..., "data": ...}
+#         A piece of a file's original tag bytes, zlib compressed (base64).
+#         id is the SHA-256 of the bytes, a piece is written once per
+#         journal however many files have it.
+#     {"op": "begin", "path": ..., "changes": [...], "head": [...], "padding": ..., "tail": [...]}
+#         Written (and synced to disk) before a file is changed. changes
+#         are the edits about to be made with the old values (e.g. "TCON:
+#         Pop -> Rock"), if known. head and tail are the ids of the pieces
+#         of the file's original tag areas (see tag_regions), the head
+#         without its padding, which is that many zero bytes. The contents
+#         of frames of at least BLOB_MIN_SIZE bytes (artwork, mostly) are
+#         pieces of their own, so the artwork of an album is in the journal
+#         once.
+#     {"op": "begin", "path": ..., "changes": [...], "values": {...}}
+#         The same for a file that is not an mp3 file (see tag_formats).
+#         values are the old values of the frame keys about to be changed,
+#         null for a key the file did not have. A rollback puts back these
+#         values, not the bytes.
+#     {"op": "done", "path": ...}
+#         Written after a file has been processed (changed or not).
+#
+# Syncing every record would cost one disk flush per file. Instead records
+# are group committed: a writer waits until its begin record is on disk, and
+# one fsync covers every record written since the last one. While one fsync
+# is running the other workers' records pile up for the next, so the slower
+# the disk the bigger the batches.
+#
+
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+import zlib
+import tag_formats
+import tag_lock
+import tag_regions
+
+# Frames at least this large are journaled as pieces of their own
+BLOB_MIN_SIZE = 4096
+# Fast compression, the writers wait for the journal
+_COMPRESS_LEVEL = 1
+
+
+def _head_pieces(head):
+    """
+    Split an ID3v2 tag into runs of small frames and the contents of
+    single large frames
+    :return: A 2-tuple (list of pieces, bytes of padding left out)
+    """
+    data = head.rstrip(b"\x00")
+    cuts = []
+    for frame_id, offset, size in tag_regions.frame_headers(io.BytesIO(head)):
+        if size >= BLOB_MIN_SIZE:
+            # Only the contents, frame headers differ between ID3v2 versions
+            cuts += [offset, offset + size]
+    pieces = []
+    pos = 0
+    for cut in cuts + [len(data)]:
+        # Put together again byte for byte whatever the cuts, e.g. when a
+        # frame ends in zero bytes taken for padding
+        cut = min(cut, len(data))
+        if cut > pos:
+            pieces.append(data[pos:cut])
+            pos = cut
+    return pieces, len(head) - len(data)
+
+
+class WriteJournal():
+    """
+    Journal of the files changed by a batch operation
+    """
+    def __init__(self, path):
+        """
+        Open (or continue) a journal
+        :param path: Journal file path
+        """
+        self._path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._cond = threading.Condition()
+        # Records written and records known to be on disk
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        # Ids of the pieces written by this journal
+        self._blobs = set()
+
+    @property
+    def path(self):
+        return self._path
+
+    def begin(self, fn, changes=None):
+        """
+        Record a file's original tags before it is changed. Returns once
+        the record is safely on disk.
+        :param fn: File about to be written
+        :param changes: Optional list of the changes about to be made (see
+        tag_records.format_change)
+        :return: None
+        """
+        head, tail = tag_regions.read_regions(fn)
+        head_pieces, padding = _head_pieces(head)
+        seq = self._append({"op": "begin", "path": fn, "changes": changes or [],
+                            "head": [self._add_blob(p) for p in head_pieces], "padding": padding,
+                            "tail": [self._add_blob(tail)] if tail else []})
+        self._wait_synced(seq)
+
+    def begin_values(self, fn, changes, values):
+        """
+        Record the old values of a file that is not an mp3 file before it
+        is changed. Returns once the record is safely on disk.
+        :param fn: File about to be written
+        :param changes: List of the changes about to be made (see tag_records.format_change)
+        :param values: A dict of frame key to its value before the changes, None if there was none
+        :return: None
+        """
+        seq = self._append({"op": "begin", "path": fn, "changes": changes, "values": values})
+        self._wait_synced(seq)
+
+    def _add_blob(self, data):
+        """
+        Write a piece of tag bytes unless it already is in the journal. It
+        is written before the begin record that refers to it, so it is on
+        disk when the begin record is.
+        :return: Its id
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        with self._cond:
+            if digest in self._blobs:
+                return digest
+        # Compressed without holding up the other writers
+        encoded = base64.b64encode(zlib.compress(data, _COMPRESS_LEVEL)).decode("ascii")
+        with self._cond:
+            if digest not in self._blobs:
+                self._append({"op": "blob", "id": digest, "data": encoded})
+                self._blobs.add(digest)
+        return digest
+
+    def complete(self, fn):
+        """
+        Record that a file has been processed. Does not wait for the disk.
+        If the record is lost in a crash the file is simply processed again.
+        :param fn: File that was processed
+        :return: None
+        """
+        self._append({"op": "done", "path": fn})
+
+    def close(self):
+        with self._cond:
+            self._sync()
+            self._file.close()
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._cond:
+            self._file.write(line)
+            self._written += 1
+            return self._written
+
+    def _wait_synced(self, seq):
+        with self._cond:
+            while self._synced < seq:
+                if self._syncing:
+                    # Records written while a sync is running are
+                    # covered together by the next one
+                    self._cond.wait()
+                else:
+                    self._sync()
+
+    def _sync(self):
+        """
+        Flush everything written so far. Called with the condition held,
+        which is released during the fsync so writers can keep appending.
+        """
+        self._syncing = True
+        target = self._written
+        self._file.flush()
+        self._cond.release()
+        try:
+            os.fsync(self._file.fileno())
+        finally:
+            self._cond.acquire()
+            self._syncing = False
+        self._synced = max(self._synced, target)
+        self._cond.notify_all()
+
+
+def read_journal(path):
+    """
+    Read the records of a journal. A partial last line (from a crash
+    while writing it) is ignored.
+    :param path: Journal file path
+    :return: A generator of (offset, record) 2-tuples
+    """
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.endswith(b"\n"):
+                try:
+                    yield offset, json.loads(line.decode("utf-8"))
+                except ValueError:
+                    pass
+            offset += len(line)
+
+
+def completed_files(path):
+    """
+    The files a journal records as done. Used to resume an interrupted job.
+    :param path: Journal file path
+    :return: A set of file paths
+    """
+    done = set()
+    if os.path.exists(path):
+        for _, record in read_journal(path):
+            if record["op"] == "done":
+                done.add(record["path"])
+    return done
+
+
+def changed_files(path):
+    """
+    Every file the journal has a begin record for, with the location of
+    its earliest begin record (that holds the file's original tags).
+    :param path: Journal file path
+    :return: A dict of file path to journal offset
+    """
+    changed = {}
+    for offset, record in read_journal(path):
+        if record["op"] == "begin" and record["path"] not in changed:
+            changed[record["path"]] = offset
+    return changed
+
+
+def blob_offsets(path):
+    """
+    Where the pieces of tag bytes are in a journal
+    :param path: Journal file path
+    :return: A dict of piece id to journal offset
+    """
+    blobs = {}
+    for offset, record in read_journal(path):
+        if record["op"] == "blob":
+            blobs.setdefault(record["id"], offset)
+    return blobs
+
+
+def _read_record(f, offset):
+    f.seek(offset)
+    return json.loads(f.readline().decode("utf-8"))
+
+
+def restore_file(path, fn, offset, blobs):
+    """
+    Put back a file's original tags from its begin record, the old values
+    of the changed frames for a file that is not an mp3 file
+    :param path: Journal file path
+    :param fn: File to be restored
+    :param offset: Offset of the file's begin record (see changed_files)
+    :param blobs: Offsets of the pieces of tag bytes (see blob_offsets)
+    :return: None
+    """
+    with open(path, "rb") as f:
+        record = _read_record(f, offset)
+        if "values" in record:
+            values = record["values"]
+            with tag_lock.locked(fn):
+                tag_formats.format_for(fn).set_values(fn, sorted((k, v) for k, v in values.items() if v is not None),
+                                                      remove=[k for k, v in values.items() if v is None])
+            return
+
+        def join(ids):
+            return b"".join(zlib.decompress(base64.b64decode(_read_record(f, blobs[i])["data"])) for i in ids)
+
+        head = join(record["head"]) + b"\x00" * record["padding"]
+        tail = join(record["tail"])
+    with tag_lock.locked(fn):
+        if tag_regions.read_regions(fn) != (head, tail):
+            tag_regions.replace_regions(fn, head, tail)